@@ -0,0 +1,225 @@
+"""Lokalne atrapy API Stripe i WooCommerce do testów obciążeniowych.
+
+Serwery odpowiadają na endpointy używane przez aplikację, z konfigurowalnym opóźnieniem,
+odsetkiem błędów, przepustowością (429 z Retry-After ponad limit równoległych żądań)
+oraz rozmiarem katalogu. Każde żądanie jest mierzone per endpoint.
+"""
+import json
+import random
+import re
+import threading
+import time
+from collections import defaultdict
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+
+class FakeService:
+    def __init__(self, latency_ms=0, jitter_ms=0, error_rate=0.0, seed=None, capacity=None):
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.error_rate = error_rate
+        self.capacity = capacity
+        self.active = 0
+        self.throttled = 0
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.timings = defaultdict(list)
+        self.errors = defaultdict(int)
+        self.server = None
+
+    def start(self):
+        service = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def _handle(self):
+                length = int(self.headers.get('Content-Length') or 0)
+                body = self.rfile.read(length) if length else b''
+                service.handle(self, body)
+
+            do_GET = do_POST = do_PUT = do_DELETE = _handle
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self.url
+
+    def stop(self):
+        if self.server:
+            self.server.shutdown()
+            self.server.server_close()
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server.server_port}"
+
+    def handle(self, request, body):
+        started = time.perf_counter()
+        parsed = urlparse(request.path)
+        query = {key: values[-1] for key, values in parse_qs(parsed.query).items()}
+        endpoint = self.endpoint_name(request.command, parsed.path)
+
+        with self.lock:
+            rejected = self.capacity is not None and self.active >= self.capacity
+            if rejected:
+                self.throttled += 1
+            else:
+                self.active += 1
+        if rejected:
+            self.respond(request, 429, {'error': 'rate limited'}, {'Retry-After': '1'})
+            return
+        try:
+            self._handle_accepted(request, parsed, query, body, endpoint, started)
+        finally:
+            with self.lock:
+                self.active -= 1
+
+    def _handle_accepted(self, request, parsed, query, body, endpoint, started):
+        delay = self.latency_ms + (self.random.uniform(0, self.jitter_ms) if self.jitter_ms else 0)
+        if delay:
+            time.sleep(delay / 1000)
+
+        if self.error_rate and self.random.random() < self.error_rate:
+            status, payload, headers = 503, {'error': 'injected failure'}, {}
+            with self.lock:
+                self.errors[endpoint] += 1
+        else:
+            try:
+                status, payload, headers = self.route(request.command, parsed.path, query, body)
+            except Exception as e:
+                status, payload, headers = 500, {'error': str(e)}, {}
+
+        self.respond(request, status, payload, headers)
+
+        with self.lock:
+            self.timings[endpoint].append(time.perf_counter() - started)
+
+    @staticmethod
+    def respond(request, status, payload, headers):
+        data = json.dumps(payload).encode('utf-8')
+        request.send_response(status)
+        request.send_header('Content-Type', 'application/json')
+        request.send_header('Content-Length', str(len(data)))
+        for key, value in headers.items():
+            request.send_header(key, value)
+        request.end_headers()
+        request.wfile.write(data)
+
+    @staticmethod
+    def endpoint_name(method, path):
+        path = re.sub(r'/(cs|prod|price|evt|cus)_[A-Za-z0-9]+', r'/{\1}', path)
+        path = re.sub(r'/\d+', '/{id}', path)
+        return f"{method} {path}"
+
+    def route(self, method, path, query, body):
+        raise NotImplementedError
+
+    def reset_stats(self):
+        with self.lock:
+            self.timings.clear()
+            self.errors.clear()
+
+
+class FakeStripe(FakeService):
+    def __init__(self, catalog_size=100, **kwargs):
+        super().__init__(**kwargs)
+        self.products = [{'id': f'prod_{i}', 'object': 'product', 'name': f'Produkt {i}', 'active': True,
+                          'updated': 1700000000, 'default_price': f'price_{i}'}
+                         for i in range(catalog_size)]
+        self.line_items = {}
+
+    def add_session(self, session_id, line_items):
+        self.line_items[session_id] = line_items
+
+    def route(self, method, path, query, body):
+        match = re.fullmatch(r'/v1/checkout/sessions/([^/]+)/line_items', path)
+        if match:
+            return 200, self._list(self.line_items.get(match.group(1), []), path, query), {}
+        match = re.fullmatch(r'/v1/checkout/sessions/([^/]+)', path)
+        if match:
+            session_id = match.group(1)
+            items = self.line_items.get(session_id, [])
+            return 200, {'id': session_id, 'object': 'checkout.session',
+                         'line_items': self._list(items, f'{path}/line_items', {})}, {}
+        if path == '/v1/products':
+            return 200, self._list(self.products, path, query), {}
+        if path == '/v1/events':
+            return 200, self._list([], path, query), {}
+        return 404, {'error': {'message': f'Nieznany endpoint {path}'}}, {}
+
+    @staticmethod
+    def _list(items, url, query):
+        limit = int(query.get('limit', 10))
+        start = 0
+        if query.get('starting_after'):
+            ids = [item['id'] for item in items]
+            start = ids.index(query['starting_after']) + 1
+        page = items[start:start + limit]
+        return {'object': 'list', 'url': url, 'data': page, 'has_more': start + limit < len(items)}
+
+
+class FakeWooCommerce(FakeService):
+    def __init__(self, catalog_size=100, existing_orders=0, **kwargs):
+        super().__init__(**kwargs)
+        self.products = [{'id': i, 'name': f'Produkt {i}', 'status': 'publish', 'price': '10.00',
+                          'date_modified_gmt': '2024-01-01T00:00:00'}
+                         for i in range(1, catalog_size + 1)]
+        self.orders = [{'id': i, 'meta_data': [{'key': 'stripe_session_id', 'value': f'cs_old_{i}'}]}
+                       for i in range(1, existing_orders + 1)]
+        self.customers = {}
+        self.order_created_at = {}
+
+    def route(self, method, path, query, body):
+        endpoint = path.split('/wp-json/wc/v3/', 1)[-1]
+        data = json.loads(body) if body else None
+
+        if endpoint == 'products' and method == 'GET':
+            return self._page(self.products, query)
+        if endpoint == 'orders' and method == 'GET':
+            return self._page(self.orders, query)
+        if endpoint == 'orders' and method == 'POST':
+            return 201, self._create_order(data), {}
+        if endpoint == 'orders/batch' and method == 'POST':
+            return 200, {'create': [self._create_order(order) for order in data.get('create', [])]}, {}
+        if endpoint == 'customers' and method == 'GET':
+            if 'email' in query:
+                customer = self.customers.get(query['email'])
+                return 200, [customer] if customer else [], {}
+            return self._page(list(self.customers.values()), query)
+        if endpoint == 'customers' and method == 'POST':
+            with self.lock:
+                if data['email'] in self.customers:
+                    return 400, {'code': 'registration-error-email-exists'}, {}
+                customer = {'id': len(self.customers) + 1, 'email': data['email'],
+                            'first_name': data.get('first_name')}
+                self.customers[data['email']] = customer
+            return 201, customer, {}
+        match = re.fullmatch(r'customers/(\d+)', endpoint)
+        if match:
+            for customer in self.customers.values():
+                if customer['id'] == int(match.group(1)):
+                    return 200, customer, {}
+            return 404, {'code': 'woocommerce_rest_invalid_id'}, {}
+        return 404, {'code': 'rest_no_route', 'message': endpoint}, {}
+
+    def _create_order(self, order_data):
+        with self.lock:
+            order = dict(order_data, id=len(self.orders) + 1)
+            self.orders.append(order)
+        for meta in order.get('meta_data', []):
+            if meta['key'] == 'stripe_session_id':
+                self.order_created_at[meta['value']] = time.perf_counter()
+        return order
+
+    @staticmethod
+    def _page(items, query):
+        page = int(query.get('page', 1))
+        per_page = int(query.get('per_page', 10))
+        total_pages = (len(items) + per_page - 1) // per_page
+        headers = {'X-WP-Total': str(len(items)), 'X-WP-TotalPages': str(total_pages)}
+        return 200, items[(page - 1) * per_page:page * per_page], headers
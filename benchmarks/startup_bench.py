@@ -0,0 +1,133 @@
+"""Pomiar czasu startu procesu aplikacji (np. workera gunicorna).
+
+Każdy pomiar to nowy proces Pythona, więc obejmuje import modułów i budowę aplikacji
+dokładnie tak, jak przy skalowaniu lub restarcie. Przykłady:
+    python -m benchmarks.startup_bench --runs 20
+    python -m benchmarks.startup_bench --save-baseline benchmarks/startup_baseline.json
+    python -m benchmarks.startup_bench --baseline benchmarks/startup_baseline.json --tolerance 0.25
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Kod uruchamiany w nowym procesie - wypisuje czasy kolejnych etapów w sekundach
+PROBES = {
+    'wsgi': """
+import json, time
+started = time.perf_counter()
+from src.wsgi import app
+booted = time.perf_counter()
+app.test_client().get('/')
+first_request = time.perf_counter()
+from src.handlers import registry
+with app.app_context():
+    registry.current()
+handlers = time.perf_counter()
+print(json.dumps({'wsgi boot': booted - started, 'wsgi first request': first_request - booted,
+                  'wsgi first handlers (lazy SDK import)': handlers - first_request}))
+""",
+    'dev': """
+import json, os, time
+started = time.perf_counter()
+from src import create_app
+create_app(start_workers=False, config_path=os.environ['STRIPEWOO_CONFIG'])
+print(json.dumps({'create_app with migrate': time.perf_counter() - started}))
+""",
+}
+
+
+def percentile(values, p):
+    values = sorted(values)
+    index = min(len(values) - 1, max(0, int(round(p / 100 * (len(values) - 1)))))
+    return values[index]
+
+
+def prepare(directory):
+    config_path = os.path.join(directory, 'config.yaml')
+    with open(config_path, 'w') as file:
+        json.dump({
+            'sqlalchemy': {'secret_key': 'bench', 'database_url': f"sqlite:///{os.path.join(directory, 'bench.db')}"},
+            'queue': {'workers': 0},
+            'logging': {'level': 'WARNING'},
+        }, file)  # JSON jest poprawnym YAML-em
+    env = dict(os.environ, STRIPEWOO_CONFIG=config_path)
+    subprocess.run([sys.executable, '-m', 'src.migrate'], cwd=ROOT, env=env, check=True, capture_output=True)
+    # Handlery muszą być skonfigurowane, żeby pomiar objął leniwy import SDK
+    subprocess.run([sys.executable, '-c', """
+import os
+from src import create_app
+from src.utils import save_config
+app = create_app(start_workers=False, config_path=os.environ['STRIPEWOO_CONFIG'], migrate=False)
+with app.app_context():
+    save_config({'woocommerce': {'url': 'https://woo.invalid', 'consumer_key': 'ck', 'consumer_secret': 'cs'},
+                 'stripe': {'api_key': 'sk_test_bench', 'webhook_secret': 'whsec_bench'}})
+"""], cwd=ROOT, env=env, check=True, capture_output=True)
+    return env
+
+
+def run(args):
+    timings = {}
+    with tempfile.TemporaryDirectory() as directory:
+        env = prepare(directory)
+        for _ in range(args.runs):
+            for name, probe in PROBES.items():
+                started = time.perf_counter()
+                result = subprocess.run([sys.executable, '-c', probe], cwd=ROOT, env=env, check=True,
+                                        capture_output=True, text=True)
+                timings.setdefault(f'{name} process total', []).append(time.perf_counter() - started)
+                for stage, value in json.loads(result.stdout.strip().splitlines()[-1]).items():
+                    timings.setdefault(stage, []).append(value)
+    return {stage: {'count': len(values), 'p50_ms': percentile(values, 50) * 1000,
+                    'p95_ms': percentile(values, 95) * 1000}
+            for stage, values in timings.items()}
+
+
+def compare(results, baseline, tolerance):
+    regressions = []
+    for stage, previous in baseline.items():
+        if stage not in results:
+            continue
+        value, before = results[stage]['p50_ms'], previous['p50_ms']
+        if value > before * (1 + tolerance) and value - before > 5.0:
+            regressions.append(f"{stage}: {value:.1f} ms > {before:.1f} ms")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark czasu startu procesu aplikacji")
+    parser.add_argument('--runs', type=int, default=10)
+    parser.add_argument('--output', help="Zapisz wynik jako JSON")
+    parser.add_argument('--save-baseline', help="Zapisz wynik jako punkt odniesienia")
+    parser.add_argument('--baseline', help="Porównaj wynik z punktem odniesienia")
+    parser.add_argument('--tolerance', type=float, default=0.25)
+    args = parser.parse_args()
+
+    results = run(args)
+    print(f"\n{'Etap':<45}{'n':>6}{'p50 ms':>10}{'p95 ms':>10}")
+    for stage, stats in results.items():
+        print(f"{stage:<45}{stats['count']:>6}{stats['p50_ms']:>10.1f}{stats['p95_ms']:>10.1f}")
+
+    for path in (args.output, args.save_baseline):
+        if path:
+            with open(path, 'w') as file:
+                json.dump(results, file, indent=2)
+
+    if args.baseline:
+        with open(args.baseline, 'r') as file:
+            regressions = compare(results, json.load(file), args.tolerance)
+        if regressions:
+            print("\nRegresje czasu startu:")
+            for regression in regressions:
+                print(f"  {regression}")
+            sys.exit(1)
+        print("\nBrak regresji względem punktu odniesienia.")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,369 @@
+"""Test obciążeniowy ścieżki /webhook na lokalnych atrapach Stripe i WooCommerce.
+
+Przykłady:
+    python -m benchmarks.webhook_bench --events 500 --concurrency 20
+    python -m benchmarks.webhook_bench --save-baseline benchmarks/baseline.json
+    python -m benchmarks.webhook_bench --baseline benchmarks/baseline.json --tolerance 0.25
+
+W trybie --baseline skrypt kończy się kodem 1, jeśli któraś metryka pogorszyła się
+o więcej niż `tolerance` względem zapisanego wyniku.
+"""
+import argparse
+import hashlib
+import hmac
+import json
+import logging
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+
+import requests
+from werkzeug.serving import make_server
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.fake_services import FakeStripe, FakeWooCommerce  # noqa: E402
+from src import create_app  # noqa: E402
+from src.extensions import db  # noqa: E402
+from src.handlers import registry  # noqa: E402
+from src.metrics import stage_summary  # noqa: E402
+from src.models import Product  # noqa: E402
+from src.product_index import product_index  # noqa: E402
+from src.event_log import read_events  # noqa: E402
+from src.replay import replay, parse_time  # noqa: E402
+from src.utils import save_config  # noqa: E402
+
+WEBHOOK_SECRET = 'whsec_bench'
+
+# Metryki, dla których większa wartość oznacza lepszy wynik
+HIGHER_IS_BETTER = {'throughput'}
+
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    index = min(len(values) - 1, max(0, int(round(p / 100 * (len(values) - 1)))))
+    return values[index]
+
+
+def summarize(values):
+    return {
+        'count': len(values),
+        'p50_ms': percentile(values, 50) * 1000,
+        'p95_ms': percentile(values, 95) * 1000,
+        'p99_ms': percentile(values, 99) * 1000,
+    }
+
+
+def sign(payload, secret=WEBHOOK_SECRET, timestamp=None):
+    timestamp = timestamp or int(time.time())
+    signature = hmac.new(secret.encode(), f"{timestamp}.".encode() + payload, hashlib.sha256).hexdigest()
+    return f"t={timestamp},v1={signature}"
+
+
+def make_line_items(index, catalog_size, items_per_cart, rng):
+    line_items = []
+    for position in range(items_per_cart):
+        product = rng.randrange(catalog_size)
+        line_items.append({'id': f'li_{index}_{position}', 'object': 'item', 'quantity': rng.randint(1, 3),
+                           'amount_total': rng.randint(100, 10000),
+                           'price': {'id': f'price_{product}', 'object': 'price', 'product': f'prod_{product}'}})
+    return line_items
+
+
+def make_event(index, fake_stripe, catalog_size, items_per_cart, rng):
+    session_id = f"cs_bench{index}"
+    fake_stripe.add_session(session_id, make_line_items(index, catalog_size, items_per_cart, rng))
+    session = {
+        'id': session_id,
+        'object': 'checkout.session',
+        'created': int(time.time()),
+        'payment_intent': f'pi_bench{index}',
+        'customer_details': {'email': f'klient{rng.randrange(max(1, index // 2 + 1))}@example.com',
+                             'name': f'Klient {index}'},
+    }
+    return {'id': f'evt_bench{index}', 'object': 'event', 'type': 'checkout.session.completed',
+            'created': int(time.time()), 'data': {'object': session}}
+
+
+def as_record(event):
+    return {'received_at': event['created'], 'body': json.dumps(event), 'session_id': event['data']['object']['id']}
+
+
+def load_recorded_events(args, fake_stripe, rng):
+    """Eventy checkout.session.completed z dziennika (src.event_log); line items generuje atrapa Stripe."""
+    records = []
+    since = parse_time(args.replay_from) if args.replay_from else None
+    until = parse_time(args.replay_to) if args.replay_to else None
+    for record in read_events(args.replay_dir, since, until):
+        if record['type'] != 'checkout.session.completed':
+            continue
+        record['session_id'] = json.loads(record['body'])['data']['object']['id']
+        fake_stripe.add_session(record['session_id'],
+                                make_line_items(len(records), args.catalog_size, args.items_per_cart, rng))
+        records.append(record)
+    return records
+
+
+def write_config(directory, args, stripe_url):
+    config_path = os.path.join(directory, 'config.yaml')
+    with open(config_path, 'w') as file:
+        json.dump({
+            'sqlalchemy': {'secret_key': 'bench', 'database_url': f"sqlite:///{os.path.join(directory, 'bench.db')}"},
+            'queue': {'workers': args.workers, 'poll_interval': 0.05, 'backoff_seconds': 1,
+                      'mode': args.mode, 'in_flight': args.in_flight},
+            'http': {'stripe_api_base': stripe_url, 'pool_maxsize': max(20, args.workers * 2)},
+            'batching': {'enabled': args.batching, 'window_ms': args.batch_window_ms},
+        }, file)  # JSON jest poprawnym YAML-em
+    return config_path
+
+
+def setup_app(config_path, fake_woo, catalog_size):
+    app = create_app(start_workers=False, config_path=config_path)
+    with app.app_context():
+        save_config({
+            'woocommerce': {'url': fake_woo.url, 'consumer_key': 'ck_bench', 'consumer_secret': 'cs_bench'},
+            'stripe': {'api_key': 'sk_test_bench', 'webhook_secret': WEBHOOK_SECRET},
+        })
+        products = []
+        for i in range(catalog_size):
+            product = Product(stripe_id=f'prod_{i}', name=f'Produkt {i}')
+            product.set_woo_product_ids([i + 1])
+            products.append(product)
+        db.session.add_all(products)
+        db.session.commit()
+        product_index.invalidate()
+        registry.current()
+    return app
+
+
+def fire(url, records, concurrency, speed=None):
+    session = requests.Session()
+    session.mount('http://', requests.adapters.HTTPAdapter(pool_maxsize=concurrency))
+    sent_at = {}
+    ingest = []
+    failures = 0
+    lock = threading.Lock()
+
+    def send(record):
+        nonlocal failures
+        payload = record['body'].encode('utf-8')
+        started = time.perf_counter()
+        response = session.post(url, data=payload, headers={'Stripe-Signature': sign(payload),
+                                                           'Content-Type': 'application/json'})
+        elapsed = time.perf_counter() - started
+        with lock:
+            sent_at[record['session_id']] = started
+            ingest.append(elapsed)
+            if response.status_code != 200:
+                failures += 1
+
+    started = time.perf_counter()
+    # Tempo jak w src.replay: najszybciej lub z zachowaniem oryginalnych odstępów (`speed`)
+    replay(records, send, speed=speed, concurrency=concurrency)
+    return sent_at, ingest, failures, time.perf_counter() - started
+
+
+def wait_for_orders(fake_woo, session_ids, timeout):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if all(session_id in fake_woo.order_created_at for session_id in session_ids):
+            return True
+        time.sleep(0.05)
+    return False
+
+
+def micro_benchmarks(app, fake_stripe, catalog_size, items_per_cart, rng, iterations):
+    """Bezpośrednie pomiary prepare_line_items i create_order - wykrywają regresje w samym kodzie."""
+    results = {'prepare_line_items': [], 'create_order': []}
+    with app.app_context():
+        woocommerce_handler, stripe_handler = registry.current()
+        carts = []
+        for i in range(iterations):
+            event = make_event(1_000_000 + i, fake_stripe, catalog_size, items_per_cart, rng)
+            carts.append((event['data']['object'], fake_stripe.line_items[event['data']['object']['id']]))
+
+        for _, line_items in carts:
+            started = time.perf_counter()
+            woocommerce_handler.prepare_line_items(line_items)
+            results['prepare_line_items'].append(time.perf_counter() - started)
+
+        for session, line_items in carts:
+            started = time.perf_counter()
+            woocommerce_handler.create_order(session, line_items)
+            results['create_order'].append(time.perf_counter() - started)
+    return {name: summarize(values) for name, values in results.items()}
+
+
+def flatten(results):
+    flat = {'throughput': results['throughput']}
+    for group in ('stages', 'micro'):
+        for name, stats in results[group].items():
+            for key in ('p50_ms', 'p95_ms', 'p99_ms'):
+                flat[f"{group}.{name}.{key}"] = stats[key]
+    return flat
+
+
+def compare(results, baseline, tolerance):
+    regressions = []
+    current = flatten(results)
+    for key, previous in flatten(baseline).items():
+        if key not in current or not previous:
+            continue
+        value = current[key]
+        if key in HIGHER_IS_BETTER:
+            if value < previous * (1 - tolerance):
+                regressions.append(f"{key}: {value:.2f} < {previous:.2f}")
+        # Pomijamy bardzo krótkie czasy - szum pomiarowy jest tam większy niż sama wartość
+        elif value > previous * (1 + tolerance) and value - previous > 1.0:
+            regressions.append(f"{key}: {value:.2f} > {previous:.2f}")
+    return regressions
+
+
+def print_report(results):
+    print(f"\nZdarzeń: {results['events']}, współbieżność: {results['concurrency']}, "
+          f"błędy HTTP: {results['failures']}, niedokończone: {results['unfinished']}")
+    print(f"Przepustowość (end-to-end): {results['throughput']:.1f} zamówień/s")
+    throttled = results.get('throttled', {})
+    print(f"Odrzucone przez limit (429): Stripe {throttled.get('stripe', 0)}, "
+          f"WooCommerce {throttled.get('woocommerce', 0)}\n")
+    print(f"{'Etap':<60}{'n':>8}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    for group in ('stages', 'micro'):
+        for name, stats in results[group].items():
+            print(f"{group + ': ' + name:<60}{stats['count']:>8}{stats['p50_ms']:>10.1f}"
+                  f"{stats['p95_ms']:>10.1f}{stats['p99_ms']:>10.1f}")
+
+
+def run(args):
+    rng = random.Random(args.seed)
+    fake_stripe = FakeStripe(catalog_size=args.catalog_size, latency_ms=args.stripe_latency_ms,
+                             jitter_ms=args.jitter_ms, error_rate=args.error_rate, seed=args.seed,
+                             capacity=args.stripe_capacity)
+    fake_woo = FakeWooCommerce(catalog_size=args.catalog_size, existing_orders=args.existing_orders,
+                               latency_ms=args.woo_latency_ms, jitter_ms=args.jitter_ms,
+                               error_rate=args.error_rate, seed=args.seed, capacity=args.woo_capacity)
+    fake_stripe.start()
+    fake_woo.start()
+
+    with tempfile.TemporaryDirectory() as directory:
+        config_path = write_config(directory, args, fake_stripe.url)
+        app = setup_app(config_path, fake_woo, args.catalog_size)
+        server = make_server('127.0.0.1', 0, app, threaded=True)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        pool = app.extensions['webhook_workers']
+        pool.start()
+
+        try:
+            if args.replay_dir:
+                records = load_recorded_events(args, fake_stripe, rng)
+            else:
+                records = [as_record(make_event(i, fake_stripe, args.catalog_size, args.items_per_cart, rng))
+                           for i in range(args.events)]
+            url = f"http://127.0.0.1:{server.server_port}/webhook"
+            sent_at, ingest, failures, _ = fire(url, records, args.concurrency, args.replay_speed)
+            finished = wait_for_orders(fake_woo, list(sent_at), args.timeout)
+
+            end_to_end = [fake_woo.order_created_at[session_id] - started
+                          for session_id, started in sent_at.items() if session_id in fake_woo.order_created_at]
+            first_sent = min(sent_at.values())
+            last_created = max(fake_woo.order_created_at.values()) if fake_woo.order_created_at else first_sent
+            throughput = len(end_to_end) / (last_created - first_sent) if last_created > first_sent else 0.0
+
+            stages = {'webhook ingest (HTTP)': summarize(ingest), 'end-to-end': summarize(end_to_end)}
+            # Etapy mierzone przez samą aplikację (src.metrics); w kolumnie p50 podajemy średnią
+            for row in stage_summary():
+                stages[f"app {row['stage']}"] = {'count': row['count'], 'p50_ms': row['avg_ms'],
+                                                 'p95_ms': row['p95_ms'], 'p99_ms': row['p95_ms']}
+            for service, prefix in ((fake_stripe, 'stripe'), (fake_woo, 'woocommerce')):
+                for endpoint, timings in sorted(service.timings.items()):
+                    stages[f"{prefix} {endpoint}"] = summarize(timings)
+
+            fake_stripe.reset_stats()
+            fake_woo.reset_stats()
+            micro = micro_benchmarks(app, fake_stripe, args.catalog_size, args.items_per_cart, rng,
+                                     args.micro_iterations)
+        finally:
+            pool.stop(timeout=5)
+            server.shutdown()
+            fake_stripe.stop()
+            fake_woo.stop()
+            with app.app_context():
+                db.session.remove()
+                db.engine.dispose()
+
+    return {
+        'events': len(records),
+        'concurrency': args.concurrency,
+        'failures': failures,
+        'unfinished': 0 if finished else len(sent_at) - len(end_to_end),
+        'throttled': {'stripe': fake_stripe.throttled, 'woocommerce': fake_woo.throttled},
+        'throughput': throughput,
+        'stages': stages,
+        'micro': micro,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark obciążeniowy webhooka Stripe -> WooCommerce")
+    parser.add_argument('--events', type=int, default=200)
+    parser.add_argument('--concurrency', type=int, default=20)
+    parser.add_argument('--workers', type=int, default=8, help="Liczba workerów kolejki")
+    parser.add_argument('--mode', choices=['threads', 'asyncio'], default='threads', help="Tryb workerów kolejki")
+    parser.add_argument('--in-flight', type=int, default=50, help="Zadań naraz na worker w trybie asyncio")
+    parser.add_argument('--catalog-size', type=int, default=500)
+    parser.add_argument('--existing-orders', type=int, default=0, help="Zamówienia już obecne w WooCommerce")
+    parser.add_argument('--items-per-cart', type=int, default=3)
+    parser.add_argument('--stripe-latency-ms', type=float, default=30)
+    parser.add_argument('--woo-latency-ms', type=float, default=80)
+    parser.add_argument('--jitter-ms', type=float, default=10)
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--stripe-capacity', type=int, help="Maks. równoległych żądań do atrapy Stripe (ponad - 429)")
+    parser.add_argument('--woo-capacity', type=int, help="Maks. równoległych żądań do atrapy WooCommerce (ponad - 429)")
+    parser.add_argument('--batching', action='store_true', help="Włącz tworzenie zamówień paczkami")
+    parser.add_argument('--batch-window-ms', type=int, default=200)
+    parser.add_argument('--micro-iterations', type=int, default=50)
+    parser.add_argument('--timeout', type=float, default=120)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--replay-dir', help="Odtwórz eventy z dziennika (katalog event_log) zamiast generowanych")
+    parser.add_argument('--replay-from', help="Początek zakresu dziennika (ISO 8601, domyślnie UTC)")
+    parser.add_argument('--replay-to', help="Koniec zakresu dziennika (ISO 8601, domyślnie UTC)")
+    parser.add_argument('--replay-speed', type=float,
+                        help="Tempo względem oryginalnego (1 - oryginalne odstępy); domyślnie najszybciej")
+    parser.add_argument('--output', help="Zapisz wynik jako JSON")
+    parser.add_argument('--save-baseline', help="Zapisz wynik jako punkt odniesienia")
+    parser.add_argument('--baseline', help="Porównaj wynik z punktem odniesienia")
+    parser.add_argument('--tolerance', type=float, default=0.25)
+    parser.add_argument('--verbose', action='store_true', help="Pokaż logi aplikacji")
+    args = parser.parse_args()
+
+    if not args.verbose:
+        logging.getLogger('src').setLevel(logging.WARNING)
+
+    results = run(args)
+    print_report(results)
+
+    for path in (args.output, args.save_baseline):
+        if path:
+            with open(path, 'w') as file:
+                json.dump(results, file, indent=2)
+
+    if args.baseline:
+        with open(args.baseline, 'r') as file:
+            regressions = compare(results, json.load(file), args.tolerance)
+        if regressions:
+            print("\nRegresje wydajności:")
+            for regression in regressions:
+                print(f"  {regression}")
+            sys.exit(1)
+        print("\nBrak regresji względem punktu odniesienia.")
+
+    if results['failures'] or results['unfinished']:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
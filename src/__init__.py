@@ -1,25 +1,36 @@
-from flask import Flask, request, jsonify
-from .stripe_handler import StripeHandler
-from .woocommerce_handler import WooCommerceHandler
-from .utils import load_config
-from flask_sqlalchemy import SQLAlchemy
-from flask_login import LoginManager
+from flask import Flask, request, jsonify, Response
+from .handlers import registry, AsyncHandlerCache
+from .tenant_store import tenant_store
+from .models import DEFAULT_TENANT_ID, CheckoutLineItems
+from .job_queue import WorkerPool, AsyncWorkerPool, enqueue_event
+from .metrics import metrics, count_api_calls, WEBHOOK_STAGE_SECONDS, WEBHOOK_EVENTS
+from .webhooks import (webhook_filter, verify_signature_any, event_type as parse_event_type, event_account,
+                       event_tenant, loads)
+from .event_log import event_log
+from .logging_setup import setup_logging, correlation
 import logging
-from .extensions import db, login_manager
+from .extensions import db, login_manager, run_db
 import yaml
 
 # Inicjalizacja obiektów
 
 
-logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-def create_app():
+def create_app(start_workers=True, config_path='src/config/config.yaml', migrate=True):
+    """Tworzy aplikację.
+
+    Przy `migrate=False` (produkcyjny src.wsgi) start nie dotyka bazy danych - schemat
+    przygotowuje wcześniej `python -m src.migrate`.
+    """
     app = Flask(__name__)
     
     # Ładowanie konfiguracji bazy danych z pliku YAML
-    with open('src/config/config.yaml', 'r') as file:
+    with open(config_path, 'r') as file:
         config = yaml.safe_load(file)
+
+    # Logi formatowane i zapisywane w wątku w tle (kolejka), z identyfikatorem korelacji
+    setup_logging(config.get('logging'))
     
     # Konfiguracja aplikacji
     app.config['SQLALCHEMY_DATABASE_URI'] = config['sqlalchemy']['database_url']
@@ -29,32 +40,22 @@ def create_app():
     # Inicjalizacja bazy danych
     db.init_app(app)
     
-    with app.app_context():
-        db.create_all()
-        
-        # Inicjalizacja pustych wartości dla WooCommerce i Stripe
-        from .models import Config
-        for key in ['woocommerce_url', 'woocommerce_consumer_key', 'woocommerce_consumer_secret', 'stripe_api_key', 'stripe_webhook_secret']:
-            if not Config.get_value(key):
-                Config.set_value(key, '')
-
-        # Ładowanie konfiguracji
-        from .utils import load_config
-        config.update(load_config())
-    
-    # Inicjalizacja handlerów tylko jeśli są skonfigurowane
-    if all(config['woocommerce'].values()):
-        app.config['WOOCOMMERCE_CONFIG'] = config['woocommerce']
-        woocommerce_handler = WooCommerceHandler(config['woocommerce'])
-    else:
-        woocommerce_handler = None
+    if migrate:
+        with app.app_context():
+            # Tworzenie tabel, migracje danych i domyślne ustawienia (tryb deweloperski i narzędzia CLI)
+            from .migrate import run_migrations
+            run_migrations()
 
-    if all(config['stripe'].values()):
-        app.config['STRIPE_API_KEY'] = config['stripe']['api_key']
-        app.config['STRIPE_WEBHOOK_SECRET'] = config['stripe']['webhook_secret']
-        stripe_handler = StripeHandler(config['stripe']['api_key'], config['stripe']['webhook_secret'])
-    else:
-        stripe_handler = None
+    # Handlery WooCommerce i Stripe powstaną przy pierwszym użyciu (registry.current())
+    registry.init(config.get('http'), config.get('batching'), config.get('customers'))
+
+    from .catalog import catalog_sync
+    catalog_sync.ttl = config.get('catalog', {}).get('ttl', catalog_sync.ttl)
+
+    # Dozwolone typy eventów, limit rozmiaru i tolerancja podpisu webhooków
+    webhook_filter.configure(config.get('webhook'))
+    # Dziennik surowych webhooków do odtwarzania (python -m src.replay)
+    event_log.configure(config.get('event_log'))
 
     # Inicjalizacja login managera
     login_manager.init_app(app)
@@ -68,46 +69,136 @@ def create_app():
         from .models import User
         return User.query.get(int(user_id))
 
-    @app.route('/webhook', methods=['POST'])
-    def stripe_webhook():
-        if not stripe_handler:
-            return jsonify({'error': 'Stripe not configured'}), 500
-        logger.info("Otrzymano żądanie webhooka")
-        payload = request.data
+    def webhook_secrets(tenant_id, payload):
+        """Sekrety, którymi może być podpisany event odebrany przez adres sklepu `tenant_id`."""
+        stripe_handlers = [registry.current(tenant_id).stripe]
+        if tenant_id == DEFAULT_TENANT_ID:
+            # Eventy Stripe Connect sprawdzamy też sekretem sklepu przypisanego do konta,
+            # więc /webhook nie wymaga skonfigurowanego sklepu domyślnego
+            account_tenant_id = event_tenant(tenant_id, {'account': event_account(payload)})
+            if account_tenant_id != tenant_id:
+                stripe_handlers.append(registry.current(account_tenant_id).stripe)
+        return [handler.webhook_secret for handler in stripe_handlers if handler]
+
+    def receive_webhook(tenant_id):
+        max_bytes = webhook_filter.max_payload_bytes
+        if request.content_length is not None and request.content_length > max_bytes:
+            WEBHOOK_EVENTS.inc(type='unknown', result='too_large')
+            return jsonify({'error': 'Payload too large'}), 413
+        # Bez Content-Length (chunked) czytamy najwyżej o bajt więcej niż limit
+        payload = request.stream.read(max_bytes + 1)
+        if len(payload) > max_bytes:
+            WEBHOOK_EVENTS.inc(type='unknown', result='too_large')
+            return jsonify({'error': 'Payload too large'}), 413
         sig_header = request.headers.get('Stripe-Signature')
 
-        logger.info(f"Otrzymano payload o długości: {len(payload)} bajtów")
-        logger.info(f"Signature Header: {sig_header}")
+        logger.debug("Otrzymano żądanie webhooka, payload o długości: %d bajtów", len(payload))
 
+        secrets = webhook_secrets(tenant_id, payload)
+        if not secrets:
+            return jsonify({'error': 'Stripe not configured'}), 500
         try:
-            event = stripe_handler.construct_event(payload, sig_header)
-            logger.info(f"Poprawnie skonstruowano event typu: {event['type']}")
+            # Podpis sprawdzamy na surowych bajtach, a z treści odczytujemy tylko typ eventu
+            with WEBHOOK_STAGE_SECONDS.time(stage='verify_signature'):
+                verify_signature_any(payload, sig_header, secrets, webhook_filter.signature_tolerance)
+                event_type = parse_event_type(payload)
         except ValueError as e:
-            logger.error(f"Błąd weryfikacji webhooka: {str(e)}")
+            logger.error("Błąd weryfikacji webhooka: %s", e)
+            WEBHOOK_EVENTS.inc(type='unknown', result='invalid')
             return jsonify({'error': str(e)}), 400
 
-        if event['type'] == 'checkout.session.completed':
-            session = event['data']['object']
-            logger.info(f"Otrzymano sesję checkout o ID: {session['id']}")
-            try:
-                logger.info("Próba utworzenia zamówienia w WooCommerce")
-                line_items = stripe_handler.process_checkout_session(session)
-                new_order = woocommerce_handler.create_order(session, line_items)
-                logger.info(f"Przetworzono zamówienie: {new_order['id']}")
-                return jsonify(success=True), 200
-            except Exception as e:
-                logger.error(f"Błąd podczas przetwarzania zamówienia: {str(e)}", exc_info=True)
-                return jsonify({'error': 'Nie udało się przetworzyć zamówienia'}), 500
-        else:
-            logger.info(f"Otrzymano event innego typu niż checkout.session.completed: {event['type']}")
+        if not webhook_filter.accepts(event_type):
+            event_log.append(request.headers, payload, request.path, tenant_id, event_type)
+            logger.debug("Pominięto event typu %s", event_type)
+            WEBHOOK_EVENTS.inc(type=event_type or 'unknown', result='ignored')
+            return jsonify(success=True), 200
+
+        try:
+            with WEBHOOK_STAGE_SECONDS.time(stage='decode'):
+                event = loads(payload)
+        except ValueError as e:
+            logger.error("Nieprawidłowy JSON eventu: %s", e)
+            WEBHOOK_EVENTS.inc(type=event_type, result='invalid')
+            return jsonify({'error': 'Invalid JSON'}), 400
+
+        event_log.append(request.headers, payload, request.path, tenant_id, event_type, event.get('id'))
+        tenant_id = event_tenant(tenant_id, event)
+
+        # Przetwarzanie odbywa się w tle - zapisujemy event i od razu potwierdzamy odbiór
+        with correlation(event['data']['object']['id']):
+            with WEBHOOK_STAGE_SECONDS.time(stage='enqueue'):
+                queued = enqueue_event(event['id'], event_type, payload, tenant_id=tenant_id)
+            if queued:
+                logger.info("Zakolejkowano event %s (tenant %s)", event['id'], tenant_id)
+            else:
+                logger.info("Event %s jest już w kolejce", event['id'])
+        WEBHOOK_EVENTS.inc(type=event_type, result='queued' if queued else 'duplicate')
 
         return jsonify(success=True), 200
 
+    @app.route('/webhook', methods=['POST'])
+    def stripe_webhook():
+        return receive_webhook(DEFAULT_TENANT_ID)
+
+    @app.route('/webhook/<slug>', methods=['POST'])
+    def tenant_webhook(slug):
+        tenant = tenant_store.by_slug(slug)
+        if tenant is None:
+            return jsonify({'error': 'Unknown store'}), 404
+        return receive_webhook(tenant.id)
+
+    def process_event(event, tenant_id=DEFAULT_TENANT_ID):
+        woocommerce_handler, stripe_handler = registry.current(tenant_id)
+        if not stripe_handler or not woocommerce_handler:
+            raise Exception(f'WooCommerce lub Stripe nie jest skonfigurowany (tenant {tenant_id})')
+        session = event['data']['object']
+        logger.info("Przetwarzanie sesji checkout")
+        with count_api_calls(), WEBHOOK_STAGE_SECONDS.time(stage='process_total'):
+            with WEBHOOK_STAGE_SECONDS.time(stage='list_line_items'):
+                line_items = stripe_handler.process_checkout_session(session)
+            new_order = woocommerce_handler.create_order(session, line_items, event_id=event['id'])
+        # Zamówienie istnieje - line items sesji nie będą już potrzebne
+        CheckoutLineItems.forget(session['id'])
+        logger.info("Przetworzono zamówienie: %s", new_order['id'])
+
+    def async_processor():
+        # Wywoływane w każdej pętli asyncio - klienci httpx nie mogą przechodzić między pętlami
+        handlers = AsyncHandlerCache(registry)
+
+        async def process_event_async(event, tenant_id=DEFAULT_TENANT_ID):
+            async with handlers.use(tenant_id) as (woocommerce_handler, stripe_handler):
+                if not stripe_handler or not woocommerce_handler:
+                    raise Exception(f'WooCommerce lub Stripe nie jest skonfigurowany (tenant {tenant_id})')
+                session = event['data']['object']
+                logger.info("Przetwarzanie sesji checkout")
+                with count_api_calls(), WEBHOOK_STAGE_SECONDS.time(stage='process_total'):
+                    # Line items, klient i sprawdzenie duplikatu są pobierane równolegle
+                    new_order = await woocommerce_handler.create_order_async(
+                        session, stripe_handler.process_checkout_session_async(session), event_id=event['id'])
+            await run_db(CheckoutLineItems.forget, session['id'])
+            logger.info("Przetworzono zamówienie: %s", new_order['id'])
+
+        process_event_async.aclose = handlers.aclose
+        return process_event_async
+
+    # Synchroniczne przetwarzanie jednego eventu (np. src.replay) - niezależne od trybu kolejki
+    app.extensions['webhook_processor'] = process_event
+    queue_config = config.get('queue') or {}
+    if queue_config.get('mode') == 'asyncio':
+        app.extensions['webhook_workers'] = AsyncWorkerPool(app, async_processor, queue_config)
+    else:
+        app.extensions['webhook_workers'] = WorkerPool(app, process_event, queue_config)
+    if start_workers:
+        app.extensions['webhook_workers'].start()
+
+    @app.route('/metrics')
+    def prometheus_metrics():
+        return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
     @app.route('/')
     def home():
         return "Aplikacja działa!"
 
-    # Dodaj tę linię, aby wyświetlić wszystkie zarejestrowane trasy
-    logger.info(f"Zarejestrowane trasy: {app.url_map}")
+    logger.debug("Zarejestrowane trasy: %s", app.url_map)
 
     return app
\ No newline at end of file
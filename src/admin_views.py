@@ -1,12 +1,18 @@
-from flask import Blueprint, render_template, redirect, url_for, flash, request, current_app
+from flask import Blueprint, render_template, redirect, url_for, flash, request, current_app, Response, jsonify, session
 from flask_login import login_user, logout_user, login_required, current_user
 from .extensions import db
-from .models import User, Product
+from .models import User, Product, ProductMapping, WebhookJob, CatalogItem, search_key, DEFAULT_TENANT_ID
 from .forms import LoginForm, ProductForm
-from .woocommerce_handler import WooCommerceHandler
 from .forms import SettingsForm
 from .utils import save_config, load_config
-from .stripe_handler import StripeHandler
+from .handlers import registry, is_configured
+from .tenant_store import tenant_store
+from .product_index import product_index
+from .catalog import catalog_sync
+from .metrics import stage_summary, counters_summary
+from .pagination import keyset_page, prefix_filter
+from .mapping_io import export_mappings, import_mappings, detect_format, MappingImportError
+from sqlalchemy.orm import selectinload
 
 admin_bp = Blueprint('admin', __name__, url_prefix='/admin')
 
@@ -32,45 +38,96 @@ def logout():
     flash('You have been logged out', 'info')
     return redirect(url_for('admin.login'))
 
+def current_tenant_id():
+    """Sklep wybrany w panelu (sesja); domyślnie sklep z ustawień panelu."""
+    tenant_id = session.get('tenant_id', DEFAULT_TENANT_ID)
+    if tenant_id != DEFAULT_TENANT_ID and tenant_store.get(tenant_id) is None:
+        return DEFAULT_TENANT_ID
+    return tenant_id
+
+def tenant_config(tenant_id):
+    if tenant_id == DEFAULT_TENANT_ID:
+        return load_config()
+    return tenant_store.get(tenant_id).config
+
+@admin_bp.context_processor
+def inject_tenants():
+    if not current_user.is_authenticated:
+        return {}
+    return {'tenants': sorted(tenant_store.all(), key=lambda tenant: tenant.name),
+            'current_tenant_id': current_tenant_id()}
+
+@admin_bp.route('/tenant', methods=['POST'])
+@login_required
+def switch_tenant():
+    tenant_id = request.form.get('tenant_id', DEFAULT_TENANT_ID, type=int)
+    session['tenant_id'] = tenant_id if tenant_store.get(tenant_id) is not None else DEFAULT_TENANT_ID
+    return redirect(url_for('admin.dashboard'))
+
+PRODUCTS_PER_PAGE = 50
+
+
+def search_products(text, cursor=None, limit=PRODUCTS_PER_PAGE, tenant_id=DEFAULT_TENANT_ID):
+    """Mapowania wyszukiwane po ID WooCommerce, prefiksie ID Stripe lub początku nazwy."""
+    query = Product.query.options(selectinload(Product.mappings)).filter_by(tenant_id=tenant_id)
+    text = (text or '').strip()
+    if text.isdigit():
+        query = query.filter(Product.id.in_(
+            db.session.query(ProductMapping.product_id).filter_by(woo_product_id=int(text))))
+    elif text.startswith('prod_'):
+        query = query.filter(prefix_filter(Product.stripe_id, text))
+    elif text:
+        query = query.filter(prefix_filter(Product.search_name, search_key(text)))
+    return keyset_page(query, (Product.search_name, Product.id), cursor, limit)
+
+
 @admin_bp.route('/')
 @login_required
 def dashboard():
-    products = Product.query.all()
-    config = load_config()
-    is_configured = all(config['woocommerce'].values()) and all(config['stripe'].values())
-    return render_template('admin/dashboard.html', products=products, is_configured=is_configured)
+    search = request.args.get('q', '')
+    tenant_id = current_tenant_id()
+    products, next_cursor = search_products(search, request.args.get('after'), tenant_id=tenant_id)
+    queue_stats = WebhookJob.stats()
+    return render_template('admin/dashboard.html', products=products, search=search, next_cursor=next_cursor,
+                           is_first_page=not request.args.get('after'),
+                           is_configured=is_configured(tenant_config(tenant_id)),
+                           queue_stats=queue_stats, stage_stats=stage_summary(), counters=counters_summary())
+
+def set_picker_choices(form, tenant_id):
+    """Opcje pól wyboru to tylko aktualnie wybrane produkty - resztę podpowiada wyszukiwarka."""
+    form.woo_product_ids.choices = CatalogItem.choices(CatalogItem.SOURCE_WOO, form.woo_product_ids.data or [],
+                                                       tenant_id=tenant_id)
+    form.stripe_product_id.choices = CatalogItem.choices(
+        CatalogItem.SOURCE_STRIPE, [form.stripe_product_id.data] if form.stripe_product_id.data else [],
+        tenant_id=tenant_id)
 
 @admin_bp.route('/product/new', methods=['GET', 'POST'])
 @login_required
 def new_product():
     form = ProductForm()
-    config = load_config()
-    
-    if not all(config['woocommerce'].values()) or not all(config['stripe'].values()):
+    tenant_id = current_tenant_id()
+    woo_handler, stripe_handler = registry.current(tenant_id)
+    if not woo_handler or not stripe_handler:
         flash('WooCommerce or Stripe is not configured. Please configure them in the settings.', 'warning')
         return redirect(url_for('admin.settings'))
-
-    woo_handler = WooCommerceHandler(config['woocommerce'])
-    stripe_handler = StripeHandler(config['stripe']['api_key'], config['stripe']['webhook_secret'])
     
     try:
-        woo_products = woo_handler.get_all_products()
-        stripe_products = stripe_handler.get_all_products()
-        
-        form.woo_product_ids.choices = [(p['id'], p['name']) for p in woo_products]
-        form.stripe_product_id.choices = [(p['id'], p['name']) for p in stripe_products]
+        catalog_sync.ensure_fresh(current_app._get_current_object(), woo_handler, stripe_handler, tenant_id)
     except Exception as e:
         flash(f'Error fetching products: {str(e)}', 'error')
         return redirect(url_for('admin.dashboard'))
+    set_picker_choices(form, tenant_id)
 
     if form.validate_on_submit():
         product = Product(
+            tenant_id=tenant_id,
             stripe_id=form.stripe_product_id.data,
             name=form.name.data
         )
         product.set_woo_product_ids(form.woo_product_ids.data)
         db.session.add(product)
         db.session.commit()
+        product_index.invalidate()
         flash('Product added successfully', 'success')
         return redirect(url_for('admin.dashboard'))
     
@@ -79,48 +136,101 @@ def new_product():
 @admin_bp.route('/product/<int:id>/edit', methods=['GET', 'POST'])
 @login_required
 def edit_product(id):
-    product = Product.query.get_or_404(id)
+    tenant_id = current_tenant_id()
+    product = Product.query.filter_by(id=id, tenant_id=tenant_id).first_or_404()
     form = ProductForm(obj=product)
     
-    config = load_config()
-    if not all(config['woocommerce'].values()) or not all(config['stripe'].values()):
+    woo_handler, stripe_handler = registry.current(tenant_id)
+    if not woo_handler or not stripe_handler:
         flash('WooCommerce or Stripe is not configured. Please configure them in the settings.', 'warning')
         return redirect(url_for('admin.settings'))
-
-    woo_handler = WooCommerceHandler(config['woocommerce'])
-    stripe_handler = StripeHandler(config['stripe']['api_key'], config['stripe']['webhook_secret'])
     
     try:
-        woo_products = woo_handler.get_all_products()
-        stripe_products = stripe_handler.get_all_products()
-        
-        form.woo_product_ids.choices = [(str(p['id']), p['name']) for p in woo_products]
-        form.stripe_product_id.choices = [(p['id'], p['name']) for p in stripe_products]
+        catalog_sync.ensure_fresh(current_app._get_current_object(), woo_handler, stripe_handler, tenant_id)
     except Exception as e:
         flash(f'Error fetching products: {str(e)}', 'error')
         return redirect(url_for('admin.dashboard'))
+    if request.method == 'GET':
+        form.woo_product_ids.data = product.get_woo_product_ids()
+        form.stripe_product_id.data = product.stripe_id
+    set_picker_choices(form, tenant_id)
 
     if form.validate_on_submit():
         product.stripe_id = form.stripe_product_id.data
         product.name = form.name.data
         product.set_woo_product_ids(form.woo_product_ids.data)
         db.session.commit()
+        product_index.invalidate()
         flash('Product updated successfully', 'success')
         return redirect(url_for('admin.dashboard'))
 
-    form.woo_product_ids.data = product.get_woo_product_ids()
-    form.stripe_product_id.data = product.stripe_id
     return render_template('admin/product_form.html', form=form, title="Edit Product")
 
 @admin_bp.route('/product/<int:id>/delete', methods=['POST'])
 @login_required
 def delete_product(id):
-    product = Product.query.get_or_404(id)
+    product = Product.query.filter_by(id=id, tenant_id=current_tenant_id()).first_or_404()
     db.session.delete(product)
     db.session.commit()
+    product_index.invalidate()
     flash('Product deleted successfully', 'success')
     return redirect(url_for('admin.dashboard'))
 
+@admin_bp.route('/catalog/search')
+@login_required
+def search_catalog():
+    source = request.args.get('source')
+    if source not in (CatalogItem.SOURCE_WOO, CatalogItem.SOURCE_STRIPE):
+        return jsonify({'error': 'Unknown source'}), 400
+    items, next_cursor = CatalogItem.search(source, request.args.get('q', ''), request.args.get('after'),
+                                            min(request.args.get('limit', 20, type=int), 100),
+                                            tenant_id=current_tenant_id())
+    return jsonify({
+        'items': [{'id': item.external_id, 'name': item.name} for item in items],
+        'next': next_cursor,
+    })
+
+@admin_bp.route('/mappings/export')
+@login_required
+def export_product_mappings():
+    fmt = 'json' if request.args.get('format') == 'json' else 'csv'
+    mimetype = 'application/json' if fmt == 'json' else 'text/csv'
+    return Response(export_mappings(fmt, tenant_id=current_tenant_id()), mimetype=mimetype,
+                    headers={'Content-Disposition': f'attachment; filename=product_mappings.{fmt}'})
+
+@admin_bp.route('/mappings/import', methods=['POST'])
+@login_required
+def import_product_mappings():
+    file = request.files.get('file')
+    if not file or not file.filename:
+        flash('Choose a CSV or JSON file to import', 'error')
+        return redirect(url_for('admin.dashboard'))
+    try:
+        data = file.read().decode('utf-8-sig')
+        result = import_mappings(data, detect_format(file.filename),
+                                 replace_all=request.form.get('replace_all') == 'on',
+                                 tenant_id=current_tenant_id())
+    except (MappingImportError, ValueError) as e:
+        flash(f'Import failed, no changes were saved: {str(e)}', 'error')
+        return redirect(url_for('admin.dashboard'))
+    flash(f"Imported {result['mappings']} mappings for {result['products']} products", 'success')
+    return redirect(url_for('admin.dashboard'))
+
+@admin_bp.route('/catalog/refresh', methods=['POST'])
+@login_required
+def refresh_catalog():
+    tenant_id = current_tenant_id()
+    woo_handler, stripe_handler = registry.current(tenant_id)
+    if not woo_handler or not stripe_handler:
+        flash('WooCommerce or Stripe is not configured. Please configure them in the settings.', 'warning')
+        return redirect(url_for('admin.settings'))
+    try:
+        catalog_sync.refresh(woo_handler, stripe_handler, tenant_id=tenant_id)
+        flash('Product catalog refreshed', 'success')
+    except Exception as e:
+        flash(f'Error refreshing product catalog: {str(e)}', 'error')
+    return redirect(url_for('admin.dashboard'))
+
 @admin_bp.route('/settings', methods=['GET', 'POST'])
 @login_required
 def settings():
@@ -138,6 +248,8 @@ def settings():
             }
         }
         save_config(new_config)
+        # Nowa wersja konfiguracji - rejestr od razu podmienia handlery
+        registry.current()
         flash('Settings updated successfully', 'success')
         return redirect(url_for('admin.settings'))
     
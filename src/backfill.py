@@ -0,0 +1,193 @@
+import argparse
+import datetime
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+from . import create_app
+from .extensions import db
+from .handlers import registry
+from .tenants import resolve_tenant_id, UnknownTenantError
+from .models import SyncedSession, CheckoutLineItems
+
+
+def parse_date(value):
+    return datetime.datetime.strptime(value, '%Y-%m-%d').replace(tzinfo=datetime.timezone.utc)
+
+
+def load_checkpoint(path, created_from, created_to):
+    if os.path.exists(path):
+        with open(path, 'r') as file:
+            checkpoint = json.load(file)
+        if checkpoint['from'] == created_from and checkpoint['to'] == created_to:
+            return checkpoint
+        print(f"Checkpoint {path} dotyczy innego zakresu dat - zaczynam od początku.")
+    return {'from': created_from, 'to': created_to, 'starting_after': None,
+            'processed': 0, 'missing': 0, 'created': 0, 'failed': []}
+
+
+def save_checkpoint(path, checkpoint):
+    # Zapis atomowy - przerwanie w trakcie nie uszkodzi checkpointu
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w') as file:
+        json.dump(checkpoint, file)
+    os.replace(tmp_path, path)
+
+
+def chunks(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def find_missing(sessions):
+    ids = [session['id'] for session in sessions]
+    synced = {session_id for (session_id,) in db.session.query(SyncedSession.stripe_session_id).filter(
+        SyncedSession.stripe_session_id.in_(ids),
+        SyncedSession.status == SyncedSession.STATUS_COMPLETED,
+    )}
+    return [session for session in sessions if session['id'] not in synced]
+
+
+class StoreOrders:
+    """ID zamówień sklepu według sesji Stripe, od dnia przed początkiem zakresu (UTC).
+
+    Bez 7-dniowego limitu skanowania z create_order - sesje sprzed wprowadzenia rejestru
+    i zwolnione rezerwacje nie mają wpisu w rejestrze, a ich zamówienia mogą być dużo starsze.
+    Strony zamówień (od najnowszych) są czytane leniwie: zamówienie nie powstaje przed swoją
+    sesją, a sesje przychodzą od najnowszej, więc dla paczki sesji wystarczy czytać do dnia
+    przed najstarszą z nich. W pamięci zostają tylko pary sesja -> ID zamówienia.
+    """
+
+    def __init__(self, woocommerce_handler, created_from):
+        self.after = datetime.datetime.fromtimestamp(created_from, datetime.timezone.utc) - datetime.timedelta(days=1)
+        self._pages = woocommerce_handler.iter_order_pages(self.after)
+        self._orders = {}
+        self._read_until = None
+        self._exhausted = False
+
+    def find(self, sessions):
+        """{ID sesji: ID zamówienia} dla sesji z paczki, które mają już zamówienie w sklepie."""
+        needed = datetime.datetime.fromtimestamp(min(session['created'] for session in sessions),
+                                                 datetime.timezone.utc) - datetime.timedelta(days=1)
+        while not self._exhausted and (self._read_until is None or self._read_until >= needed):
+            orders = next(self._pages, None)
+            if orders is None:
+                self._exhausted = True
+                break
+            for order in orders:
+                for meta in order.get('meta_data', []):
+                    if meta['key'] == "stripe_session_id":
+                        self._orders[meta['value']] = order['id']
+                created = order.get('date_created_gmt')
+                if created:
+                    created = datetime.datetime.fromisoformat(created).replace(tzinfo=datetime.timezone.utc)
+                    self._read_until = min(self._read_until or created, created)
+        return {session['id']: self._orders[session['id']] for session in sessions if session['id'] in self._orders}
+
+
+def backfill(created_from, created_to, dry_run=False, concurrency=4, checkpoint_path='backfill_checkpoint.json',
+             chunk_size=100, tenant=None):
+    app = create_app(start_workers=False)
+    with app.app_context():
+        try:
+            tenant_id = resolve_tenant_id(tenant)
+        except UnknownTenantError as e:
+            print(e)
+            return
+
+    def create_missing_order(session):
+        with app.app_context():
+            try:
+                woocommerce_handler, stripe_handler = registry.current(tenant_id)
+                line_items = stripe_handler.process_checkout_session(session)
+                # Sklep został już sprawdzony (StoreOrders) - bez ponownego skanowania dla każdej sesji
+                woocommerce_handler.create_order(session, line_items, checked_store=True)
+                CheckoutLineItems.forget(session['id'])
+                return None
+            except Exception as e:
+                return str(e)
+            finally:
+                db.session.remove()
+
+    with app.app_context():
+        woocommerce_handler, stripe_handler = registry.current(tenant_id)
+        if not woocommerce_handler or not stripe_handler:
+            print("WooCommerce lub Stripe nie jest skonfigurowany.")
+            return
+
+        checkpoint = load_checkpoint(checkpoint_path, created_from, created_to)
+        if checkpoint['starting_after']:
+            print(f"Wznawianie od sesji {checkpoint['starting_after']} "
+                  f"(przetworzono już {checkpoint['processed']})")
+
+        store_orders = StoreOrders(woocommerce_handler, created_from)
+        sessions = stripe_handler.iter_checkout_sessions(created_from, created_to, checkpoint['starting_after'])
+        started = time.monotonic()
+        processed_at_start = checkpoint['processed']
+
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            for chunk in chunks(sessions, chunk_size):
+                missing = find_missing(chunk)
+                # Zamówienia istniejące w sklepie, ale nieznane rejestrowi, tylko zapisujemy w rejestrze
+                in_store = store_orders.find(missing) if missing else {}
+                missing = [session for session in missing if session['id'] not in in_store]
+                if not dry_run:
+                    for session_id, order_id in in_store.items():
+                        SyncedSession.record(session_id, order_id)
+                db.session.remove()
+
+                if dry_run:
+                    for session in missing:
+                        created = datetime.datetime.fromtimestamp(session['created'], datetime.timezone.utc)
+                        email = (session.get('customer_details') or {}).get('email')
+                        print(f"- {session['id']}  {created:%Y-%m-%d %H:%M:%S}  {email}  {session.get('amount_total')}")
+                else:
+                    for session, error in zip(missing, executor.map(create_missing_order, missing)):
+                        if error:
+                            checkpoint['failed'].append(session['id'])
+                            print(f"Błąd dla sesji {session['id']}: {error}")
+                        else:
+                            checkpoint['created'] += 1
+
+                # Checkpoint po każdej paczce - wszystkie wcześniejsze sesje są już przetworzone
+                checkpoint['processed'] += len(chunk)
+                checkpoint['missing'] += len(missing)
+                checkpoint['starting_after'] = chunk[-1]['id']
+                if not dry_run:
+                    save_checkpoint(checkpoint_path, checkpoint)
+
+                elapsed = time.monotonic() - started
+                rate = (checkpoint['processed'] - processed_at_start) / elapsed if elapsed else 0
+                print(f"Przetworzono {checkpoint['processed']} sesji, brakujących {checkpoint['missing']}, "
+                      f"utworzono {checkpoint['created']}, błędów {len(checkpoint['failed'])} "
+                      f"({rate:.1f} sesji/s)")
+
+        print("Zakończono." + (" (dry-run - nic nie zostało utworzone)" if dry_run else ""))
+        if checkpoint['failed']:
+            print(f"Sesje z błędami ({len(checkpoint['failed'])}) zostaną ponowione po usunięciu "
+                  f"pliku {checkpoint_path} i ponownym uruchomieniu.")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Odtworzenie brakujących zamówień WooCommerce na podstawie sesji Stripe")
+    parser.add_argument('--from', dest='date_from', required=True, help="Data początkowa (RRRR-MM-DD)")
+    parser.add_argument('--to', dest='date_to', required=True, help="Data końcowa (RRRR-MM-DD, włącznie)")
+    parser.add_argument('--dry-run', action='store_true', help="Tylko wypisz brakujące sesje")
+    parser.add_argument('--concurrency', type=int, default=4, help="Liczba równoległych zamówień")
+    parser.add_argument('--checkpoint', default='backfill_checkpoint.json', help="Plik checkpointu do wznawiania")
+    parser.add_argument('--tenant', help="Slug sklepu (domyślnie sklep z ustawień panelu)")
+    args = parser.parse_args()
+
+    created_from = int(parse_date(args.date_from).timestamp())
+    created_to = int((parse_date(args.date_to) + datetime.timedelta(days=1)).timestamp()) - 1
+    backfill(created_from, created_to, dry_run=args.dry_run, concurrency=args.concurrency,
+             checkpoint_path=args.checkpoint, tenant=args.tenant)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,187 @@
+import datetime
+import logging
+import threading
+import time
+from itertools import chain
+from .extensions import db
+from .models import CatalogItem, SyncState, DEFAULT_TENANT_ID
+
+logger = logging.getLogger(__name__)
+
+WOO_CURSOR = 'catalog_woo_modified_after'
+STRIPE_CURSOR = 'catalog_stripe_events_after'
+# Stripe przechowuje zdarzenia przez 30 dni - starszy kursor wymaga pełnej synchronizacji
+STRIPE_EVENTS_RETENTION = datetime.timedelta(days=29)
+# Margines na rozbieżność zegarów między nami a sklepem
+CLOCK_SKEW = datetime.timedelta(minutes=5)
+
+
+def cursor_name(name, tenant_id):
+    # Sklep domyślny zachowuje nazwy kursorów sprzed wprowadzenia tenantów
+    return name if tenant_id == DEFAULT_TENANT_ID else f"{name}:{tenant_id}"
+
+
+def _parse_woo_date(value):
+    if not value:
+        return None
+    return datetime.datetime.fromisoformat(value)
+
+
+class CatalogSync:
+    """Przyrostowa synchronizacja lokalnej kopii katalogów WooCommerce i Stripe (osobno dla każdego sklepu)."""
+
+    def __init__(self, ttl=300):
+        self.ttl = ttl
+        self._locks_guard = threading.Lock()
+        self._locks = {}
+        # Sklepy z synchronizacją w tle w toku - najwyżej jeden wątek na sklep
+        self._refreshing = set()
+
+    def _lock(self, tenant_id):
+        with self._locks_guard:
+            return self._locks.setdefault(tenant_id, threading.Lock())
+
+    def is_empty(self, tenant_id=DEFAULT_TENANT_ID):
+        return (SyncState.get(cursor_name(WOO_CURSOR, tenant_id)) is None
+                or SyncState.get(cursor_name(STRIPE_CURSOR, tenant_id)) is None)
+
+    def is_stale(self, tenant_id=DEFAULT_TENANT_ID):
+        for name in (WOO_CURSOR, STRIPE_CURSOR):
+            state = SyncState.get(cursor_name(name, tenant_id))
+            if state is None or datetime.datetime.utcnow() - state.updated_at > datetime.timedelta(seconds=self.ttl):
+                return True
+        return False
+
+    def ensure_fresh(self, app, woo_handler, stripe_handler, tenant_id=DEFAULT_TENANT_ID):
+        """Pierwsza synchronizacja odbywa się od razu, kolejne w tle po upływie TTL."""
+        if self.is_empty(tenant_id):
+            self.refresh(woo_handler, stripe_handler, tenant_id=tenant_id)
+        elif self.is_stale(tenant_id):
+            with self._locks_guard:
+                if tenant_id in self._refreshing:
+                    return
+                self._refreshing.add(tenant_id)
+            thread = threading.Thread(target=self._refresh_in_background,
+                                      args=(app, woo_handler, stripe_handler, tenant_id),
+                                      name=f'catalog-sync-{tenant_id}', daemon=True)
+            thread.start()
+
+    def _refresh_in_background(self, app, woo_handler, stripe_handler, tenant_id):
+        try:
+            with app.app_context():
+                try:
+                    self.refresh(woo_handler, stripe_handler, blocking=False, tenant_id=tenant_id)
+                except Exception as e:
+                    logger.error("Błąd synchronizacji katalogu w tle: %s", e, exc_info=True)
+                finally:
+                    db.session.remove()
+        finally:
+            with self._locks_guard:
+                self._refreshing.discard(tenant_id)
+
+    def refresh(self, woo_handler, stripe_handler, blocking=True, tenant_id=DEFAULT_TENANT_ID):
+        # Tylko jedna synchronizacja danego sklepu naraz w procesie
+        lock = self._lock(tenant_id)
+        if not lock.acquire(blocking=blocking):
+            return
+        try:
+            started = time.monotonic()
+            woo_count = self.refresh_woo(woo_handler, tenant_id)
+            stripe_count = self.refresh_stripe(stripe_handler, tenant_id)
+            logger.info("Zsynchronizowano katalog (tenant %s): %d zmian WooCommerce, %d zmian Stripe w %.2fs",
+                        tenant_id, woo_count, stripe_count, time.monotonic() - started)
+        finally:
+            lock.release()
+
+    def refresh_woo(self, woo_handler, tenant_id=DEFAULT_TENANT_ID):
+        started_at = datetime.datetime.utcnow()
+        cursor = SyncState.get(cursor_name(WOO_CURSOR, tenant_id))
+        if cursor is None:
+            pages = woo_handler.iter_product_pages(status="any")
+        else:
+            modified_after = datetime.datetime.fromisoformat(cursor.value) - CLOCK_SKEW
+            # status "any" pomija kosz, więc produkty usunięte do kosza pobieramy osobno
+            pages = chain(woo_handler.iter_product_pages(status="any", modified_after=modified_after),
+                          woo_handler.iter_product_pages(status="trash", modified_after=modified_after))
+
+        count = 0
+        for products in pages:
+            self._upsert(tenant_id, CatalogItem.SOURCE_WOO, [
+                (str(p['id']), p['name'], p.get('status') == 'publish', _parse_woo_date(p.get('date_modified_gmt')))
+                for p in products
+            ])
+            count += len(products)
+        if cursor is None:
+            count += self._purge_missing(tenant_id, CatalogItem.SOURCE_WOO, started_at)
+        SyncState.set(cursor_name(WOO_CURSOR, tenant_id), started_at.isoformat())
+        db.session.commit()
+        return count
+
+    def refresh_stripe(self, stripe_handler, tenant_id=DEFAULT_TENANT_ID):
+        started_at = datetime.datetime.utcnow()
+        cursor = SyncState.get(cursor_name(STRIPE_CURSOR, tenant_id))
+        if cursor is None or started_at - datetime.datetime.fromisoformat(cursor.value) > STRIPE_EVENTS_RETENTION:
+            rows = [(p['id'], p['name'], p['active'], datetime.datetime.utcfromtimestamp(p['updated']))
+                    for p in stripe_handler.iter_products(active=None)]
+            self._upsert(tenant_id, CatalogItem.SOURCE_STRIPE, rows)
+            # Zdarzeń product.deleted sprzed pełnej synchronizacji już nie zobaczymy
+            changes = len(rows) + self._purge_missing(tenant_id, CatalogItem.SOURCE_STRIPE, started_at)
+        else:
+            # Stripe nie filtruje listy produktów po dacie zmiany, więc korzystamy ze zdarzeń product.*
+            since = datetime.datetime.fromisoformat(cursor.value) - CLOCK_SKEW
+            events = stripe_handler.get_product_events(int(since.replace(tzinfo=datetime.timezone.utc).timestamp()))
+            deleted = [e['data']['object']['id'] for e in events if e['type'] == 'product.deleted']
+            latest = {}
+            for e in events:
+                if e['type'] != 'product.deleted':
+                    latest[e['data']['object']['id']] = e['data']['object']
+            self._upsert(tenant_id, CatalogItem.SOURCE_STRIPE, [
+                (p['id'], p['name'], p['active'], datetime.datetime.utcfromtimestamp(p['updated']))
+                for product_id, p in latest.items() if product_id not in deleted
+            ])
+            if deleted:
+                CatalogItem.query.filter(CatalogItem.tenant_id == tenant_id,
+                                         CatalogItem.source == CatalogItem.SOURCE_STRIPE,
+                                         CatalogItem.external_id.in_(deleted)).delete(synchronize_session=False)
+            changes = len(events)
+
+        SyncState.set(cursor_name(STRIPE_CURSOR, tenant_id), started_at.isoformat())
+        db.session.commit()
+        return changes
+
+    @staticmethod
+    def _purge_missing(tenant_id, source, synced_before):
+        """Po pełnej synchronizacji usuwa produkty, których nie zwróciło API (usunięte w sklepie)."""
+        deleted = CatalogItem.query.filter(CatalogItem.tenant_id == tenant_id,
+                                           CatalogItem.source == source,
+                                           CatalogItem.synced_at < synced_before).delete(synchronize_session=False)
+        if deleted:
+            logger.info("Usunięto %d produktów %s nieobecnych w sklepie (tenant %s)", deleted, source, tenant_id)
+        return deleted
+
+    @staticmethod
+    def _upsert(tenant_id, source, rows, chunk_size=500):
+        now = datetime.datetime.utcnow()
+        for start in range(0, len(rows), chunk_size):
+            CatalogSync._upsert_chunk(tenant_id, source, rows[start:start + chunk_size], now)
+
+    @staticmethod
+    def _upsert_chunk(tenant_id, source, rows, now):
+        existing = {item.external_id: item for item in CatalogItem.query.filter(
+            CatalogItem.tenant_id == tenant_id,
+            CatalogItem.source == source,
+            CatalogItem.external_id.in_([row[0] for row in rows]),
+        )}
+        for external_id, name, active, modified_at in rows:
+            item = existing.get(external_id)
+            if item is None:
+                item = CatalogItem(tenant_id=tenant_id, source=source, external_id=external_id)
+                db.session.add(item)
+                existing[external_id] = item
+            item.name = name
+            item.active = active
+            item.modified_at = modified_at
+            item.synced_at = now
+
+
+catalog_sync = CatalogSync()
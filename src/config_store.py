@@ -0,0 +1,71 @@
+import threading
+import time
+from .extensions import db
+from .models import Config, CacheVersion
+
+CONFIG_VERSION_KEY = 'config'
+
+
+class ConfigStore:
+    """Ustawienia z tabeli Config trzymane w pamięci procesu.
+
+    Wszystkie klucze są ładowane jednym zapytaniem. Zapis odbywa się w jednej transakcji
+    i podbija licznik wersji, po którym pozostałe procesy unieważniają swoją kopię.
+    Licznik sprawdzamy nie częściej niż co `check_interval` sekund.
+    """
+
+    def __init__(self, check_interval=5):
+        self.check_interval = check_interval
+        self._lock = threading.Lock()
+        self._values = None
+        self._version = None
+        self._checked_at = 0.0
+
+    def all(self):
+        return self._ensure_fresh()[0]
+
+    def get(self, key, default=None):
+        return self.all().get(key, default)
+
+    def version(self):
+        return self._ensure_fresh()[1]
+
+    def set_many(self, values):
+        rows = {row.key: row for row in Config.query.filter(Config.key.in_(list(values)))}
+        for key, value in values.items():
+            if key in rows:
+                rows[key].value = value
+            else:
+                db.session.add(Config(key=key, value=value))
+        CacheVersion.bump(CONFIG_VERSION_KEY)
+        db.session.commit()
+        self.invalidate()
+
+    def ensure_defaults(self, keys, default=''):
+        existing = {key for (key,) in db.session.query(Config.key).filter(Config.key.in_(keys))}
+        missing = [key for key in keys if key not in existing]
+        if missing:
+            self.set_many({key: default for key in missing})
+
+    def invalidate(self):
+        with self._lock:
+            self._values = None
+
+    def _ensure_fresh(self):
+        values, version = self._values, self._version
+        if values is not None and time.monotonic() - self._checked_at < self.check_interval:
+            return values, version
+
+        with self._lock:
+            now = time.monotonic()
+            if self._values is not None and now - self._checked_at < self.check_interval:
+                return self._values, self._version
+            version = CacheVersion.get_version(CONFIG_VERSION_KEY)
+            if self._values is None or version != self._version:
+                self._values = dict(db.session.query(Config.key, Config.value))
+                self._version = version
+            self._checked_at = now
+            return self._values, self._version
+
+
+config_store = ConfigStore()
@@ -3,7 +3,7 @@ from .models import User
 import getpass
 
 def create_admin():
-    app = create_app()
+    app = create_app(start_workers=False)
     with app.app_context():
         db.create_all()
         
@@ -0,0 +1,243 @@
+import atexit
+import glob
+import gzip
+import heapq
+import json
+import logging
+import os
+import queue
+import re
+import shutil
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_EVENT_LOG_CONFIG = {
+    'enabled': False,
+    'directory': 'event_log',
+    # Aktywny segment jest zamykany i kompresowany po przekroczeniu rozmiaru lub wieku
+    'segment_max_bytes': 64 * 1024 * 1024,
+    'segment_max_seconds': 3600,
+    # Skompresowane segmenty starsze niż retencja są usuwane (0 - bez limitu)
+    'retention_days': 30,
+    'queue_size': 10000,
+}
+
+# Nagłówki żądania zapisywane razem z treścią eventu (bez Stripe-Signature - replay podpisuje na nowo)
+LOGGED_HEADERS = ('Content-Type', 'User-Agent')
+
+# segment-<początek ms>-<pid>.jsonl (aktywny) i segment-<początek ms>-<koniec ms>-<pid>.jsonl.gz (zamknięty)
+_OPEN_SEGMENT = re.compile(r'segment-(\d+)-(\d+)\.jsonl$')
+_CLOSED_SEGMENT = re.compile(r'segment-(\d+)-(\d+)-(\d+)\.jsonl\.gz$')
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def compress_segment(path, end_ms=None):
+    """Kompresuje zamknięty segment (przez plik tymczasowy - czytelnik nigdy nie widzi połowy pliku)."""
+    match = _OPEN_SEGMENT.search(os.path.basename(path))
+    start_ms, pid = match.group(1), match.group(2)
+    if end_ms is None:
+        end_ms = int(os.path.getmtime(path) * 1000)
+    target = os.path.join(os.path.dirname(path), f"segment-{start_ms}-{end_ms}-{pid}.jsonl.gz")
+    with open(path, 'rb') as source, gzip.open(target + '.tmp', 'wb') as destination:
+        shutil.copyfileobj(source, destination)
+    os.replace(target + '.tmp', target)
+    os.remove(path)
+    return target
+
+
+class EventLog:
+    """Dziennik zweryfikowanych webhooków (surowa treść + nagłówki), tylko do dopisywania.
+
+    Zapis odbywa się w wątku w tle - żądanie /webhook tylko wkłada rekord do kolejki,
+    a przy przepełnieniu rekord jest porzucany zamiast blokować odpowiedź. Każdy proces
+    pisze do własnego segmentu; zamknięte segmenty są kompresowane gzipem.
+    """
+
+    def __init__(self):
+        self.config = dict(DEFAULT_EVENT_LOG_CONFIG)
+        self.dropped = 0
+        self._queue = None
+        self._thread = None
+        self._pid = None
+        self._lock = threading.Lock()
+        self._file = None
+        self._path = None
+        self._opened_at = 0.0
+
+    @property
+    def enabled(self):
+        return self.config['enabled']
+
+    def configure(self, event_log_config):
+        self.config = dict(DEFAULT_EVENT_LOG_CONFIG, **(event_log_config or {}))
+
+    def append(self, headers, body, path, tenant_id, event_type, event_id=None):
+        """Wkłada rekord do kolejki zapisu - błąd dziennika nigdy nie przerywa obsługi webhooka."""
+        if not self.enabled:
+            return
+        try:
+            self._enqueue(headers, body, path, tenant_id, event_type, event_id)
+        except Exception as e:
+            self.dropped += 1
+            logger.error("Nie udało się dopisać eventu do dziennika: %s", e, exc_info=True)
+
+    def _enqueue(self, headers, body, path, tenant_id, event_type, event_id):
+        self._ensure_writer()
+        record = {
+            'received_at': time.time(),
+            'path': path,
+            'tenant_id': tenant_id,
+            'type': event_type,
+            'event_id': event_id,
+            'headers': {name: headers[name] for name in LOGGED_HEADERS if name in headers},
+            'body': body.decode('utf-8'),
+        }
+        try:
+            self._queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def _ensure_writer(self):
+        # Wątek startuje w procesie, który pisze (np. w workerze gunicorna po fork)
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._queue = queue.Queue(maxsize=self.config['queue_size'])
+            self._file = None
+            self._thread = threading.Thread(target=self._run, name='event-log-writer', daemon=True)
+            self._thread.start()
+            self._pid = os.getpid()
+            atexit.register(self.close)
+
+    def close(self):
+        """Zapisuje oczekujące rekordy i kompresuje aktywny segment."""
+        if self._pid != os.getpid() or self._queue is None:
+            return
+        self._queue.put(None)
+        self._thread.join(timeout=10)
+
+    def _run(self):
+        # Katalog i segmenty po awarii obsługujemy tutaj, a nie w wątku żądania
+        try:
+            os.makedirs(self.config['directory'], exist_ok=True)
+            self._compress_orphans()
+        except Exception as e:
+            logger.error("Błąd przygotowania katalogu dziennika eventów: %s", e, exc_info=True)
+        while True:
+            try:
+                record = self._queue.get(timeout=1)
+            except queue.Empty:
+                try:
+                    self._rotate_if_needed()
+                except Exception as e:
+                    logger.error("Błąd rotacji dziennika eventów: %s", e, exc_info=True)
+                continue
+            records = [record]
+            # Wszystko, co czeka w kolejce, trafia do pliku jednym zapisem
+            while len(records) < 1000:
+                try:
+                    records.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            stop = None in records
+            try:
+                self._write([r for r in records if r is not None])
+                self._rotate_if_needed(force=stop)
+            except Exception as e:
+                logger.error("Błąd zapisu dziennika eventów: %s", e, exc_info=True)
+            if stop:
+                return
+
+    def _write(self, records):
+        if not records:
+            return
+        if self._file is None:
+            self._opened_at = time.time()
+            name = f"segment-{int(self._opened_at * 1000)}-{os.getpid()}.jsonl"
+            self._path = os.path.join(self.config['directory'], name)
+            self._file = open(self._path, 'ab')
+        self._file.write(b''.join(json.dumps(r, ensure_ascii=False).encode('utf-8') + b'\n' for r in records))
+        self._file.flush()
+
+    def _rotate_if_needed(self, force=False):
+        if self._file is None:
+            return
+        too_big = self._file.tell() >= self.config['segment_max_bytes']
+        too_old = time.time() - self._opened_at >= self.config['segment_max_seconds']
+        if not (force or too_big or too_old):
+            return
+        self._file.close()
+        self._file = None
+        compress_segment(self._path, int(time.time() * 1000))
+        if self.dropped:
+            logger.warning("Dziennik eventów: porzucono %d rekordów (pełna kolejka)", self.dropped)
+        self._apply_retention()
+
+    def _compress_orphans(self):
+        # Aktywne segmenty procesów, które już nie działają (np. po awarii)
+        for path in glob.glob(os.path.join(self.config['directory'], 'segment-*.jsonl')):
+            match = _OPEN_SEGMENT.search(os.path.basename(path))
+            if match and not _pid_alive(int(match.group(2))):
+                try:
+                    compress_segment(path)
+                except OSError as e:
+                    # Np. segment skompresował w tym czasie inny proces
+                    logger.warning("Nie udało się skompresować segmentu %s: %s", path, e)
+
+    def _apply_retention(self):
+        if not self.config['retention_days']:
+            return
+        cutoff_ms = (time.time() - self.config['retention_days'] * 86400) * 1000
+        for path in glob.glob(os.path.join(self.config['directory'], 'segment-*.jsonl.gz')):
+            match = _CLOSED_SEGMENT.search(os.path.basename(path))
+            if match and int(match.group(2)) < cutoff_ms:
+                os.remove(path)
+
+
+def _read_segment(path):
+    opener = gzip.open if path.endswith('.gz') else open
+    with opener(path, 'rb') as file:
+        for line in file:
+            try:
+                yield json.loads(line)
+            except ValueError:
+                # Niedokończony ostatni wiersz aktywnego segmentu
+                continue
+
+
+def read_events(directory, since=None, until=None):
+    """Rekordy z zakresu czasu (timestampy w sekundach), w kolejności odebrania."""
+    streams = []
+    for path in glob.glob(os.path.join(directory, 'segment-*.jsonl*')):
+        name = os.path.basename(path)
+        closed = _CLOSED_SEGMENT.search(name)
+        opened = _OPEN_SEGMENT.search(name)
+        if closed:
+            start, end = int(closed.group(1)) / 1000, int(closed.group(2)) / 1000
+        elif opened:
+            start, end = int(opened.group(1)) / 1000, None
+        else:
+            continue
+        if (until is not None and start > until) or (since is not None and end is not None and end < since):
+            continue
+        streams.append(record for record in _read_segment(path)
+                       if (since is None or record['received_at'] >= since)
+                       and (until is None or record['received_at'] <= until))
+    # Segmenty różnych procesów nakładają się w czasie - scalamy je po czasie odebrania
+    return heapq.merge(*streams, key=lambda record: record['received_at'])
+
+
+event_log = EventLog()
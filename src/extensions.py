@@ -1,5 +1,24 @@
+import asyncio
+from flask import current_app
 from flask_sqlalchemy import SQLAlchemy
 from flask_login import LoginManager
 
 db = SQLAlchemy()
 login_manager = LoginManager()
+
+
+async def run_db(func, *args, **kwargs):
+    """Wywołuje `func` w wątku z własnym kontekstem aplikacji (a więc i sesją bazy), poza pętlą asyncio.
+
+    Sesja jest zamykana po wywołaniu, więc `func` musi zwracać zwykłe wartości, a nie obiekty ORM.
+    """
+    app = current_app._get_current_object()
+
+    def call():
+        with app.app_context():
+            try:
+                return func(*args, **kwargs)
+            finally:
+                db.session.remove()
+
+    return await asyncio.to_thread(call)
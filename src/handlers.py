@@ -0,0 +1,195 @@
+import datetime
+import logging
+import threading
+from collections import namedtuple
+from contextlib import asynccontextmanager
+from .config_store import config_store
+from .extensions import run_db
+from .models import DEFAULT_TENANT_ID
+from .tenant_store import tenant_store
+from .utils import load_config
+
+logger = logging.getLogger(__name__)
+
+# Spójna para handlerów - webhook zawsze widzi handlery z tej samej konfiguracji
+Handlers = namedtuple('Handlers', ['woocommerce', 'stripe'])
+
+
+def is_configured(config):
+    return all(config['woocommerce'].values()) and all(config['stripe'].values())
+
+
+class HandlerRegistry:
+    """Długożyjące handlery WooCommerce i Stripe współdzielone przez cały proces.
+
+    Każdy sklep (tenant) ma własne handlery i własne sesje HTTP (pule połączeń keep-alive),
+    więc wolny sklep nie zajmuje połączeń pozostałych. Handlery są podmieniane atomowo
+    po zmianie ustawień i powstają dopiero przy pierwszym użyciu, więc start procesu
+    nie ładuje SDK Stripe/WooCommerce.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._handlers = {}
+        self._config_versions = {}
+        self._sessions = {}
+        self.http_config = None
+        self.batching_config = None
+        self.customer_ttl = None
+        self.page_workers = 4
+
+    def init(self, http_config=None, batching_config=None, customers_config=None):
+        self.http_config = http_config or {}
+        self.batching_config = batching_config
+        self.page_workers = self.http_config.get('page_workers', self.page_workers)
+        if customers_config and 'ttl' in customers_config:
+            self.customer_ttl = datetime.timedelta(seconds=customers_config['ttl'])
+
+    def _get_sessions(self, tenant_id):
+        if tenant_id not in self._sessions:
+            from .http_pool import create_session
+            self._sessions[tenant_id] = {
+                'woocommerce': create_session(self.http_config, service='woocommerce'),
+                'stripe': create_session(self.http_config, service='stripe'),
+            }
+        return self._sessions[tenant_id]
+
+    def configure(self, config, config_version=None, tenant_id=DEFAULT_TENANT_ID):
+        with self._lock:
+            self._config_versions[tenant_id] = config_version
+            sessions = self._get_sessions(tenant_id)
+            woocommerce_handler = None
+            stripe_handler = None
+            if all(config['woocommerce'].values()):
+                from .woocommerce_handler import WooCommerceHandler
+                woocommerce_handler = WooCommerceHandler(config['woocommerce'], page_workers=self.page_workers,
+                                                         session=sessions['woocommerce'],
+                                                         batching_config=self.batching_config,
+                                                         customer_ttl=self.customer_ttl,
+                                                         tenant_id=tenant_id)
+            if all(config['stripe'].values()):
+                from .stripe_handler import StripeHandler
+                stripe_handler = StripeHandler(config['stripe']['api_key'], config['stripe']['webhook_secret'],
+                                               session=sessions['stripe'],
+                                               api_base=self.http_config.get('stripe_api_base'))
+            previous = self._handlers.get(tenant_id, Handlers(None, None))
+            self._handlers[tenant_id] = Handlers(woocommerce_handler, stripe_handler)
+        if previous.woocommerce is not None:
+            # Dokończenie zamówień oczekujących w paczce starego handlera
+            previous.woocommerce.close()
+        logger.info("Zaktualizowano handlery WooCommerce i Stripe (tenant %s)", tenant_id)
+
+    def current(self, tenant_id=DEFAULT_TENANT_ID):
+        if tenant_id == DEFAULT_TENANT_ID:
+            # Ustawienia zmienione w innym procesie - przebudowujemy handlery
+            version = config_store.version()
+            if version != self._config_versions.get(tenant_id):
+                self.configure(load_config(), version)
+            return self._handlers[tenant_id]
+
+        tenant = tenant_store.get(tenant_id)
+        if tenant is None:
+            return Handlers(None, None)
+        # Wersją handlerów tenanta jest jego konfiguracja - zmiana innego sklepu ich nie przebudowuje
+        if tenant.config != self._config_versions.get(tenant_id):
+            self.configure(tenant.config, tenant.config, tenant_id=tenant_id)
+        return self._handlers[tenant_id]
+
+    @property
+    def woocommerce(self):
+        return self.current().woocommerce
+
+    @property
+    def stripe(self):
+        return self.current().stripe
+
+
+registry = HandlerRegistry()
+
+
+class AsyncHandlerCache:
+    """Asynchroniczne handlery (httpx) jednej pętli zdarzeń workera asyncio.
+
+    Klient httpx nie może przechodzić między pętlami, więc każda pętla ma własne handlery.
+    Konfigurację i jej wersję bierzemy z tych samych źródeł co HandlerRegistry. Handlery
+    podmienione po zmianie ustawień są zamykane, gdy skończy z nich korzystać ostatnie zadanie.
+    """
+
+    def __init__(self, registry):
+        self.registry = registry
+        self._handlers = {}
+        self._versions = {}
+        self._in_use = {}
+        self._retired = []
+
+    @asynccontextmanager
+    async def use(self, tenant_id=DEFAULT_TENANT_ID):
+        """Handlery sklepu na czas przetwarzania jednego eventu."""
+        handlers = await self.current(tenant_id)
+        self._in_use[handlers] = self._in_use.get(handlers, 0) + 1
+        try:
+            yield handlers
+        finally:
+            self._in_use[handlers] -= 1
+            if not self._in_use[handlers]:
+                del self._in_use[handlers]
+                if handlers in self._retired:
+                    self._retired.remove(handlers)
+                    await self._close(handlers)
+
+    async def current(self, tenant_id=DEFAULT_TENANT_ID):
+        # Odświeżenie ustawień to zapytanie do bazy - poza pętlą zdarzeń
+        settings = await run_db(self._settings, tenant_id)
+        if settings is None:
+            return Handlers(None, None)
+        config, version = settings
+        if tenant_id not in self._handlers or version != self._versions.get(tenant_id):
+            previous = self._configure(config, version, tenant_id)
+            if previous is not None:
+                if previous in self._in_use:
+                    # Zadania w toku jeszcze z nich korzystają - zamknie je ostatnie z nich (use)
+                    self._retired.append(previous)
+                else:
+                    await self._close(previous)
+        return self._handlers[tenant_id]
+
+    @staticmethod
+    def _settings(tenant_id):
+        """(konfiguracja, wersja) handlerów sklepu albo None dla nieznanego sklepu."""
+        if tenant_id == DEFAULT_TENANT_ID:
+            return load_config(), config_store.version()
+        tenant = tenant_store.get(tenant_id)
+        if tenant is None:
+            return None
+        return tenant.config, tenant.config
+
+    def _configure(self, config, version, tenant_id):
+        woocommerce_handler = None
+        stripe_handler = None
+        if all(config['woocommerce'].values()):
+            from .woocommerce_handler import AsyncWooCommerceHandler
+            woocommerce_handler = AsyncWooCommerceHandler(config['woocommerce'], self.registry.http_config,
+                                                          customer_ttl=self.registry.customer_ttl,
+                                                          tenant_id=tenant_id)
+        if all(config['stripe'].values()):
+            from .stripe_handler import AsyncStripeHandler
+            stripe_handler = AsyncStripeHandler(config['stripe']['api_key'], config['stripe']['webhook_secret'],
+                                                self.registry.http_config,
+                                                api_base=self.registry.http_config.get('stripe_api_base'))
+        previous = self._handlers.get(tenant_id)
+        self._handlers[tenant_id] = Handlers(woocommerce_handler, stripe_handler)
+        self._versions[tenant_id] = version
+        logger.info("Zaktualizowano asynchroniczne handlery WooCommerce i Stripe (tenant %s)", tenant_id)
+        return previous
+
+    @staticmethod
+    async def _close(handlers):
+        for handler in handlers:
+            if handler is not None:
+                await handler.aclose()
+
+    async def aclose(self):
+        for handlers in self._retired + list(self._handlers.values()):
+            await self._close(handlers)
+        self._handlers.clear()
+        self._retired = []
@@ -0,0 +1,346 @@
+import asyncio
+import email.utils
+import hashlib
+import logging
+import random
+import threading
+import time
+import uuid
+from urllib.parse import urlparse
+import httpx
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import NewConnectionError
+from .metrics import response_hook, httpx_hooks, OUTBOUND_RETRIES
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_HTTP_CONFIG = {
+    'pool_connections': 10,
+    'pool_maxsize': 20,
+    'connect_timeout': 5,
+    'read_timeout': 30,
+    # Ponowienia żądań idempotentnych (GET/PUT/DELETE, POST z kluczem idempotencji) i odrzuconych przez 429
+    'retries': 3,
+    'backoff_seconds': 0.5,
+    'max_backoff_seconds': 10,
+    # Dłuższy Retry-After nie blokuje wątku - odpowiedź wraca do wywołującego (np. ponowienie z kolejki)
+    'max_retry_after': 30,
+    'limits': {},
+}
+
+# Limity per host (Stripe: per konto): `rate`/`burst` - kubełek tokenów (żądania/s), `max_concurrency` - górny limit
+# równoległych żądań, obniżany po 429/503 i stopniowo podnoszony po udanych odpowiedziach
+DEFAULT_SERVICE_LIMITS = {
+    # Stripe: 100 żądań/s w trybie live (25/s w testowym) - resztę ustali adaptacyjny limit
+    'stripe': {'rate': 90, 'burst': 100, 'max_concurrency': 32, 'min_concurrency': 1},
+    # WooCommerce nie ma wbudowanego limitu - przepustowość zależy od hostingu
+    'woocommerce': {'rate': None, 'burst': None, 'max_concurrency': 16, 'min_concurrency': 1},
+}
+
+# Nagłówek klucza idempotencji dodawany do żądań POST (Stripe gwarantuje jednokrotne wykonanie)
+IDEMPOTENCY_HEADERS = {'stripe': 'Idempotency-Key'}
+
+IDEMPOTENT_METHODS = frozenset(['GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE'])
+THROTTLE_STATUSES = frozenset([429, 503])
+RETRY_STATUSES = frozenset([429, 500, 502, 503, 504])
+
+
+class TokenBucket:
+    """Limit liczby żądań na sekundę (bez limitu przy `rate=None`).
+
+    `pause` wstrzymuje wydawanie tokenów wszystkim wątkom, np. na czas z nagłówka Retry-After.
+    Ten sam kubełek obsługuje wątki (`acquire`) i pętle asyncio (`acquire_async`).
+    """
+
+    def __init__(self, rate=None, burst=None):
+        self.rate = rate
+        self.capacity = burst or rate or 0
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = threading.Lock()
+
+    def _take(self):
+        """Pobiera token - zwraca 0 albo czas do następnej próby."""
+        with self._lock:
+            now = time.monotonic()
+            if now < self._paused_until:
+                return self._paused_until - now
+            if self.rate is None:
+                return 0
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return 0
+            return (1 - self._tokens) / self.rate
+
+    def acquire(self):
+        while True:
+            wait = self._take()
+            if not wait:
+                return
+            time.sleep(wait)
+
+    async def acquire_async(self):
+        while True:
+            wait = self._take()
+            if not wait:
+                return
+            await asyncio.sleep(wait)
+
+    def pause(self, seconds):
+        with self._lock:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+
+class AdaptiveLimiter:
+    """Limit równoległych żądań dostosowywany do backendu (AIMD).
+
+    Po odpowiedzi 429/503 limit spada o połowę (najwyżej raz na `decrease_interval` sekund,
+    żeby seria odrzuconych równoległych żądań nie zbiła go do minimum), po każdej udanej
+    odpowiedzi rośnie o 1/limit, czyli o około 1 na pełną "rundę" żądań.
+    """
+
+    def __init__(self, maximum, minimum=1, decrease_interval=1.0):
+        self.maximum = maximum
+        self.minimum = minimum
+        self.limit = float(maximum)
+        self.decrease_interval = decrease_interval
+        self._in_flight = 0
+        self._decreased_at = 0.0
+        self._condition = threading.Condition()
+        # Oczekujący z pętli asyncio (pętla, future) - budzeni przy każdym zwolnieniu miejsca
+        self._async_waiters = []
+
+    def acquire(self):
+        with self._condition:
+            while self._in_flight >= int(self.limit):
+                self._condition.wait()
+            self._in_flight += 1
+
+    async def acquire_async(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            with self._condition:
+                if self._in_flight < int(self.limit):
+                    self._in_flight += 1
+                    return
+                waiter = loop.create_future()
+                self._async_waiters.append((loop, waiter))
+            await waiter
+
+    def release(self, throttled=False):
+        with self._condition:
+            self._in_flight -= 1
+            now = time.monotonic()
+            if throttled:
+                if now - self._decreased_at >= self.decrease_interval:
+                    self.limit = max(self.minimum, self.limit / 2)
+                    self._decreased_at = now
+                    logger.warning("Backend przeciążony - limit równoległych żądań obniżony do %d",
+                                   int(self.limit))
+            else:
+                self.limit = min(self.maximum, self.limit + 1 / self.limit)
+            self._condition.notify_all()
+            waiters, self._async_waiters = self._async_waiters, []
+        for loop, waiter in waiters:
+            try:
+                loop.call_soon_threadsafe(_wake, waiter)
+            except RuntimeError:
+                # Pętla już zamknięta - nikt nie czeka
+                pass
+
+
+def _wake(waiter):
+    if not waiter.done():
+        waiter.set_result(None)
+
+
+class HostLimits:
+    """Kubełek tokenów i limit równoległości jednego hosta, wspólne dla wątków i pętli asyncio."""
+
+    def __init__(self, limits):
+        self.bucket = TokenBucket(limits.get('rate'), limits.get('burst'))
+        self.limiter = AdaptiveLimiter(limits['max_concurrency'], limits.get('min_concurrency') or 1)
+
+
+_host_limits = {}
+_host_limits_lock = threading.Lock()
+
+
+def host_limits(key, limits):
+    """Limity wspólne dla wszystkich sesji procesu o tym samym kluczu (host albo host i konto Stripe)."""
+    with _host_limits_lock:
+        if key not in _host_limits:
+            _host_limits[key] = HostLimits(limits)
+        return _host_limits[key]
+
+
+def service_limits(service, http_config):
+    return dict(DEFAULT_SERVICE_LIMITS.get(service, DEFAULT_SERVICE_LIMITS['woocommerce']),
+                **http_config['limits'].get(service, {}))
+
+
+def limits_key(service, request):
+    # Żądanie requests albo httpx
+    host = urlparse(str(request.url)).netloc
+    if service != 'stripe':
+        return host
+    # Stripe limituje każde konto osobno - 429 jednego sklepu nie może wstrzymywać pozostałych.
+    # Konto to konto połączone (Stripe-Account) albo klucz API; klucz trzymamy tylko jako skrót
+    account = request.headers.get('Stripe-Account') or request.headers.get('Authorization', '')
+    return host, hashlib.sha256(account.encode('utf-8')).hexdigest()[:16]
+
+
+def was_not_sent(error):
+    """Czy błąd wystąpił przed wysłaniem żądania (odmowa lub timeout połączenia)."""
+    if isinstance(error, requests.exceptions.ConnectTimeout):
+        return True
+    reason = getattr(error.args[0], 'reason', None) if error.args else None
+    return isinstance(reason, NewConnectionError)
+
+
+def parse_retry_after(value):
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        parsed = email.utils.parsedate_to_datetime(value)
+        return max(0.0, parsed.timestamp() - time.time()) if parsed else None
+
+
+class ThrottledAdapter(HTTPAdapter):
+    """Adapter HTTP z limitami per host, adaptacyjnym limitem równoległości i ponowieniami z jitterem."""
+
+    def __init__(self, service, http_config, **kwargs):
+        self.service = service
+        self.http_config = http_config
+        self.limits = service_limits(service, http_config)
+        self.idempotency_header = IDEMPOTENCY_HEADERS.get(service)
+        super().__init__(**kwargs)
+
+    def send(self, request, **kwargs):
+        if kwargs.get('timeout') is None:
+            kwargs['timeout'] = (self.http_config['connect_timeout'], self.http_config['read_timeout'])
+        if self.idempotency_header and request.method == 'POST' and self.idempotency_header not in request.headers:
+            # Ten sam klucz we wszystkich próbach - ponowiony zapis nie zostanie wykonany drugi raz
+            request.headers[self.idempotency_header] = str(uuid.uuid4())
+        retryable = request.method in IDEMPOTENT_METHODS or (
+            self.idempotency_header is not None and self.idempotency_header in request.headers)
+        limits = host_limits(limits_key(self.service, request), self.limits)
+
+        attempt = 0
+        while True:
+            limits.bucket.acquire()
+            limits.limiter.acquire()
+            try:
+                response = super().send(request, **kwargs)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                limits.limiter.release()
+                # Bez połączenia żądanie na pewno nie dotarło - takie można ponowić zawsze
+                if attempt >= self.http_config['retries'] or not (retryable or was_not_sent(e)):
+                    raise
+                reason = 'timeout' if isinstance(e, requests.exceptions.Timeout) else 'connection'
+                delay = self._backoff(attempt)
+            except Exception:
+                limits.limiter.release()
+                raise
+            else:
+                throttled = response.status_code in THROTTLE_STATUSES
+                limits.limiter.release(throttled)
+                retry_after = parse_retry_after(response.headers.get('Retry-After'))
+                if throttled:
+                    limits.bucket.pause(min(retry_after or self._backoff(attempt),
+                                            self.http_config['max_retry_after']))
+                if not self._should_retry(response, retryable, attempt, retry_after):
+                    return response
+                reason = str(response.status_code)
+                delay = max(retry_after or 0, self._backoff(attempt))
+                response.close()
+            OUTBOUND_RETRIES.inc(service=self.service, reason=reason)
+            logger.info("Ponowienie %s %s za %.2fs (%s, próba %d)", request.method, request.path_url.split('?', 1)[0],
+                        delay, reason, attempt + 1)
+            time.sleep(delay)
+            attempt += 1
+
+    def _should_retry(self, response, retryable, attempt, retry_after):
+        if response.status_code not in RETRY_STATUSES or attempt >= self.http_config['retries']:
+            return False
+        if retry_after is not None and retry_after > self.http_config['max_retry_after']:
+            return False
+        should_retry = response.headers.get('Stripe-Should-Retry')
+        if should_retry is not None:
+            return should_retry == 'true'
+        # 429 oznacza odrzucenie przed wykonaniem, więc ponawiamy również nieidempotentne żądania
+        return retryable or response.status_code == 429
+
+    def _backoff(self, attempt):
+        # "Full jitter" - równoległe ponowienia nie uderzają w backend jednocześnie
+        cap = min(self.http_config['max_backoff_seconds'], self.http_config['backoff_seconds'] * 2 ** attempt)
+        return random.uniform(0, cap)
+
+
+def create_session(http_config=None, service=None):
+    """Sesja HTTP z pulą połączeń keep-alive współdzieloną przez wątki."""
+    http_config = dict(DEFAULT_HTTP_CONFIG, **(http_config or {}))
+    session = requests.Session()
+    adapter = ThrottledAdapter(service, http_config, pool_connections=http_config['pool_connections'],
+                               pool_maxsize=http_config['pool_maxsize'])
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    if service:
+        # Liczniki i czasy wychodzących żądań per endpoint
+        session.hooks['response'].append(response_hook(service))
+    return session
+
+
+class ThrottledAsyncTransport(httpx.AsyncBaseTransport):
+    """Transport httpx (worker asyncio) z tymi samymi limitami per host co ThrottledAdapter.
+
+    Kubełek tokenów i adaptacyjny limit są wspólne z sesjami requests procesu, więc 429
+    w jednej ścieżce spowalnia obie. Ponowienia zostają po stronie wywołującego (SDK Stripe,
+    `AsyncWooCommerceHandler._get`).
+    """
+
+    def __init__(self, service, http_config, transport):
+        self.service = service
+        self.http_config = http_config
+        self.limits = service_limits(service, http_config)
+        self.transport = transport
+
+    async def handle_async_request(self, request):
+        limits = host_limits(limits_key(self.service, request), self.limits)
+        await limits.bucket.acquire_async()
+        await limits.limiter.acquire_async()
+        try:
+            response = await self.transport.handle_async_request(request)
+        except BaseException:
+            limits.limiter.release()
+            raise
+        throttled = response.status_code in THROTTLE_STATUSES
+        limits.limiter.release(throttled)
+        if throttled:
+            retry_after = parse_retry_after(response.headers.get('Retry-After'))
+            limits.bucket.pause(min(retry_after or self.http_config['backoff_seconds'],
+                                    self.http_config['max_retry_after']))
+        return response
+
+    async def aclose(self):
+        await self.transport.aclose()
+
+
+def create_async_client(http_config=None, service=None, verify=True):
+    """Klient httpx z pulą połączeń keep-alive - jeden na pętlę zdarzeń workera asyncio."""
+    http_config = dict(DEFAULT_HTTP_CONFIG, **(http_config or {}))
+    # Przy własnym transporcie httpx pomija `verify` i `limits` klienta - ustawiamy je w transporcie
+    transport = httpx.AsyncHTTPTransport(
+        verify=verify, limits=httpx.Limits(max_keepalive_connections=http_config['pool_maxsize']))
+    return httpx.AsyncClient(
+        timeout=httpx.Timeout(http_config['read_timeout'], connect=http_config['connect_timeout']),
+        transport=ThrottledAsyncTransport(service, http_config, transport),
+        # Liczniki i czasy wychodzących żądań jak w sesjach requests (response_hook)
+        event_hooks=httpx_hooks(service),
+    )
@@ -0,0 +1,407 @@
+import asyncio
+import datetime
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from sqlalchemy import or_
+from sqlalchemy.exc import IntegrityError
+from .extensions import db, run_db
+from .models import WebhookJob, DEFAULT_TENANT_ID
+from .tenant_store import tenant_store
+from .metrics import WEBHOOK_JOBS
+from .logging_setup import correlation
+from .webhooks import loads
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_QUEUE_CONFIG = {
+    'workers': 2,
+    'max_attempts': 5,
+    'backoff_seconds': 5,
+    'max_backoff_seconds': 900,
+    'poll_interval': 1,
+    'visibility_timeout': 300,
+    # Limit równoległych zadań jednego sklepu (na proces); przy wielu sklepach domyślnie o jedno
+    # mniej, niż proces obsługuje naraz (workers, a w trybie asyncio workers * in_flight)
+    'tenant_concurrency': None,
+    # 'threads' - jedno zadanie na wątek, 'asyncio' - każdy wątek obsługuje do `in_flight` zadań naraz
+    'mode': 'threads',
+    'in_flight': 50,
+    # Wątki na zapytania do bazy w każdej pętli trybu asyncio (każdy zajmuje na czas zapytania
+    # jedno połączenie z puli SQLAlchemy)
+    'db_threads': 4,
+    # Zakończone zadania są usuwane po tylu dniach (0 - nigdy). Wpis chroni też przed ponownym
+    # przetworzeniem eventu dostarczonego przez Stripe jeszcze raz (Stripe ponawia do 3 dni)
+    'done_retention_days': 7,
+}
+
+# Co ile sekund worker sprawdza, czy są zakończone zadania do usunięcia
+PURGE_INTERVAL = 3600
+
+
+class JobDeferred(Exception):
+    """Zadania nie można teraz przetworzyć (np. zasób trzyma inny proces) - ponowienie nie zużywa próby.
+
+    `retry_after` to liczba sekund, po której ponowienie ma szansę się udać.
+    """
+
+    def __init__(self, message, retry_after=None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+def enqueue_event(event_id, event_type, payload, tenant_id=DEFAULT_TENANT_ID):
+    """Zapisuje event w kolejce. Zwraca False, jeśli event był już zakolejkowany (retry Stripe)."""
+    if isinstance(payload, bytes):
+        payload = payload.decode('utf-8')
+    try:
+        db.session.add(WebhookJob(tenant_id=tenant_id, event_id=event_id, event_type=event_type, payload=payload))
+        db.session.commit()
+        return True
+    except IntegrityError:
+        db.session.rollback()
+        return False
+
+
+def claim_next_job(visibility_timeout, exclude_tenants=(), max_attempts=None):
+    """Atomowo rezerwuje kolejne zadanie gotowe do przetworzenia.
+
+    Zadania w statusie 'processing', których blokada wygasła (np. worker padł),
+    wracają do puli - dostarczanie jest więc co najmniej jednokrotne. Takie zadanie, które
+    wykorzystało już `max_attempts` prób (np. za każdym razem zabija workera), trafia do
+    dead-letter. Zadania sklepów z `exclude_tenants` (wyczerpany limit równoległości) są pomijane.
+    """
+    now = datetime.datetime.utcnow()
+    expired = now - datetime.timedelta(seconds=visibility_timeout)
+    abandoned = (WebhookJob.status == WebhookJob.STATUS_PROCESSING) & (WebhookJob.locked_at < expired)
+    query = WebhookJob.query.with_entities(WebhookJob.id, WebhookJob.status, WebhookJob.attempts).filter(or_(
+        (WebhookJob.status == WebhookJob.STATUS_QUEUED) & (WebhookJob.next_attempt_at <= now),
+        abandoned,
+    ))
+    if exclude_tenants:
+        query = query.filter(WebhookJob.tenant_id.notin_(list(exclude_tenants)))
+    candidates = query.order_by(WebhookJob.next_attempt_at).limit(5).all()
+
+    for job_id, status, attempts in candidates:
+        if max_attempts and status == WebhookJob.STATUS_PROCESSING and attempts >= max_attempts:
+            dead = WebhookJob.query.filter(WebhookJob.id == job_id, abandoned).update({
+                'status': WebhookJob.STATUS_DEAD,
+                'locked_at': None,
+                'last_error': f"Przetwarzanie przerwane (wygasła blokada) w ostatniej z {attempts} prób",
+            }, synchronize_session=False)
+            db.session.commit()
+            if dead == 1:
+                WEBHOOK_JOBS.inc(result='dead')
+                logger.error("Zadanie %s przeniesione do dead-letter: worker nie ukończył żadnej z %d prób",
+                             job_id, attempts)
+            continue
+        updated = WebhookJob.query.filter(
+            WebhookJob.id == job_id,
+            or_(WebhookJob.status == WebhookJob.STATUS_QUEUED, abandoned),
+        ).update({
+            'status': WebhookJob.STATUS_PROCESSING,
+            'locked_at': now,
+            'attempts': WebhookJob.attempts + 1,
+        }, synchronize_session=False)
+        db.session.commit()
+        if updated == 1:
+            return db.session.get(WebhookJob, job_id)
+    return None
+
+
+def decode_job(payload):
+    """Event zadania i ID sesji Stripe (identyfikator korelacji logów)."""
+    event = loads(payload)
+    return event, event['data']['object'].get('id')
+
+
+def complete_job(job):
+    WEBHOOK_JOBS.inc(result='done')
+    job.status = WebhookJob.STATUS_DONE
+    job.locked_at = None
+    job.last_error = None
+    db.session.commit()
+
+
+def fail_job(job, error, queue_config):
+    job.last_error = str(error)
+    job.locked_at = None
+    if isinstance(error, JobDeferred):
+        # Oczekiwanie na inny proces nie jest błędem zadania - nie zużywa próby, a ponowienie
+        # następuje dopiero wtedy, gdy blokada może zostać przejęta
+        job.attempts -= 1
+        delay = max(error.retry_after or 0, queue_config['backoff_seconds'])
+        job.status = WebhookJob.STATUS_QUEUED
+        WEBHOOK_JOBS.inc(result='deferred')
+        job.next_attempt_at = datetime.datetime.utcnow() + datetime.timedelta(seconds=delay)
+        logger.info("Zadanie %s odłożone o %ds: %s", job.event_id, delay, error)
+    elif job.attempts >= queue_config['max_attempts']:
+        job.status = WebhookJob.STATUS_DEAD
+        WEBHOOK_JOBS.inc(result='dead')
+        logger.error("Zadanie %s przeniesione do dead-letter po %d próbach: %s", job.event_id, job.attempts, error)
+    else:
+        delay = min(queue_config['backoff_seconds'] * 2 ** (job.attempts - 1),
+                    queue_config['max_backoff_seconds'])
+        job.status = WebhookJob.STATUS_QUEUED
+        WEBHOOK_JOBS.inc(result='retry')
+        job.next_attempt_at = datetime.datetime.utcnow() + datetime.timedelta(seconds=delay)
+        logger.warning("Zadanie %s nie powiodło się (próba %d), ponowienie za %ss: %s",
+                       job.event_id, job.attempts, delay, error)
+    db.session.commit()
+
+
+def purge_done_jobs(retention_days, batch_size=1000):
+    """Usuwa zakończone zadania starsze niż `retention_days` (w paczkach - krótkie transakcje)."""
+    cutoff = datetime.datetime.utcnow() - datetime.timedelta(days=retention_days)
+    deleted = 0
+    while True:
+        ids = [job_id for (job_id,) in WebhookJob.query.with_entities(WebhookJob.id).filter(
+            WebhookJob.status == WebhookJob.STATUS_DONE, WebhookJob.created_at < cutoff).limit(batch_size)]
+        if not ids:
+            return deleted
+        WebhookJob.query.filter(WebhookJob.id.in_(ids)).delete(synchronize_session=False)
+        db.session.commit()
+        deleted += len(ids)
+
+
+class WorkerPool:
+    """Pula wątków przetwarzających zadania z kolejki webhooków.
+
+    Każdy sklep (tenant) może zajmować jednocześnie co najwyżej tyle wątków, ile wynosi jego
+    limit, więc wolny sklep nie blokuje przetwarzania zamówień pozostałych.
+    """
+
+    def __init__(self, app, processor, queue_config=None):
+        self.app = app
+        self.processor = processor
+        self.config = dict(DEFAULT_QUEUE_CONFIG, **(queue_config or {}))
+        self._stop = threading.Event()
+        self._threads = []
+        self._claim_lock = threading.Lock()
+        self._in_flight = {}
+        self._purged_at = None
+        self._start_lock = threading.Lock()
+        self._started_pid = None
+
+    def start(self):
+        self._started_pid = os.getpid()
+        for i in range(self.config['workers']):
+            thread = threading.Thread(target=self._run, name=f"webhook-worker-{i}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        logger.info("Uruchomiono %d workerów kolejki webhooków", len(self._threads))
+
+    def ensure_started(self):
+        """Uruchamia workery przy pierwszym żądaniu w procesie (np. w workerze gunicorna po fork)."""
+        if self._started_pid == os.getpid():
+            return
+        with self._start_lock:
+            if self._started_pid != os.getpid():
+                # Wątki rodzica nie przeżywają fork - w nowym procesie zaczynamy od zera
+                self._threads = []
+                self.start()
+
+    def stop(self, timeout=None):
+        self._stop.set()
+        for thread in self._threads:
+            thread.join(timeout)
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                with self.app.app_context():
+                    processed = self.run_once()
+            except Exception as e:
+                logger.error("Błąd workera kolejki: %s", e, exc_info=True)
+                processed = False
+            self.purge_if_due()
+            if not processed:
+                self._stop.wait(self.config['poll_interval'])
+
+    def purge_due(self):
+        return bool(self.config['done_retention_days']) and (
+            self._purged_at is None or time.monotonic() - self._purged_at >= PURGE_INTERVAL)
+
+    def purge_if_due(self):
+        """Usuwa stare zakończone zadania - najwyżej raz na PURGE_INTERVAL w procesie."""
+        retention_days = self.config['done_retention_days']
+        with self._claim_lock:
+            if not self.purge_due():
+                return
+            self._purged_at = time.monotonic()
+        try:
+            with self.app.app_context():
+                try:
+                    deleted = purge_done_jobs(retention_days)
+                finally:
+                    db.session.remove()
+        except Exception as e:
+            logger.error("Błąd usuwania zakończonych zadań kolejki: %s", e, exc_info=True)
+            return
+        if deleted:
+            logger.info("Usunięto %d zakończonych zadań kolejki starszych niż %d dni", deleted, retention_days)
+
+    def tenant_limit(self, tenant_id):
+        tenant = tenant_store.get(tenant_id) if tenant_id != DEFAULT_TENANT_ID else None
+        if tenant is not None and tenant.max_concurrency:
+            return tenant.max_concurrency
+        if self.config['tenant_concurrency']:
+            return self.config['tenant_concurrency']
+        if not tenant_store.all():
+            # Jeden sklep - nie ma kogo chronić
+            return None
+        return max(1, self.capacity() - 1)
+
+    def capacity(self):
+        """Ile zadań proces przetwarza jednocześnie."""
+        return self.config['workers']
+
+    def _claim(self):
+        with self._claim_lock:
+            exclude = []
+            for tenant_id, count in self._in_flight.items():
+                limit = self.tenant_limit(tenant_id)
+                if limit is not None and count >= limit:
+                    exclude.append(tenant_id)
+            job = claim_next_job(self.config['visibility_timeout'], exclude, self.config['max_attempts'])
+            if job is not None:
+                self._in_flight[job.tenant_id] = self._in_flight.get(job.tenant_id, 0) + 1
+            return job
+
+    def _release(self, tenant_id):
+        with self._claim_lock:
+            self._in_flight[tenant_id] -= 1
+
+    def run_once(self):
+        try:
+            job = self._claim()
+            if job is None:
+                return False
+            tenant_id = job.tenant_id
+            try:
+                event, session_id, error = None, None, None
+                try:
+                    event, session_id = decode_job(job.payload)
+                except Exception as e:
+                    # Uszkodzona treść - ponowienia i dead-letter jak przy każdym innym błędzie
+                    error = e
+                # Wszystkie logi przetwarzania (również ponowień) oznaczone ID sesji Stripe
+                with correlation(session_id):
+                    if error is None:
+                        try:
+                            self.processor(event, tenant_id)
+                        except Exception as e:
+                            db.session.rollback()
+                            error = e
+                    if error is None:
+                        complete_job(job)
+                    else:
+                        fail_job(job, error, self.config)
+            finally:
+                self._release(tenant_id)
+            return True
+        finally:
+            db.session.remove()
+
+
+class AsyncWorkerPool(WorkerPool):
+    """Pula workerów, z których każdy obsługuje wiele zadań naraz w pętli asyncio.
+
+    `processor_factory` tworzy w każdej pętli korutynę `processor(event, tenant_id)` (z własnymi
+    klientami HTTP) z metodą `aclose`. Limity równoległości sklepów działają jak w WorkerPool.
+    Zapytania do bazy są synchroniczne, więc wykonuje je `db_threads` wątków pętli (run_db).
+    """
+
+    def __init__(self, app, processor_factory, queue_config=None):
+        super().__init__(app, None, queue_config)
+        self.processor_factory = processor_factory
+
+    def capacity(self):
+        return self.config['workers'] * self.config['in_flight']
+
+    def _run(self):
+        asyncio.run(self._run_async())
+
+    async def _run_async(self):
+        asyncio.get_running_loop().set_default_executor(
+            ThreadPoolExecutor(self.config['db_threads'], thread_name_prefix=f"{threading.current_thread().name}-db"))
+        processor = self.processor_factory()
+        tasks = set()
+        try:
+            while not self._stop.is_set():
+                if self.purge_due():
+                    await asyncio.to_thread(self.purge_if_due)
+                if len(tasks) >= self.config['in_flight']:
+                    await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+                    continue
+                job = await asyncio.to_thread(self._claim_detached)
+                if job is not None:
+                    task = asyncio.create_task(self._process(processor, *job))
+                    tasks.add(task)
+                    task.add_done_callback(tasks.discard)
+                elif tasks:
+                    await asyncio.wait(tasks, timeout=self.config['poll_interval'],
+                                       return_when=asyncio.FIRST_COMPLETED)
+                else:
+                    await asyncio.sleep(self.config['poll_interval'])
+            if tasks:
+                await asyncio.wait(tasks)
+        finally:
+            await processor.aclose()
+
+    def _claim_detached(self):
+        # Zadanie przetwarzają inne sesje (wywołania run_db), więc zwracamy tylko jego dane
+        try:
+            with self.app.app_context():
+                try:
+                    job = self._claim()
+                    return (job.id, job.tenant_id, job.payload) if job is not None else None
+                finally:
+                    db.session.remove()
+        except Exception as e:
+            logger.error("Błąd workera kolejki: %s", e, exc_info=True)
+            return None
+
+    async def _process(self, processor, job_id, tenant_id, payload):
+        try:
+            # Kontekst aplikacji dla run_db - sesję bazy ma dopiero każde wywołanie w wątku
+            with self.app.app_context():
+                event, session_id, error = None, None, None
+                try:
+                    event, session_id = decode_job(payload)
+                except Exception as e:
+                    error = e
+                with correlation(session_id):
+                    if error is None:
+                        try:
+                            await processor(event, tenant_id)
+                        except Exception as e:
+                            error = e
+                    await self._finish_async(job_id, error)
+        finally:
+            self._release(tenant_id)
+
+    async def _finish_async(self, job_id, error):
+        try:
+            await run_db(self._finish, job_id, error)
+            return
+        except Exception as e:
+            if error is not None:
+                # Zadanie wróci po visibility_timeout (z limitem prób - zob. claim_next_job)
+                logger.error("Nie udało się zapisać błędu zadania %s: %s", job_id, e, exc_info=True)
+                return
+            error = e
+        # Zamówienie powstało, ale nie udało się oznaczyć zadania - ponowienie rozpozna je w rejestrze
+        try:
+            await run_db(self._finish, job_id, error)
+        except Exception as e:
+            logger.error("Nie udało się zapisać błędu zadania %s: %s", job_id, e, exc_info=True)
+
+    def _finish(self, job_id, error=None):
+        job = db.session.get(WebhookJob, job_id)
+        if error is None:
+            complete_job(job)
+        else:
+            fail_job(job, error, self.config)
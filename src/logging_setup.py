@@ -0,0 +1,181 @@
+import atexit
+import copy
+import contextvars
+import datetime
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import threading
+import random
+import re
+from contextlib import contextmanager
+
+DEFAULT_LOGGING_CONFIG = {
+    'level': 'INFO',
+    'format': 'json',
+    'debug_sample_rate': 0.1,
+    'queue_size': 10000,
+}
+
+# Identyfikator korelacji - ID sesji Stripe, której dotyczy bieżące przetwarzanie
+correlation_id = contextvars.ContextVar('correlation_id', default=None)
+
+SECRET_PATTERNS = [
+    (re.compile(r'\b(sk|rk)_(live|test)_[A-Za-z0-9]+'), r'\1_\2_***'),
+    (re.compile(r'\bwhsec_[A-Za-z0-9]+'), 'whsec_***'),
+    (re.compile(r'\b(ck|cs)_[0-9a-f]{20,}'), r'\1_***'),
+    (re.compile(r"""(['"]?(?:consumer_key|consumer_secret|api_key|webhook_secret|password|secret_key)['"]?\s*[:=]\s*)(['"]?)[^'",\s}]+"""),
+     r'\1\2***'),
+    (re.compile(r'(v1=)[0-9a-f]+'), r'\1***'),
+]
+
+
+def redact(text):
+    for pattern, replacement in SECRET_PATTERNS:
+        text = pattern.sub(replacement, text)
+    return text
+
+
+@contextmanager
+def correlation(value):
+    token = correlation_id.set(value)
+    try:
+        yield
+    finally:
+        correlation_id.reset(token)
+
+
+class CorrelationFilter(logging.Filter):
+    """Dołącza identyfikator korelacji - musi działać w wątku, który loguje."""
+
+    def filter(self, record):
+        record.correlation_id = correlation_id.get()
+        return True
+
+
+class SamplingFilter(logging.Filter):
+    """Przepuszcza tylko część rekordów DEBUG, pozostałe poziomy zawsze."""
+
+    def __init__(self, debug_sample_rate):
+        super().__init__()
+        self.debug_sample_rate = debug_sample_rate
+
+    def filter(self, record):
+        if record.levelno > logging.DEBUG:
+            return True
+        return random.random() < self.debug_sample_rate
+
+
+class StructuredFormatter(logging.Formatter):
+    """Formatowanie (i redakcja sekretów) odbywa się dopiero w wątku zapisującym logi."""
+
+    def __init__(self, as_json=True):
+        super().__init__()
+        self.as_json = as_json
+
+    def format(self, record):
+        message = redact(record.getMessage())
+        # Rekord z kolejki ma traceback już w postaci tekstu (NonBlockingQueueHandler.prepare)
+        exc_text = self.formatException(record.exc_info) if record.exc_info else record.exc_text
+        if exc_text:
+            message = f"{message}\n{redact(exc_text)}"
+        correlation = getattr(record, 'correlation_id', None)
+        if not self.as_json:
+            prefix = f"[{correlation}] " if correlation else ""
+            return f"{record.levelname}:{record.name}:{prefix}{message}"
+        entry = {
+            'ts': datetime.datetime.fromtimestamp(record.created, datetime.timezone.utc).isoformat(),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': message,
+        }
+        if correlation:
+            entry['correlation_id'] = correlation
+        return json.dumps(entry, ensure_ascii=False)
+
+
+class NonBlockingQueueHandler(logging.handlers.QueueHandler):
+    """Przekazuje rekordy do wątku w tle, a przy przepełnieniu kolejki porzuca je zamiast blokować.
+
+    W wątku wywołującym powstaje tylko tekst komunikatu (`msg % args`) i tracebacku -
+    argumenty (słowniki, obiekty ORM) mogą się zmienić albo odłączyć od sesji, zanim wątek
+    zapisujący je sformatuje. Formatowanie wpisu i redakcja sekretów odbywają się w tle,
+    a rekordy odrzucone przez filtry (np. próbkowanie DEBUG) nie są formatowane wcale.
+    """
+
+    dropped = 0
+    _exception_formatter = logging.Formatter()
+
+    def prepare(self, record):
+        record = copy.copy(record)
+        record.msg = record.message = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = self._exception_formatter.formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        _ensure_listener(self)
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            NonBlockingQueueHandler.dropped += 1
+
+
+_listener = None
+_listener_pid = None
+_listener_lock = threading.Lock()
+
+
+def _ensure_listener(queue_handler):
+    """Uruchamia wątek zapisujący logi w bieżącym procesie.
+
+    Po fork (np. `gunicorn --preload`) wątek został w procesie nadrzędnym - bez tego
+    kolejka procesu potomnego nie byłaby opróżniana, a logi po jej zapełnieniu ginęłyby.
+    """
+    global _listener, _listener_pid
+    if _listener_pid == os.getpid():
+        return
+    with _listener_lock:
+        if _listener_pid == os.getpid():
+            return
+        handlers = _listener.handlers
+        # Kolejka odziedziczona po procesie nadrzędnym mogła zostać skopiowana w trakcie zapisu
+        queue_handler.queue = queue.Queue(maxsize=queue_handler.queue.maxsize)
+        _listener = logging.handlers.QueueListener(queue_handler.queue, *handlers)
+        _listener.start()
+        _listener_pid = os.getpid()
+
+
+def _stop_listener():
+    if _listener is not None and _listener_pid == os.getpid():
+        _listener.stop()
+
+
+def setup_logging(logging_config=None):
+    global _listener, _listener_pid
+    logging_config = dict(DEFAULT_LOGGING_CONFIG, **(logging_config or {}))
+    if _listener is not None:
+        return
+
+    log_queue = queue.Queue(maxsize=logging_config['queue_size'])
+    queue_handler = NonBlockingQueueHandler(log_queue)
+    queue_handler.addFilter(CorrelationFilter())
+    queue_handler.addFilter(SamplingFilter(logging_config['debug_sample_rate']))
+
+    stream_handler = logging.StreamHandler()
+    stream_handler.setFormatter(StructuredFormatter(as_json=logging_config['format'] == 'json'))
+
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(queue_handler)
+    root.setLevel(logging_config['level'])
+
+    _listener = logging.handlers.QueueListener(log_queue, stream_handler)
+    _listener.start()
+    _listener_pid = os.getpid()
+    atexit.register(_stop_listener)
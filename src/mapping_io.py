@@ -0,0 +1,198 @@
+import argparse
+import csv
+import io
+import json
+import sys
+from itertools import islice
+from .extensions import db
+from .models import Product, ProductMapping, CatalogItem, search_key, DEFAULT_TENANT_ID
+from .product_index import product_index
+
+FIELDS = ['stripe_product_id', 'name', 'woo_product_id', 'quantity', 'price_share']
+
+
+class MappingImportError(ValueError):
+    pass
+
+
+def export_rows(tenant_id=DEFAULT_TENANT_ID):
+    rows = db.session.query(Product.stripe_id, Product.name, ProductMapping.woo_product_id,
+                            ProductMapping.quantity, ProductMapping.price_share) \
+        .outerjoin(ProductMapping, ProductMapping.product_id == Product.id) \
+        .filter(Product.tenant_id == tenant_id) \
+        .order_by(Product.stripe_id, ProductMapping.id)
+    for stripe_id, name, woo_product_id, quantity, price_share in rows:
+        yield {'stripe_product_id': stripe_id, 'name': name, 'woo_product_id': woo_product_id,
+               'quantity': quantity, 'price_share': price_share}
+
+
+def export_mappings(fmt='csv', tenant_id=DEFAULT_TENANT_ID):
+    rows = export_rows(tenant_id)
+    if fmt == 'json':
+        return json.dumps(list(rows), ensure_ascii=False, indent=2)
+    output = io.StringIO()
+    writer = csv.DictWriter(output, fieldnames=FIELDS)
+    writer.writeheader()
+    writer.writerows(rows)
+    return output.getvalue()
+
+
+def parse_rows(data, fmt='csv'):
+    if fmt == 'json':
+        rows = json.loads(data)
+        if not isinstance(rows, list):
+            raise MappingImportError("Plik JSON musi zawierać listę mapowań")
+        return rows
+    return list(csv.DictReader(io.StringIO(data)))
+
+
+def _optional(value, convert, line, field):
+    if value is None or value == '':
+        return None
+    try:
+        return convert(value)
+    except (TypeError, ValueError):
+        raise MappingImportError(f"Wiersz {line}: niepoprawna wartość {field}: {value!r}")
+
+
+def group_rows(rows):
+    """Waliduje wiersze i grupuje je po produkcie Stripe: {stripe_id: (name, [mapowania])}."""
+    products = {}
+    for line, row in enumerate(rows, start=1):
+        stripe_id = (row.get('stripe_product_id') or '').strip()
+        if not stripe_id:
+            raise MappingImportError(f"Wiersz {line}: brak stripe_product_id")
+        name, mappings = products.setdefault(stripe_id, [None, {}])
+        products[stripe_id][0] = (row.get('name') or '').strip() or name
+        woo_product_id = _optional(row.get('woo_product_id'), int, line, 'woo_product_id')
+        if woo_product_id is None:
+            continue
+        quantity = _optional(row.get('quantity'), int, line, 'quantity') or 1
+        price_share = _optional(row.get('price_share'), float, line, 'price_share')
+        if quantity < 1:
+            raise MappingImportError(f"Wiersz {line}: quantity musi być dodatnie")
+        if price_share is not None and not 0 <= price_share <= 1:
+            raise MappingImportError(f"Wiersz {line}: price_share musi być z zakresu 0-1")
+        mappings[woo_product_id] = {'woo_product_id': woo_product_id, 'quantity': quantity,
+                                    'price_share': price_share}
+
+    for stripe_id, (name, mappings) in products.items():
+        shares = sum(mapping['price_share'] or 0 for mapping in mappings.values())
+        if shares > 1 + 1e-9:
+            raise MappingImportError(f"Produkt {stripe_id}: suma price_share przekracza 1")
+    return products
+
+
+def chunks(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def import_mappings(data, fmt='csv', replace_all=False, chunk_size=500, tenant_id=DEFAULT_TENANT_ID):
+    """Wczytuje mapowania sklepu `tenant_id` w jednej transakcji.
+
+    Mapowania produktów występujących w pliku są zastępowane w całości, pozostałe
+    zostają bez zmian (chyba że `replace_all` - wtedy są usuwane).
+    """
+    products = group_rows(parse_rows(data, fmt))
+    try:
+        existing = dict(db.session.query(Product.stripe_id, Product.id).filter_by(tenant_id=tenant_id))
+        catalog_names = dict(db.session.query(CatalogItem.external_id, CatalogItem.name)
+                             .filter_by(tenant_id=tenant_id, source=CatalogItem.SOURCE_STRIPE))
+
+        new_products = [{'tenant_id': tenant_id, 'stripe_id': stripe_id,
+                         'name': name or catalog_names.get(stripe_id, stripe_id)}
+                        for stripe_id, (name, _) in products.items() if stripe_id not in existing]
+        for product in new_products:
+            product['search_name'] = search_key(product['name'])
+        renamed = [{'id': existing[stripe_id], 'name': name, 'search_name': search_key(name)}
+                   for stripe_id, (name, _) in products.items() if name and stripe_id in existing]
+        if new_products:
+            db.session.execute(db.insert(Product), new_products)
+            existing = dict(db.session.query(Product.stripe_id, Product.id).filter_by(tenant_id=tenant_id))
+        if renamed:
+            db.session.execute(db.update(Product), renamed)
+
+        deleted = 0
+        if replace_all:
+            keep = {existing[stripe_id] for stripe_id in products}
+            removed = [id for stripe_id, id in existing.items() if id not in keep]
+            for chunk in chunks(removed, chunk_size):
+                deleted += ProductMapping.query.filter(ProductMapping.product_id.in_(chunk)) \
+                    .delete(synchronize_session=False)
+                Product.query.filter(Product.id.in_(chunk)).delete(synchronize_session=False)
+        for chunk in chunks([existing[stripe_id] for stripe_id in products], chunk_size):
+            deleted += ProductMapping.query.filter(ProductMapping.product_id.in_(chunk)) \
+                .delete(synchronize_session=False)
+
+        rows = [dict(mapping, product_id=existing[stripe_id])
+                for stripe_id, (_, mappings) in products.items() for mapping in mappings.values()]
+        if rows:
+            db.session.execute(db.insert(ProductMapping), rows)
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    product_index.invalidate()
+    return {'products': len(products), 'created_products': len(new_products), 'mappings': len(rows),
+            'replaced_mappings': deleted}
+
+
+def detect_format(filename, default='csv'):
+    if filename and filename.lower().endswith('.json'):
+        return 'json'
+    if filename and filename.lower().endswith('.csv'):
+        return 'csv'
+    return default
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Import i eksport mapowań produktów Stripe -> WooCommerce")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    export_parser = subparsers.add_parser('export')
+    export_parser.add_argument('file', nargs='?', help="Plik docelowy (domyślnie standardowe wyjście)")
+    export_parser.add_argument('--format', choices=['csv', 'json'])
+    import_parser = subparsers.add_parser('import')
+    import_parser.add_argument('file')
+    import_parser.add_argument('--format', choices=['csv', 'json'])
+    import_parser.add_argument('--replace-all', action='store_true',
+                               help="Usuń produkty, których nie ma w pliku")
+    for subparser in (export_parser, import_parser):
+        subparser.add_argument('--tenant', help="Slug sklepu (domyślnie sklep z ustawień panelu)")
+    args = parser.parse_args()
+
+    from . import create_app
+    from .tenants import resolve_tenant_id, UnknownTenantError
+    app = create_app(start_workers=False)
+    with app.app_context():
+        try:
+            tenant_id = resolve_tenant_id(args.tenant)
+        except UnknownTenantError as e:
+            print(e)
+            sys.exit(1)
+        fmt = args.format or detect_format(args.file)
+        if args.command == 'export':
+            data = export_mappings(fmt, tenant_id=tenant_id)
+            if args.file:
+                with open(args.file, 'w', encoding='utf-8', newline='') as file:
+                    file.write(data)
+            else:
+                sys.stdout.write(data)
+            return
+        with open(args.file, 'r', encoding='utf-8-sig', newline='') as file:
+            data = file.read()
+        try:
+            result = import_mappings(data, fmt, replace_all=args.replace_all, tenant_id=tenant_id)
+        except (MappingImportError, json.JSONDecodeError) as e:
+            print(f"Import przerwany, nic nie zostało zapisane: {e}")
+            sys.exit(1)
+        print(f"Zaimportowano {result['mappings']} mapowań dla {result['products']} produktów "
+              f"(nowych produktów: {result['created_products']}, zastąpionych mapowań: {result['replaced_mappings']}).")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,232 @@
+import contextvars
+import re
+import threading
+import time
+from contextlib import contextmanager
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+
+def _label_key(labelnames, labels):
+    return tuple(str(labels.get(name, '')) for name in labelnames)
+
+
+def _format_labels(labelnames, key, extra=None):
+    pairs = [f'{name}="{value}"' for name, value in zip(labelnames, key)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+class Counter:
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def inc(self, amount=1, **labels):
+        key = _label_key(self.labelnames, labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            return dict(self._values)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        for key, value in sorted(self.samples().items()):
+            lines.append(f"{self.name}{_format_labels(self.labelnames, key)} {value}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def observe(self, value, **labels):
+        key = _label_key(self.labelnames, labels)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = {'counts': [0] * len(self.buckets), 'sum': 0.0, 'count': 0}
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state['counts'][index] += 1
+                    break
+            state['sum'] += value
+            state['count'] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def samples(self):
+        with self._lock:
+            return {key: {'counts': list(state['counts']), 'sum': state['sum'], 'count': state['count']}
+                    for key, state in self._values.items()}
+
+    def quantile(self, state, q):
+        """Przybliżony kwantyl - górna granica kubełka, w którym się mieści."""
+        target = q * state['count']
+        cumulative = 0
+        for bound, count in zip(self.buckets, state['counts']):
+            cumulative += count
+            if cumulative >= target:
+                return bound
+        return float('inf')
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        for key, state in sorted(self.samples().items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets, state['counts']):
+                cumulative += count
+                labels = _format_labels(self.labelnames, key, 'le="%s"' % bound)
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = _format_labels(self.labelnames, key, 'le="+Inf"')
+            lines.append(f"{self.name}_bucket{labels} {state['count']}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labelnames, key)} {state['sum']}")
+            lines.append(f"{self.name}_count{_format_labels(self.labelnames, key)} {state['count']}")
+        return lines
+
+
+class MetricsRegistry:
+    """Liczniki i histogramy procesu w formacie Prometheus."""
+
+    def __init__(self):
+        self._metrics = []
+
+    def counter(self, name, documentation, labelnames=()):
+        metric = Counter(name, documentation, labelnames)
+        self._metrics.append(metric)
+        return metric
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        metric = Histogram(name, documentation, labelnames, buckets)
+        self._metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+metrics = MetricsRegistry()
+
+WEBHOOK_STAGE_SECONDS = metrics.histogram(
+    'stripewoo_webhook_stage_seconds', 'Czas trwania etapów przetwarzania webhooka', ['stage'])
+WEBHOOK_EVENTS = metrics.counter(
+    'stripewoo_webhook_events_total', 'Odebrane webhooki według typu i wyniku', ['type', 'result'])
+WEBHOOK_JOBS = metrics.counter(
+    'stripewoo_webhook_jobs_total', 'Przetworzone zadania kolejki według wyniku (done/retry/dead)', ['result'])
+API_CALLS_PER_WEBHOOK = metrics.histogram(
+    'stripewoo_api_calls_per_webhook', 'Liczba wywołań API na jeden przetworzony webhook', (),
+    buckets=(1, 2, 3, 4, 5, 6, 8, 10, 15, 20, 50))
+OUTBOUND_REQUESTS = metrics.counter(
+    'stripewoo_outbound_requests_total', 'Wychodzące żądania HTTP według usługi, endpointu i statusu',
+    ['service', 'method', 'endpoint', 'status'])
+OUTBOUND_SECONDS = metrics.histogram(
+    'stripewoo_outbound_request_seconds', 'Czas wychodzących żądań HTTP', ['service', 'endpoint'])
+OUTBOUND_RETRIES = metrics.counter(
+    'stripewoo_outbound_retries_total', 'Ponowione wychodzące żądania HTTP według usługi i przyczyny',
+    ['service', 'reason'])
+
+# Licznik w zmiennej kontekstu, a nie wątku - worker asyncio przetwarza wiele webhooków w jednym
+# wątku, a zadania uruchomione w trakcie webhooka (i run_db) dziedziczą jego licznik
+_calls = contextvars.ContextVar('api_calls', default=None)
+
+
+@contextmanager
+def count_api_calls():
+    """Zlicza wychodzące żądania HTTP wykonane w bieżącym kontekście (np. na jeden webhook)."""
+    counter = [0]
+    token = _calls.set(counter)
+    try:
+        yield
+    finally:
+        _calls.reset(token)
+        API_CALLS_PER_WEBHOOK.observe(counter[0])
+
+
+def _count_call():
+    counter = _calls.get()
+    if counter is not None:
+        counter[0] += 1
+
+
+# Całe segmenty ścieżki będące identyfikatorami: ID Stripe (prefiks z podkreśleniem i losowa część
+# z cyfrą lub wielką literą, np. cs_test_a1B2c3) i liczby. Stałe segmenty z małych liter
+# i podkreśleń (line_items, payment_intents) zostają - etykieta to endpoint, nie obiekt
+_STRIPE_ID_SEGMENT = re.compile(r'/(?:[a-z]+_)+(?=[a-z]*[A-Z0-9])[A-Za-z0-9]+(?=/|$)')
+_NUMERIC_SEGMENT = re.compile(r'/\d+(?=/|$)')
+
+
+def normalize_endpoint(path):
+    path = path.split('/wp-json/wc/v3/', 1)[-1]
+    path = _STRIPE_ID_SEGMENT.sub('/{id}', path)
+    return _NUMERIC_SEGMENT.sub('/{id}', path)
+
+
+def response_hook(service):
+    def hook(response, *args, **kwargs):
+        request = response.request
+        endpoint = normalize_endpoint(request.path_url.split('?', 1)[0])
+        OUTBOUND_REQUESTS.inc(service=service, method=request.method, endpoint=endpoint,
+                              status=response.status_code)
+        OUTBOUND_SECONDS.observe(response.elapsed.total_seconds(), service=service, endpoint=endpoint)
+        _count_call()
+    return hook
+
+
+def httpx_hooks(service):
+    """Hooki klienta httpx (worker asyncio) - te same liczniki co `response_hook`."""
+    async def on_request(request):
+        request.extensions['started_at'] = time.perf_counter()
+
+    async def on_response(response):
+        request = response.request
+        endpoint = normalize_endpoint(request.url.path)
+        OUTBOUND_REQUESTS.inc(service=service, method=request.method, endpoint=endpoint,
+                              status=response.status_code)
+        started_at = request.extensions.get('started_at')
+        if started_at is not None:
+            OUTBOUND_SECONDS.observe(time.perf_counter() - started_at, service=service, endpoint=endpoint)
+        _count_call()
+    return {'request': [on_request], 'response': [on_response]}
+
+
+def stage_summary():
+    """Zestawienie etapów webhooka dla panelu administratora."""
+    rows = []
+    for (stage,), state in sorted(WEBHOOK_STAGE_SECONDS.samples().items()):
+        rows.append({
+            'stage': stage,
+            'count': state['count'],
+            'avg_ms': state['sum'] / state['count'] * 1000 if state['count'] else 0,
+            'p95_ms': WEBHOOK_STAGE_SECONDS.quantile(state, 0.95) * 1000,
+        })
+    return rows
+
+
+def counters_summary():
+    summary = {'jobs': {}, 'outbound': {}}
+    for (result,), value in WEBHOOK_JOBS.samples().items():
+        summary['jobs'][result] = value
+    for (service, method, endpoint, status), value in OUTBOUND_REQUESTS.samples().items():
+        key = f"{service} {method} {endpoint}"
+        summary['outbound'][key] = summary['outbound'].get(key, 0) + value
+    return summary
@@ -0,0 +1,141 @@
+import logging
+import os
+from .extensions import db
+from .models import Product, ProductMapping, CatalogItem, CustomerIndex, search_key
+
+logger = logging.getLogger(__name__)
+
+
+# Tabele, w których tenant_id wchodzi do unikalnych ograniczeń - wymagają przebudowy, nie ALTER
+TENANT_SCOPED_MODELS = (Product, CatalogItem, CustomerIndex)
+
+
+def add_missing_columns():
+    """Dodaje do istniejących tabel nowe kolumny (NULL-owalne lub z `server_default` - create_all tego nie robi)."""
+    inspector = db.inspect(db.engine)
+    added = []
+    for table in db.metadata.sorted_tables:
+        if not inspector.has_table(table.name):
+            continue
+        existing = {column['name'] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name in existing or (not column.nullable and column.server_default is None):
+                continue
+            column_type = column.type.compile(db.engine.dialect)
+            definition = f'{column.name} {column_type}'
+            if column.server_default is not None:
+                definition += f" NOT NULL DEFAULT '{column.server_default.arg}'"
+            db.session.execute(db.text(f'ALTER TABLE {table.name} ADD COLUMN {definition}'))
+            added.append(f"{table.name}.{column.name}")
+    db.session.commit()
+    if added:
+        logger.info("Dodano kolumny: %s", ', '.join(added))
+    return added
+
+
+def rebuild_tenant_tables():
+    """Przebudowuje tabele sprzed wprowadzenia tenantów (nowe unikalne ograniczenia z tenant_id).
+
+    SQLite nie pozwala zmienić ograniczeń tabeli, więc tworzymy ją od nowa i kopiujemy
+    wiersze - dotychczasowe dane trafiają do sklepu domyślnego (tenant_id = 0).
+    """
+    inspector = db.inspect(db.engine)
+    rebuilt = []
+    for model in TENANT_SCOPED_MODELS:
+        table = model.__table__
+        if not inspector.has_table(table.name):
+            continue
+        existing = [column['name'] for column in inspector.get_columns(table.name)]
+        if 'tenant_id' in existing:
+            continue
+        if db.engine.dialect.name != 'sqlite':
+            raise RuntimeError(f"Tabela {table.name} wymaga ręcznej migracji: dodaj kolumnę tenant_id "
+                               f"i rozszerz o nią unikalne ograniczenia")
+        columns = ', '.join(name for name in existing if name in table.columns)
+        indexes = [index['name'] for index in inspector.get_indexes(table.name)]
+        old_name = f'{table.name}_old'
+        # Bez trybu legacy SQLite przepiąłby klucze obce innych tabel (product_mapping) na tabelę *_old
+        db.session.execute(db.text('PRAGMA legacy_alter_table=ON'))
+        db.session.execute(db.text(f'ALTER TABLE {table.name} RENAME TO {old_name}'))
+        # Indeksy przechodzą razem z tabelą - zwalniamy nazwy dla indeksów nowej tabeli
+        for index in indexes:
+            db.session.execute(db.text(f'DROP INDEX {index}'))
+        table.create(db.session.connection())
+        db.session.execute(db.text(f'INSERT INTO {table.name} ({columns}) SELECT {columns} FROM {old_name}'))
+        db.session.execute(db.text(f'DROP TABLE {old_name}'))
+        db.session.execute(db.text('PRAGMA legacy_alter_table=OFF'))
+        rebuilt.append(table.name)
+    db.session.commit()
+    if rebuilt:
+        logger.info("Przebudowano tabele dla wielu sklepów: %s", ', '.join(rebuilt))
+    return rebuilt
+
+
+def create_missing_indexes():
+    for table in db.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(db.engine, checkfirst=True)
+
+
+def fill_search_names(chunk_size=1000):
+    """Uzupełnia `search_name` w wierszach zapisanych przed dodaniem kolumny."""
+    count = 0
+    for model in (Product, CatalogItem):
+        while True:
+            rows = db.session.query(model.id, model.name).filter(model.search_name.is_(None)).limit(chunk_size).all()
+            if not rows:
+                break
+            db.session.execute(db.update(model), [{'id': id, 'search_name': search_key(name)} for id, name in rows])
+            db.session.commit()
+            count += len(rows)
+    return count
+
+
+def migrate_product_mappings():
+    """Przenosi listy `Product.woo_product_ids` (po przecinku) do tabeli ProductMapping.
+
+    Migracja jest idempotentna - po przeniesieniu kolumna jest czyszczona, więc kolejne
+    uruchomienia nie mają nic do zrobienia.
+    """
+    products = Product.query.filter(Product.woo_product_ids.isnot(None), Product.woo_product_ids != '').all()
+    if not products:
+        return 0
+
+    rows = []
+    for product in products:
+        existing = {mapping.woo_product_id for mapping in product.mappings}
+        for id in dict.fromkeys(int(id) for id in product.woo_product_ids.split(',') if id.strip()):
+            if id not in existing:
+                rows.append({'product_id': product.id, 'woo_product_id': id, 'quantity': 1})
+        product.woo_product_ids = None
+    if rows:
+        db.session.execute(db.insert(ProductMapping), rows)
+    db.session.commit()
+    logger.info("Przeniesiono %d mapowań z %d produktów do tabeli product_mapping", len(rows), len(products))
+    return len(rows)
+
+
+def run_migrations():
+    db.create_all()
+    rebuild_tenant_tables()
+    add_missing_columns()
+    create_missing_indexes()
+    fill_search_names()
+    migrate_product_mappings()
+
+    # Puste wartości ustawień WooCommerce i Stripe (jeden commit)
+    from .config_store import config_store
+    from .utils import CONFIG_KEYS
+    config_store.ensure_defaults(CONFIG_KEYS)
+
+
+def migrate(config_path='src/config/config.yaml'):
+    from . import create_app
+    app = create_app(start_workers=False, config_path=config_path, migrate=False)
+    with app.app_context():
+        run_migrations()
+    print("Schemat bazy danych jest aktualny.")
+
+
+if __name__ == '__main__':
+    migrate(os.environ.get('STRIPEWOO_CONFIG', 'src/config/config.yaml'))
@@ -1,6 +1,19 @@
 from .extensions import db
 from werkzeug.security import generate_password_hash, check_password_hash
 from flask_login import UserMixin
+from sqlalchemy.exc import IntegrityError
+from .pagination import keyset_page, prefix_filter
+import datetime
+
+
+# Sklep skonfigurowany w ustawieniach panelu (tabela Config) - dane bez przypisanego tenanta
+DEFAULT_TENANT_ID = 0
+
+
+def search_key(text):
+    """Postać nazwy używana w indeksie wyszukiwania (wielkość liter nie ma znaczenia)."""
+    return (text or '').strip().casefold()
+
 
 class User(UserMixin, db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -13,17 +26,83 @@ class User(UserMixin, db.Model):
     def check_password(self, password):
         return check_password_hash(self.password_hash, password)
 
+class Tenant(db.Model):
+    """Sklep obsługiwany przez tę samą instancję aplikacji: własne klucze, mapowania i limity."""
+    id = db.Column(db.Integer, primary_key=True)
+    slug = db.Column(db.String(64), unique=True, nullable=False)
+    name = db.Column(db.String(128), nullable=False)
+    active = db.Column(db.Boolean, nullable=False, default=True)
+    # Konto Stripe (Connect) - eventy z tym `account` na wspólnym /webhook trafiają do tego tenanta
+    stripe_account_id = db.Column(db.String(64), unique=True)
+    stripe_api_key = db.Column(db.String(256), nullable=False)
+    stripe_webhook_secret = db.Column(db.String(256))
+    woocommerce_url = db.Column(db.String(256), nullable=False)
+    woocommerce_consumer_key = db.Column(db.String(256), nullable=False)
+    woocommerce_consumer_secret = db.Column(db.String(256), nullable=False)
+    # Maksymalna liczba jednocześnie przetwarzanych webhooków tego sklepu (na proces)
+    max_concurrency = db.Column(db.Integer)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.datetime.utcnow)
+
+    def handler_config(self):
+        """Konfiguracja w formacie `load_config()`."""
+        return {
+            'woocommerce': {
+                'url': self.woocommerce_url,
+                'consumer_key': self.woocommerce_consumer_key,
+                'consumer_secret': self.woocommerce_consumer_secret,
+            },
+            'stripe': {
+                'api_key': self.stripe_api_key,
+                'webhook_secret': self.stripe_webhook_secret or '',
+            }
+        }
+
 class Product(db.Model):
+    __table_args__ = (
+        db.UniqueConstraint('tenant_id', 'stripe_id'),
+        db.Index('ix_product_tenant_search_name', 'tenant_id', 'search_name'),
+    )
+
     id = db.Column(db.Integer, primary_key=True)
-    stripe_id = db.Column(db.String(64), unique=True, nullable=False)
+    tenant_id = db.Column(db.Integer, nullable=False, default=DEFAULT_TENANT_ID, server_default='0')
+    stripe_id = db.Column(db.String(64), nullable=False)
     name = db.Column(db.String(128), nullable=False)
+    search_name = db.Column(db.String(128))
+    # Przestarzała kolumna (lista ID po przecinku) - czytana tylko przez migrację do ProductMapping
     woo_product_ids = db.Column(db.String(256))
+    # Skrót nazwy, ceny i statusu z WooCommerce wysłanych ostatnio do Stripe (src.product_sync)
+    sync_hash = db.Column(db.String(64))
+    mappings = db.relationship('ProductMapping', backref='product', cascade='all, delete-orphan',
+                               order_by='ProductMapping.id')
+
+    @db.validates('name')
+    def _update_search_name(self, key, name):
+        self.search_name = search_key(name)
+        return name
 
     def set_woo_product_ids(self, ids):
-        self.woo_product_ids = ','.join(map(str, ids))
+        """Ustawia zmapowane produkty WooCommerce, zachowując ustawienia istniejących mapowań."""
+        existing = {mapping.woo_product_id: mapping for mapping in self.mappings}
+        self.mappings = [existing.get(int(id)) or ProductMapping(woo_product_id=int(id)) for id in ids]
 
     def get_woo_product_ids(self):
-        return [int(id) for id in self.woo_product_ids.split(',') if id]
+        return [mapping.woo_product_id for mapping in self.mappings]
+
+class ProductMapping(db.Model):
+    """Pojedyncze mapowanie produkt Stripe -> produkt WooCommerce.
+
+    `quantity` mnoży ilość z koszyka Stripe, `price_share` to część kwoty pozycji (0-1)
+    przypisana temu produktowi. Mapowania bez `price_share` dzielą po równo pozostałą kwotę.
+    """
+    __table_args__ = (
+        db.UniqueConstraint('product_id', 'woo_product_id'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    product_id = db.Column(db.Integer, db.ForeignKey('product.id', ondelete='CASCADE'), nullable=False, index=True)
+    woo_product_id = db.Column(db.Integer, nullable=False, index=True)
+    quantity = db.Column(db.Integer, nullable=False, default=1)
+    price_share = db.Column(db.Float)
 
 class Config(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -43,4 +122,356 @@ class Config(db.Model):
         else:
             config = cls(key=key, value=value)
             db.session.add(config)
-        db.session.commit()
\ No newline at end of file
+        db.session.commit()
+
+class SyncedSession(db.Model):
+    """Lokalny rejestr zsynchronizowanych sesji Stripe -> zamówienia WooCommerce."""
+    STATUS_PENDING = 'pending'
+    # Żądanie utworzenia zamówienia zostało wysłane, ale jego wynik jest nieznany
+    STATUS_UNKNOWN = 'unknown'
+    STATUS_COMPLETED = 'completed'
+    # Po tym czasie rezerwacja bez wyniku (np. po awarii workera) może zostać przejęta
+    STALE_AFTER = datetime.timedelta(minutes=10)
+    _coverage_start = None
+
+    id = db.Column(db.Integer, primary_key=True)
+    stripe_session_id = db.Column(db.String(255), unique=True, index=True, nullable=False)
+    stripe_event_id = db.Column(db.String(255), index=True)
+    woo_order_id = db.Column(db.Integer)
+    status = db.Column(db.String(16), nullable=False, default=STATUS_PENDING)
+    claimed_at = db.Column(db.DateTime, nullable=False, default=datetime.datetime.utcnow)
+    completed_at = db.Column(db.DateTime)
+
+    @classmethod
+    def lookup(cls, session_id=None, event_id=None):
+        query = cls.query
+        if session_id:
+            return query.filter_by(stripe_session_id=session_id).first()
+        if event_id:
+            return query.filter_by(stripe_event_id=event_id).first()
+        return None
+
+    @classmethod
+    def covers(cls, created):
+        """Czy sesja utworzona w `created` (timestamp) powstała już po wprowadzeniu rejestru."""
+        if not created:
+            return False
+        if cls._coverage_start is None:
+            cls._coverage_start = db.session.query(db.func.min(cls.claimed_at)).scalar()
+        if cls._coverage_start is None:
+            return False
+        return datetime.datetime.utcfromtimestamp(created) > cls._coverage_start
+
+    @classmethod
+    def claim(cls, session_id, event_id=None, stale_after=STALE_AFTER):
+        """Rezerwuje sesję dla bieżącego procesu.
+
+        Zwraca True, jeśli rezerwacja się udała. Unikalny indeks na stripe_session_id
+        gwarantuje, że tylko jeden proces/wątek wygra wyścig. Porzucone rezerwacje
+        (np. po awarii workera) starsze niż `stale_after` mogą zostać przejęte, a rezerwacje
+        z nieznanym wynikiem (STATUS_UNKNOWN) - od razu.
+        """
+        now = datetime.datetime.utcnow()
+        try:
+            db.session.add(cls(stripe_session_id=session_id, stripe_event_id=event_id,
+                               status=cls.STATUS_PENDING, claimed_at=now))
+            db.session.commit()
+            return True
+        except IntegrityError:
+            db.session.rollback()
+
+        # Przejęcie porzuconej rezerwacji - warunkowy UPDATE jest atomowy
+        values = {'claimed_at': now, 'status': cls.STATUS_PENDING}
+        if event_id:
+            values['stripe_event_id'] = event_id
+        updated = cls.query.filter(
+            cls.stripe_session_id == session_id,
+            db.or_(cls.status == cls.STATUS_UNKNOWN,
+                   (cls.status == cls.STATUS_PENDING) & (cls.claimed_at < now - stale_after)),
+        ).update(values, synchronize_session=False)
+        db.session.commit()
+        return updated == 1
+
+    @classmethod
+    def retry_after(cls, session_id):
+        """Za ile sekund rezerwacja sesji będzie mogła zostać przejęta (0 - już teraz)."""
+        synced = cls.lookup(session_id=session_id)
+        if synced is None or synced.status != cls.STATUS_PENDING:
+            return 0
+        return max(0, (synced.claimed_at + cls.STALE_AFTER - datetime.datetime.utcnow()).total_seconds())
+
+    @classmethod
+    def complete(cls, session_id, woo_order_id):
+        cls.query.filter_by(stripe_session_id=session_id).update({
+            'woo_order_id': woo_order_id,
+            'status': cls.STATUS_COMPLETED,
+            'completed_at': datetime.datetime.utcnow(),
+        }, synchronize_session=False)
+        db.session.commit()
+
+    @classmethod
+    def record(cls, session_id, woo_order_id):
+        """Zapisuje zamówienie znalezione w sklepie (np. przez backfill) jako zsynchronizowane."""
+        try:
+            db.session.add(cls(stripe_session_id=session_id, woo_order_id=woo_order_id,
+                               status=cls.STATUS_COMPLETED, completed_at=datetime.datetime.utcnow()))
+            db.session.commit()
+        except IntegrityError:
+            db.session.rollback()
+            cls.complete(session_id, woo_order_id)
+
+    @classmethod
+    def release(cls, session_id):
+        """Usuwa rezerwację - tylko gdy żądanie utworzenia zamówienia na pewno nie zostało wysłane."""
+        cls.query.filter_by(stripe_session_id=session_id, status=cls.STATUS_PENDING).delete(
+            synchronize_session=False)
+        db.session.commit()
+
+    @classmethod
+    def mark_unknown(cls, session_id):
+        """Zamówienie mogło powstać (np. timeout odpowiedzi) - kolejna próba najpierw sprawdzi sklep."""
+        cls.query.filter_by(stripe_session_id=session_id, status=cls.STATUS_PENDING).update(
+            {'status': cls.STATUS_UNKNOWN}, synchronize_session=False)
+        db.session.commit()
+
+
+class CheckoutLineItems(db.Model):
+    """Line items sesji checkout pobrane ze Stripe (po zakończeniu sesji już się nie zmieniają).
+
+    Ponowienia zadania nie pobierają ich ponownie; wpis jest usuwany po utworzeniu zamówienia.
+    """
+    stripe_session_id = db.Column(db.String(255), primary_key=True)
+    line_items = db.Column(db.Text, nullable=False)
+    fetched_at = db.Column(db.DateTime, nullable=False, default=datetime.datetime.utcnow)
+
+    @classmethod
+    def get(cls, session_id):
+        cached = db.session.get(cls, session_id)
+        return cached.line_items if cached else None
+
+    @classmethod
+    def remember(cls, session_id, line_items):
+        try:
+            db.session.add(cls(stripe_session_id=session_id, line_items=line_items))
+            db.session.commit()
+        except IntegrityError:
+            # Równoległe pobranie tej samej sesji - wpis już istnieje
+            db.session.rollback()
+
+    @classmethod
+    def forget(cls, session_id):
+        cls.query.filter_by(stripe_session_id=session_id).delete(synchronize_session=False)
+        db.session.commit()
+
+
+class WebhookJob(db.Model):
+    """Trwała kolejka eventów webhooka przetwarzanych przez workery w tle."""
+    STATUS_QUEUED = 'queued'
+    STATUS_PROCESSING = 'processing'
+    STATUS_DONE = 'done'
+    STATUS_DEAD = 'dead'
+
+    id = db.Column(db.Integer, primary_key=True)
+    tenant_id = db.Column(db.Integer, nullable=False, default=DEFAULT_TENANT_ID, server_default='0')
+    event_id = db.Column(db.String(255), unique=True, nullable=False)
+    event_type = db.Column(db.String(64), nullable=False)
+    payload = db.Column(db.Text, nullable=False)
+    status = db.Column(db.String(16), nullable=False, default=STATUS_QUEUED, index=True)
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    last_error = db.Column(db.Text)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.datetime.utcnow)
+    next_attempt_at = db.Column(db.DateTime, nullable=False, default=datetime.datetime.utcnow, index=True)
+    locked_at = db.Column(db.DateTime)
+
+    @classmethod
+    def stats(cls):
+        rows = db.session.query(cls.status, db.func.count(cls.id), db.func.min(cls.created_at)) \
+            .filter(cls.status != cls.STATUS_DONE).group_by(cls.status).all()
+        stats = {'queued': 0, 'processing': 0, 'dead': 0, 'oldest_age': None}
+        oldest = None
+        for status, count, created_at in rows:
+            stats[status] = count
+            if status != cls.STATUS_DEAD and (oldest is None or created_at < oldest):
+                oldest = created_at
+        stats['depth'] = stats['queued'] + stats['processing']
+        if oldest:
+            stats['oldest_age'] = int((datetime.datetime.utcnow() - oldest).total_seconds())
+        return stats
+
+
+class CacheVersion(db.Model):
+    """Licznik wersji współdzielony przez procesy - zmiana wersji unieważnia lokalne cache."""
+    name = db.Column(db.String(64), primary_key=True)
+    version = db.Column(db.Integer, nullable=False, default=0)
+
+    @classmethod
+    def get_version(cls, name):
+        version = db.session.query(cls.version).filter_by(name=name).scalar()
+        return version or 0
+
+    @classmethod
+    def bump(cls, name):
+        """Podbija wersję w bieżącej transakcji (commit należy do wywołującego)."""
+        updated = cls.query.filter_by(name=name).update(
+            {'version': cls.version + 1}, synchronize_session=False)
+        if not updated:
+            db.session.add(cls(name=name, version=1))
+
+
+class CatalogItem(db.Model):
+    """Lokalna kopia katalogu produktów WooCommerce i Stripe."""
+    SOURCE_WOO = 'woo'
+    SOURCE_STRIPE = 'stripe'
+
+    __table_args__ = (
+        db.UniqueConstraint('tenant_id', 'source', 'external_id'),
+        db.Index('ix_catalog_item_source_name', 'tenant_id', 'source', 'name'),
+        db.Index('ix_catalog_item_search', 'tenant_id', 'source', 'active', 'search_name'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    tenant_id = db.Column(db.Integer, nullable=False, default=DEFAULT_TENANT_ID, server_default='0')
+    source = db.Column(db.String(16), nullable=False)
+    external_id = db.Column(db.String(64), nullable=False)
+    name = db.Column(db.String(255), nullable=False)
+    search_name = db.Column(db.String(255))
+    active = db.Column(db.Boolean, nullable=False, default=True)
+    modified_at = db.Column(db.DateTime)
+    synced_at = db.Column(db.DateTime, nullable=False, default=datetime.datetime.utcnow)
+
+    @db.validates('name')
+    def _update_search_name(self, key, name):
+        self.search_name = search_key(name)
+        return name
+
+    @classmethod
+    def choices(cls, source, external_ids=None, tenant_id=DEFAULT_TENANT_ID):
+        query = db.session.query(cls.external_id, cls.name).filter_by(tenant_id=tenant_id, source=source, active=True)
+        if external_ids is not None:
+            query = query.filter(cls.external_id.in_([str(id) for id in external_ids]))
+        rows = query.order_by(cls.name).all()
+        if source == cls.SOURCE_WOO:
+            return [(int(external_id), name) for external_id, name in rows]
+        return [(external_id, name) for external_id, name in rows]
+
+    @classmethod
+    def search(cls, source, text, cursor=None, limit=20, tenant_id=DEFAULT_TENANT_ID):
+        """Wyszukiwanie po początku nazwy lub po dokładnym ID, stronicowane kluczem (search_name, id)."""
+        query = cls.query.filter_by(tenant_id=tenant_id, source=source, active=True)
+        text = (text or '').strip()
+        if text:
+            query = query.filter(db.or_(prefix_filter(cls.search_name, search_key(text)), cls.external_id == text))
+        return keyset_page(query, (cls.search_name, cls.id), cursor, limit)
+
+
+class SyncState(db.Model):
+    """Kursory i znaczniki czasu synchronizacji w tle."""
+    name = db.Column(db.String(64), primary_key=True)
+    value = db.Column(db.String(255))
+    updated_at = db.Column(db.DateTime, nullable=False, default=datetime.datetime.utcnow)
+
+    @classmethod
+    def get(cls, name):
+        return db.session.get(cls, name)
+
+    @classmethod
+    def set(cls, name, value):
+        """Zapisuje stan w bieżącej transakcji (commit należy do wywołującego)."""
+        state = db.session.get(cls, name)
+        if state is None:
+            state = cls(name=name)
+            db.session.add(state)
+        state.value = value
+        state.updated_at = datetime.datetime.utcnow()
+        return state
+
+
+class CustomerIndex(db.Model):
+    """Lokalny indeks e-mail -> ID klienta WooCommerce (osobny dla każdego sklepu)."""
+    __table_args__ = (
+        db.UniqueConstraint('tenant_id', 'email'),
+    )
+
+    # Po tym czasie rezerwacja utworzenia klienta może zostać przejęta
+    STALE_AFTER = datetime.timedelta(minutes=2)
+
+    id = db.Column(db.Integer, primary_key=True)
+    tenant_id = db.Column(db.Integer, nullable=False, default=DEFAULT_TENANT_ID, server_default='0')
+    email = db.Column(db.String(255), nullable=False)
+    woo_customer_id = db.Column(db.Integer)
+    verified_at = db.Column(db.DateTime)
+    claimed_at = db.Column(db.DateTime, nullable=False, default=datetime.datetime.utcnow)
+
+    @classmethod
+    def lookup(cls, email, tenant_id=DEFAULT_TENANT_ID):
+        return cls.query.filter_by(tenant_id=tenant_id, email=email).first()
+
+    @classmethod
+    def claim(cls, email, stale_after=STALE_AFTER, tenant_id=DEFAULT_TENANT_ID):
+        """Rezerwuje utworzenie klienta dla adresu e-mail - tylko jeden proces może go utworzyć."""
+        now = datetime.datetime.utcnow()
+        try:
+            db.session.add(cls(tenant_id=tenant_id, email=email, claimed_at=now))
+            db.session.commit()
+            return True
+        except IntegrityError:
+            db.session.rollback()
+
+        updated = cls.query.filter(
+            cls.tenant_id == tenant_id,
+            cls.email == email,
+            cls.woo_customer_id.is_(None),
+            cls.claimed_at < now - stale_after,
+        ).update({'claimed_at': now}, synchronize_session=False)
+        db.session.commit()
+        return updated == 1
+
+    @classmethod
+    def retry_after(cls, email, tenant_id=DEFAULT_TENANT_ID):
+        """Za ile sekund rezerwacja adresu e-mail będzie mogła zostać przejęta (0 - już teraz)."""
+        entry = cls.lookup(email, tenant_id=tenant_id)
+        if entry is None or entry.woo_customer_id:
+            return 0
+        return max(0, (entry.claimed_at + cls.STALE_AFTER - datetime.datetime.utcnow()).total_seconds())
+
+    @classmethod
+    def remember(cls, email, woo_customer_id, tenant_id=DEFAULT_TENANT_ID):
+        now = datetime.datetime.utcnow()
+        updated = cls.query.filter_by(tenant_id=tenant_id, email=email).update(
+            {'woo_customer_id': woo_customer_id, 'verified_at': now}, synchronize_session=False)
+        if not updated:
+            db.session.add(cls(tenant_id=tenant_id, email=email, woo_customer_id=woo_customer_id,
+                               verified_at=now, claimed_at=now))
+        try:
+            db.session.commit()
+        except IntegrityError:
+            # Wpis dodał w międzyczasie inny proces - aktualizujemy go
+            db.session.rollback()
+            cls.query.filter_by(tenant_id=tenant_id, email=email).update(
+                {'woo_customer_id': woo_customer_id, 'verified_at': now}, synchronize_session=False)
+            db.session.commit()
+
+    @classmethod
+    def remember_many(cls, customers, tenant_id=DEFAULT_TENANT_ID):
+        """Zapisuje wiele par (email, id klienta) w jednej transakcji."""
+        now = datetime.datetime.utcnow()
+        existing = {entry.email: entry for entry in cls.query.filter(
+            cls.tenant_id == tenant_id, cls.email.in_(list(customers)))}
+        for email, woo_customer_id in customers.items():
+            entry = existing.get(email)
+            if entry is None:
+                entry = cls(tenant_id=tenant_id, email=email, claimed_at=now)
+                db.session.add(entry)
+            entry.woo_customer_id = woo_customer_id
+            entry.verified_at = now
+        db.session.commit()
+
+    @classmethod
+    def forget(cls, email, tenant_id=DEFAULT_TENANT_ID):
+        cls.query.filter_by(tenant_id=tenant_id, email=email).delete(synchronize_session=False)
+        db.session.commit()
+
+    @classmethod
+    def release(cls, email, tenant_id=DEFAULT_TENANT_ID):
+        cls.query.filter_by(tenant_id=tenant_id, email=email, woo_customer_id=None).delete(synchronize_session=False)
+        db.session.commit()
@@ -0,0 +1,130 @@
+import logging
+import threading
+import time
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BATCHING_CONFIG = {
+    'enabled': False,
+    'window_ms': 200,
+    'max_size': 50,
+    'timeout': 60,
+}
+# Limit pozycji w jednym żądaniu do endpointu batch WooCommerce
+WOO_BATCH_LIMIT = 100
+
+
+class OrderBatchError(Exception):
+    """Błąd utworzenia pojedynczego zamówienia w ramach paczki."""
+
+
+class OrderBatcherClosed(RuntimeError):
+    """Batcher został zamknięty (np. podmiana handlera) - zamówienie nie trafiło do żadnej paczki."""
+
+
+class OrderBatcher:
+    """Zbiera zamówienia z wielu wątków i wysyła je paczkami przez `orders/batch`.
+
+    Paczka jest wysyłana po upływie `window_ms` od pierwszego zamówienia albo po zebraniu
+    `max_size` zamówień. Każde zamówienie dostaje własny Future - błąd jednej pozycji
+    nie wpływa na pozostałe.
+    """
+
+    def __init__(self, wcapi, batching_config=None):
+        self.wcapi = wcapi
+        self.config = dict(DEFAULT_BATCHING_CONFIG, **(batching_config or {}))
+        self.window = self.config['window_ms'] / 1000
+        self.max_size = min(self.config['max_size'], WOO_BATCH_LIMIT)
+        self._pending = []
+        self._cond = threading.Condition()
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, name='order-batcher', daemon=True)
+        self._thread.start()
+
+    def submit(self, order_data):
+        future = Future()
+        with self._cond:
+            if self._closed:
+                raise OrderBatcherClosed('OrderBatcher został zamknięty')
+            self._pending.append((order_data, future))
+            self._cond.notify()
+        return future
+
+    def create_order(self, order_data):
+        future = self.submit(order_data)
+        try:
+            return future.result(timeout=self.config['timeout'])
+        except FutureTimeoutError:
+            with self._cond:
+                for index, (_, pending) in enumerate(self._pending):
+                    if pending is future:
+                        # Jeszcze nie wysłane - wycofujemy, żeby nie trafiło do sklepu po ponowieniu zadania
+                        del self._pending[index]
+                        raise OrderBatchError(
+                            f"Zamówienie dla sesji {_session_id(order_data)} nie zostało wysłane w czasie "
+                            f"{self.config['timeout']}s")
+            # Paczka jest już w drodze - wynik nieznany (ponowienie najpierw sprawdzi sklep)
+            raise
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+        self._thread.join()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._pending and not self._closed:
+                    self._cond.wait()
+                if not self._pending and self._closed:
+                    return
+                # Czekamy na zapełnienie okna czasowego lub paczki
+                deadline = time.monotonic() + self.window
+                while len(self._pending) < self.max_size and not self._closed:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+                batch = self._pending[:self.max_size]
+                self._pending = self._pending[self.max_size:]
+            # Paczka może być pusta, jeśli jej zamówienia wycofano po przekroczeniu czasu
+            if batch:
+                self._send(batch)
+
+    def _send(self, batch):
+        logger.info("Wysyłanie paczki %d zamówień do WooCommerce", len(batch))
+        try:
+            response = self.wcapi.post("orders/batch", {"create": [order_data for order_data, _ in batch]})
+            if response.status_code != 200:
+                raise Exception(f"Błąd przy tworzeniu paczki zamówień: {response.text}")
+            results = response.json().get('create', [])
+        except Exception as e:
+            logger.error("Błąd podczas wysyłania paczki zamówień: %s", e)
+            for _, future in batch:
+                future.set_exception(e)
+            return
+
+        # Zamówienia dopasowujemy tylko po sesji - przypisanie po pozycji mogłoby zapisać w rejestrze
+        # zamówienie innej sesji. Pozycja bez dopasowania kończy się błędem (ponowienie sprawdzi sklep)
+        by_session = {_session_id(result): result for result in results
+                      if not result.get('error') and _session_id(result)}
+        errors = [result['error'].get('message') for result in results if result.get('error')]
+        for order_data, future in batch:
+            session_id = _session_id(order_data)
+            result = by_session.get(session_id)
+            if result is not None:
+                future.set_result(result)
+            elif errors:
+                future.set_exception(OrderBatchError(
+                    f"Brak zamówienia dla sesji {session_id} w wyniku paczki (błędy paczki: {'; '.join(errors)})"))
+            else:
+                future.set_exception(OrderBatchError(f"Brak wyniku paczki dla sesji {session_id}"))
+
+
+def _session_id(order):
+    for meta in order.get('meta_data', []):
+        if meta.get('key') == 'stripe_session_id':
+            return meta.get('value')
+    return None
@@ -0,0 +1,38 @@
+import base64
+import json
+from .extensions import db
+
+
+def encode_cursor(values):
+    return base64.urlsafe_b64encode(json.dumps(values, separators=(',', ':')).encode('utf-8')).decode('ascii')
+
+
+def decode_cursor(cursor):
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+    except (ValueError, UnicodeError):
+        return None
+    return values if isinstance(values, list) else None
+
+
+def prefix_filter(column, prefix):
+    # Zakres zamiast LIKE - SQLite może wtedy użyć zwykłego indeksu na kolumnie
+    return db.and_(column >= prefix, column < prefix + '\U0010ffff')
+
+
+def keyset_page(query, columns, cursor=None, limit=50):
+    """Strona wyników uporządkowana po `columns`, zaczynająca się za kursorem.
+
+    W przeciwieństwie do OFFSET koszt pobrania kolejnej strony nie rośnie z jej numerem.
+    Zwraca (elementy, kursor następnej strony lub None).
+    """
+    values = decode_cursor(cursor) if cursor else None
+    if values is not None and len(values) == len(columns):
+        query = query.filter(db.tuple_(*columns) > db.tuple_(*[db.literal(value) for value in values]))
+    items = query.order_by(*columns).limit(limit + 1).all()
+    next_cursor = None
+    if len(items) > limit:
+        items = items[:limit]
+        last = items[-1]
+        next_cursor = encode_cursor([getattr(last, column.key) for column in columns])
+    return items, next_cursor
@@ -0,0 +1,83 @@
+import logging
+import threading
+import time
+from collections import namedtuple
+from .extensions import db
+from .models import Product, ProductMapping, CacheVersion, DEFAULT_TENANT_ID
+
+logger = logging.getLogger(__name__)
+
+INDEX_VERSION_KEY = 'product_index'
+
+# Gotowy szablon pozycji zamówienia WooCommerce dla jednego produktu Stripe
+LineItemTemplate = namedtuple('LineItemTemplate', ['product_id', 'quantity', 'share'])
+
+
+class ProductIndex:
+    """Mapowanie produktów Stripe -> WooCommerce trzymane w pamięci procesu.
+
+    Indeks jest ładowany raz i przebudowywany tylko po zmianie licznika wersji w bazie,
+    który sprawdzamy nie częściej niż co `check_interval` sekund. Mapowanie koszyka
+    między sprawdzeniami nie wykonuje żadnych zapytań SQL.
+    """
+
+    def __init__(self, check_interval=5):
+        self.check_interval = check_interval
+        self._lock = threading.Lock()
+        self._templates = None
+        self._version = None
+        self._checked_at = 0.0
+
+    def get(self, stripe_product_id, tenant_id=DEFAULT_TENANT_ID):
+        return self._current().get((tenant_id, stripe_product_id))
+
+    def invalidate(self):
+        # Podbicie wersji w bazie powiadamia pozostałe procesy
+        CacheVersion.bump(INDEX_VERSION_KEY)
+        db.session.commit()
+        with self._lock:
+            self._templates = None
+
+    def _current(self):
+        templates = self._templates
+        if templates is not None and time.monotonic() - self._checked_at < self.check_interval:
+            return templates
+
+        with self._lock:
+            now = time.monotonic()
+            if self._templates is not None and now - self._checked_at < self.check_interval:
+                return self._templates
+            version = CacheVersion.get_version(INDEX_VERSION_KEY)
+            if self._templates is None or version != self._version:
+                self._templates = self._load()
+                self._version = version
+                logger.info("Załadowano indeks mapowań produktów (wersja %s, %d produktów)",
+                            version, len(self._templates))
+            self._checked_at = now
+            return self._templates
+
+    @staticmethod
+    def _load():
+        mappings = {}
+        rows = db.session.query(Product.tenant_id, Product.stripe_id, ProductMapping.woo_product_id,
+                                ProductMapping.quantity, ProductMapping.price_share) \
+            .outerjoin(ProductMapping, ProductMapping.product_id == Product.id) \
+            .order_by(Product.id, ProductMapping.id)
+        for tenant_id, stripe_id, woo_product_id, quantity, price_share in rows:
+            product_mappings = mappings.setdefault((tenant_id, stripe_id), [])
+            if woo_product_id is not None:
+                product_mappings.append((woo_product_id, quantity or 1, price_share))
+        # Klucz (tenant_id, stripe_id) - ten sam produkt Stripe może być różnie zmapowany w każdym sklepie
+        return {key: compile_templates(product_mappings) for key, product_mappings in mappings.items()}
+
+
+def compile_templates(mappings):
+    """Zamienia mapowania (woo_product_id, quantity, price_share) na szablony z ustalonym udziałem w cenie."""
+    fixed = sum(price_share for _, _, price_share in mappings if price_share is not None)
+    unset = sum(1 for _, _, price_share in mappings if price_share is None)
+    remainder = max(1 - fixed, 0) / unset if unset else 0
+    return tuple(LineItemTemplate(woo_product_id, quantity, remainder if price_share is None else price_share)
+                 for woo_product_id, quantity, price_share in mappings)
+
+
+product_index = ProductIndex()
@@ -0,0 +1,211 @@
+import argparse
+import hashlib
+import html
+import json
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+from decimal import Decimal, InvalidOperation
+from itertools import islice
+from sqlalchemy.orm import selectinload
+from .extensions import db
+from .models import Product, DEFAULT_TENANT_ID
+from .tenants import resolve_tenant_id, UnknownTenantError
+
+logger = logging.getLogger(__name__)
+
+# Waluty bez części ułamkowej - kwota w Stripe nie jest mnożona przez 100
+ZERO_DECIMAL_CURRENCIES = frozenset(['bif', 'clp', 'djf', 'gnf', 'jpy', 'kmf', 'krw', 'mga', 'pyg', 'rwf',
+                                     'ugx', 'vnd', 'vuv', 'xaf', 'xof', 'xpf'])
+
+
+def desired_state(product, woo_products):
+    """Nazwa, cena i status produktu Stripe wynikające z zmapowanych produktów WooCommerce.
+
+    Nazwę przenosimy tylko przy mapowaniu 1:1 - zestaw kilku produktów ma własną nazwę.
+    Cena zestawu to suma cen składników razy ich ilość, a aktywny jest tylko wtedy,
+    gdy wszystkie składniki są opublikowane.
+    """
+    items = [(woo_products.get(mapping.woo_product_id), mapping.quantity) for mapping in product.mappings]
+    if not items:
+        return None
+    active = all(woo is not None and woo.get('status') == 'publish' for woo, _ in items)
+    name = None
+    if len(items) == 1 and items[0][0] is not None:
+        name = html.unescape(items[0][0]['name'])
+    price = None
+    try:
+        if all(woo is not None and woo.get('price') for woo, _ in items):
+            price = sum(Decimal(woo['price']) * quantity for woo, quantity in items)
+    except InvalidOperation:
+        price = None
+    return {'name': name, 'price': str(price) if price is not None else None, 'active': active}
+
+
+def state_hash(state):
+    return hashlib.sha256(json.dumps(state, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def to_unit_amount(price, currency):
+    amount = Decimal(price) if currency in ZERO_DECIMAL_CURRENCIES else Decimal(price) * 100
+    return int(amount.quantize(Decimal(1)))
+
+
+def idempotency_key(operation, stripe_id, version, params):
+    # Ten sam zapis na tej samej wersji produktu (`updated`) ma ten sam klucz - ponowienie
+    # po przerwanym uruchomieniu nie utworzy drugiej ceny, a zapis po zmianie produktu dostanie nowy klucz
+    digest = hashlib.sha256(json.dumps([version, params], sort_keys=True).encode('utf-8')).hexdigest()[:32]
+    return f"product-sync-{operation}-{stripe_id}-{digest}"
+
+
+def plan_changes(state, stripe_product):
+    """Zapisy potrzebne, by produkt Stripe odpowiadał stanowi z WooCommerce.
+
+    Zwraca parametry aktualizacji produktu i parametry nowej ceny (ceny w Stripe są
+    niezmienne - zmiana kwoty to nowa cena ustawiona jako domyślna).
+    """
+    update = {}
+    if state['name'] and state['name'] != stripe_product['name']:
+        update['name'] = state['name']
+    if state['active'] != stripe_product['active']:
+        update['active'] = state['active']
+
+    new_price = None
+    default_price = stripe_product.get('default_price')
+    if state['price'] is not None and isinstance(default_price, dict):
+        unit_amount = to_unit_amount(state['price'], default_price['currency'])
+        if unit_amount != default_price.get('unit_amount'):
+            new_price = {'product': stripe_product['id'], 'currency': default_price['currency'],
+                         'unit_amount': unit_amount}
+            recurring = default_price.get('recurring')
+            if recurring:
+                new_price['recurring'] = {'interval': recurring['interval'],
+                                          'interval_count': recurring['interval_count']}
+            if default_price.get('tax_behavior'):
+                new_price['tax_behavior'] = default_price['tax_behavior']
+    elif state['price'] is not None and default_price is None:
+        logger.warning("Produkt Stripe %s nie ma domyślnej ceny - pomijam synchronizację ceny", stripe_product['id'])
+    return update, new_price
+
+
+def push_changes(stripe_handler, stripe_id, version, update, new_price):
+    """Wysyła zmiany jednego produktu. Zwraca liczbę wykonanych zapisów."""
+    writes = 0
+    if new_price:
+        price = stripe_handler.create_price(new_price, idempotency_key('price', stripe_id, version, new_price))
+        update = dict(update, default_price=price['id'])
+        writes += 1
+    if update:
+        stripe_handler.update_product(stripe_id, update, idempotency_key('product', stripe_id, version, update))
+        writes += 1
+    return writes
+
+
+def sync_products(woo_handler, stripe_handler, tenant_id=DEFAULT_TENANT_ID, concurrency=4, batch_size=100,
+                  dry_run=False):
+    """Przenosi do Stripe nazwy, ceny i statusy zmapowanych produktów WooCommerce.
+
+    Produkty, których skrót stanu z WooCommerce nie zmienił się od ostatniej udanej
+    synchronizacji, są pomijane bez porównywania. Pozostałe są porównywane ze Stripe
+    i wysyłane są tylko różniące się pola - w paczkach po `batch_size`, najwyżej
+    `concurrency` równolegle. Skróty zapisujemy po każdej paczce.
+    """
+    started = time.monotonic()
+    woo_products = {product['id']: product for product in woo_handler.get_all_products(status="any")}
+    stripe_products = {product['id']: product
+                       for product in stripe_handler.get_all_products(active=None, expand_prices=True)}
+
+    stats = {'checked': 0, 'unchanged': 0, 'updated': 0, 'writes': 0, 'failed': 0, 'missing': 0}
+    pending = []
+    products = Product.query.filter_by(tenant_id=tenant_id).options(selectinload(Product.mappings)) \
+        .order_by(Product.id)
+    for product in products:
+        state = desired_state(product, woo_products)
+        if state is None:
+            continue
+        stats['checked'] += 1
+        digest = state_hash(state)
+        if digest == product.sync_hash:
+            stats['unchanged'] += 1
+            continue
+        stripe_product = stripe_products.get(product.stripe_id)
+        if stripe_product is None:
+            logger.warning("Nie znaleziono produktu Stripe %s (mapowanie %s)", product.stripe_id, product.id)
+            stats['missing'] += 1
+            continue
+        update, new_price = plan_changes(state, stripe_product)
+        pending.append((product.id, product.stripe_id, stripe_product.get('updated'), digest, update, new_price))
+
+    def push(change):
+        product_id, stripe_id, version, digest, update, new_price = change
+        try:
+            return product_id, digest, push_changes(stripe_handler, stripe_id, version, update, new_price), None
+        except Exception as e:
+            return product_id, digest, 0, e
+
+    changes = iter(pending)
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        while True:
+            batch = list(islice(changes, batch_size))
+            if not batch:
+                break
+            if dry_run:
+                for _, stripe_id, _, _, update, new_price in batch:
+                    if update or new_price:
+                        amount = f" cena={new_price['unit_amount']} {new_price['currency']}" if new_price else ''
+                        print(f"- {stripe_id}: {update}{amount}")
+                        stats['updated'] += 1
+                continue
+            hashes = {}
+            for product_id, digest, writes, error in executor.map(push, batch):
+                if error is not None:
+                    stats['failed'] += 1
+                    logger.error("Błąd synchronizacji produktu (mapowanie %s): %s", product_id, error)
+                    continue
+                hashes[product_id] = digest
+                stats['writes'] += writes
+                if writes:
+                    stats['updated'] += 1
+                else:
+                    stats['unchanged'] += 1
+            # Nieudane produkty zachowują stary skrót - zostaną porównane ponownie przy kolejnym uruchomieniu
+            for product_id, digest in hashes.items():
+                Product.query.filter_by(id=product_id).update({'sync_hash': digest}, synchronize_session=False)
+            db.session.commit()
+
+    logger.info("Synchronizacja produktów (tenant %s): sprawdzono %d, zmieniono %d (%d zapisów), błędów %d "
+                "w %.1fs", tenant_id, stats['checked'], stats['updated'], stats['writes'], stats['failed'],
+                time.monotonic() - started)
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Synchronizacja nazw, cen i statusów produktów WooCommerce -> Stripe")
+    parser.add_argument('--dry-run', action='store_true', help="Tylko wypisz produkty do zmiany")
+    parser.add_argument('--concurrency', type=int, default=4, help="Liczba równoległych zapisów do Stripe")
+    parser.add_argument('--batch-size', type=int, default=100, help="Liczba produktów w paczce")
+    parser.add_argument('--tenant', help="Slug sklepu (domyślnie sklep z ustawień panelu)")
+    args = parser.parse_args()
+
+    from . import create_app
+    from .handlers import registry
+    app = create_app(start_workers=False)
+    with app.app_context():
+        try:
+            tenant_id = resolve_tenant_id(args.tenant)
+        except UnknownTenantError as e:
+            print(e)
+            return
+        woo_handler, stripe_handler = registry.current(tenant_id)
+        if not woo_handler or not stripe_handler:
+            print("WooCommerce lub Stripe nie jest skonfigurowany.")
+            return
+        stats = sync_products(woo_handler, stripe_handler, tenant_id, concurrency=args.concurrency,
+                              batch_size=args.batch_size, dry_run=args.dry_run)
+        print(f"Sprawdzono {stats['checked']} produktów: zmienionych {stats['updated']} "
+              f"({stats['writes']} zapisów), bez zmian {stats['unchanged']}, brak w Stripe {stats['missing']}, "
+              f"błędów {stats['failed']}." + (" (dry-run - nic nie zostało zapisane)" if args.dry_run else ""))
+
+
+if __name__ == '__main__':
+    main()
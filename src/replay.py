@@ -0,0 +1,163 @@
+"""Odtwarzanie webhooków zapisanych w dzienniku eventów (src.event_log).
+
+Przykłady:
+    python -m src.replay --from 2024-10-01T10:00 --to 2024-10-01T12:00 --dry-run
+    python -m src.replay --from 2024-10-01T10:00 --to 2024-10-01T12:00 --concurrency 8
+    python -m src.replay --from 2024-10-01 --to 2024-10-02 --speed 1 --target https://staging.example.com --secret whsec_...
+
+Bez --target eventy trafiają bezpośrednio do przetwarzania (handlery sklepów z bieżącej
+konfiguracji) - zamówienia już utworzone są pomijane przez rejestr zsynchronizowanych sesji.
+Z --target żądania są wysyłane ponownie na adres /webhook z nowym podpisem.
+"""
+import argparse
+import datetime
+import hashlib
+import hmac
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from .extensions import db
+from .event_log import read_events
+from .webhooks import webhook_filter, event_tenant, loads
+
+
+def parse_time(value):
+    """Data/czas ISO 8601 jako timestamp; bez strefy czasowej - UTC."""
+    parsed = datetime.datetime.fromisoformat(value)
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=datetime.timezone.utc)
+    return parsed.timestamp()
+
+
+def sign(payload, secret, timestamp=None):
+    timestamp = timestamp or int(time.time())
+    signature = hmac.new(secret.encode('utf-8'), f"{timestamp}.".encode('ascii') + payload,
+                         hashlib.sha256).hexdigest()
+    return f"t={timestamp},v1={signature}"
+
+
+def replay(records, send, speed=None, concurrency=8):
+    """Wywołuje `send(record)` dla kolejnych rekordów w `concurrency` wątkach.
+
+    Przy `speed=None` najszybciej, jak się da; w przeciwnym razie z zachowaniem odstępów
+    między eventami podzielonych przez `speed` (1 - oryginalne tempo). Zwraca liczniki
+    wysłanych, pominiętych (`send` zwrócił False) i nieudanych eventów.
+    """
+    stats = {'sent': 0, 'skipped': 0, 'failed': 0, 'errors': []}
+    lock = threading.Lock()
+    # Najwyżej 2x`concurrency` eventów czeka w pamięci na wolny wątek
+    slots = threading.BoundedSemaphore(concurrency * 2)
+
+    def run(record):
+        try:
+            result = send(record)
+        except Exception as e:
+            with lock:
+                stats['failed'] += 1
+                stats['errors'].append((record.get('event_id'), str(e)))
+        else:
+            with lock:
+                stats['sent' if result is not False else 'skipped'] += 1
+        finally:
+            slots.release()
+
+    first_received = started = None
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for record in records:
+            if speed:
+                if first_received is None:
+                    first_received, started = record['received_at'], time.monotonic()
+                delay = (record['received_at'] - first_received) / speed - (time.monotonic() - started)
+                if delay > 0:
+                    time.sleep(delay)
+            slots.acquire()
+            executor.submit(run, record)
+    return stats
+
+
+def http_sender(base_url, secret_for, session):
+    """Wysyła rekord na `base_url` + oryginalna ścieżka, z nowym podpisem (stary jest już przeterminowany)."""
+    def send(record):
+        payload = record['body'].encode('utf-8')
+        headers = {'Content-Type': record['headers'].get('Content-Type', 'application/json'),
+                   'Stripe-Signature': sign(payload, secret_for(record))}
+        response = session.post(base_url.rstrip('/') + record['path'], data=payload, headers=headers)
+        if response.status_code != 200:
+            raise Exception(f"Status {response.status_code}: {response.text[:200]}")
+    return send
+
+
+def pipeline_sender(app, processor):
+    """Przetwarza rekord tak jak worker kolejki (typy spoza webhook.event_types są pomijane)."""
+    def send(record):
+        if not webhook_filter.accepts(record['type']):
+            return False
+        with app.app_context():
+            try:
+                event = loads(record['body'])
+                processor(event, event_tenant(record['tenant_id'], event))
+            finally:
+                db.session.remove()
+    return send
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Odtwarzanie webhooków z dziennika eventów")
+    parser.add_argument('--from', dest='since', required=True, help="Początek zakresu (ISO 8601, domyślnie UTC)")
+    parser.add_argument('--to', dest='until', required=True, help="Koniec zakresu (ISO 8601, domyślnie UTC)")
+    parser.add_argument('--directory', help="Katalog dziennika (domyślnie event_log.directory z konfiguracji)")
+    parser.add_argument('--type', action='append', dest='types', help="Tylko eventy tego typu (można powtórzyć)")
+    parser.add_argument('--speed', type=float,
+                        help="Tempo względem oryginalnego (1 - oryginalne odstępy); domyślnie najszybciej")
+    parser.add_argument('--concurrency', type=int, default=8, help="Liczba równolegle odtwarzanych eventów")
+    parser.add_argument('--target', help="Adres aplikacji (np. https://staging.example.com) zamiast przetwarzania lokalnego")
+    parser.add_argument('--secret', help="Sekret podpisu dla --target (domyślnie sekret sklepu z konfiguracji)")
+    parser.add_argument('--dry-run', action='store_true', help="Tylko wypisz eventy z zakresu")
+    args = parser.parse_args()
+
+    from . import create_app
+    app = create_app(start_workers=False)
+    from .event_log import event_log
+    directory = args.directory or event_log.config['directory']
+    records = read_events(directory, parse_time(args.since), parse_time(args.until))
+    if args.types:
+        records = (record for record in records if record['type'] in args.types)
+
+    if args.dry_run:
+        count = 0
+        for record in records:
+            received = datetime.datetime.fromtimestamp(record['received_at'], datetime.timezone.utc)
+            print(f"- {received:%Y-%m-%d %H:%M:%S.%f}  {record['path']:<24} {record['type'] or '-':<36} "
+                  f"{record.get('event_id') or '-'}")
+            count += 1
+        print(f"Eventów w zakresie: {count} (dry-run - nic nie zostało wysłane)")
+        return
+
+    if args.target:
+        import requests
+        from .utils import load_config
+        from .tenant_store import tenant_store
+        with app.app_context():
+            default_secret = load_config()['stripe']['webhook_secret']
+            tenant_secrets = {tenant.id: tenant.config['stripe']['webhook_secret'] for tenant in tenant_store.all()}
+
+        def secret_for(record):
+            return args.secret or tenant_secrets.get(record['tenant_id'], default_secret)
+
+        session = requests.Session()
+        session.mount(args.target, requests.adapters.HTTPAdapter(pool_maxsize=args.concurrency))
+        send = http_sender(args.target, secret_for, session)
+    else:
+        send = pipeline_sender(app, app.extensions['webhook_processor'])
+
+    started = time.monotonic()
+    stats = replay(records, send, speed=args.speed, concurrency=args.concurrency)
+    elapsed = time.monotonic() - started
+    for event_id, error in stats['errors']:
+        print(f"Błąd dla eventu {event_id}: {error}")
+    print(f"Odtworzono {stats['sent']} eventów, pominięto {stats['skipped']}, błędów {stats['failed']} "
+          f"w {elapsed:.1f}s ({stats['sent'] / elapsed if elapsed else 0:.1f} eventów/s)")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,29 +1,166 @@
-import stripe
+import asyncio
+import json
 import logging
+import ssl
+import stripe
+from .extensions import run_db
+from .models import CheckoutLineItems
+from .webhooks import loads
 
 logger = logging.getLogger(__name__)
 
 class StripeHandler:
-    def __init__(self, api_key, webhook_secret):
+    def __init__(self, api_key, webhook_secret, session=None, api_base=None):
         self.stripe = stripe
-        self.stripe.api_key = api_key
+        # Osobny klient na instancję zamiast globalnego stripe.api_key
+        http_client = None
+        max_network_retries = None
+        if session is not None:
+            # Timeouty, limity i ponowienia (z kluczem idempotencji dla POST) zapewnia adapter sesji,
+            # więc SDK nie ponawia żądań samodzielnie
+            http_client = stripe.RequestsClient(session=session, timeout=None)
+            max_network_retries = 0
+        base_addresses = {'api': api_base} if api_base else {}
+        self.client = stripe.StripeClient(api_key, http_client=http_client, base_addresses=base_addresses,
+                                          max_network_retries=max_network_retries)
         self.webhook_secret = webhook_secret
 
     def construct_event(self, payload, sig_header):
-        return self.stripe.Webhook.construct_event(
+        return self.client.construct_event(
             payload, sig_header, self.webhook_secret
         )
 
     def process_checkout_session(self, session):
-        logger.info(f"Przetwarzanie sesji checkout: {session['id']}")
-        line_items = self.stripe.checkout.Session.list_line_items(session['id'], limit=5)
-        logger.info(f"Pobrano {len(line_items.data)} line items")
-        return line_items.data
-    
-    def get_all_products(self):
+        """Wszystkie line items sesji.
+
+        Najpierw używa line items rozwiniętych w obiekcie sesji (`expand`), potem zapisanych
+        w bazie przy poprzedniej próbie, a dopiero na końcu pobiera je z API (z paginacją,
+        100 na stronę - większość koszyków to jedno żądanie).
+        """
+        line_items = self._known_line_items(session)
+        if line_items is not None:
+            return line_items
+
+        line_items = list(self.client.checkout.sessions.line_items.list(
+            session['id'], params={'limit': 100}).auto_paging_iter())
+        logger.debug("Pobrano %d line items", len(line_items))
+        CheckoutLineItems.remember(session['id'], json.dumps(line_items))
+        return line_items
+
+    def _known_line_items(self, session):
+        expanded = session.get('line_items')
+        if expanded and not expanded.get('has_more'):
+            logger.debug("Użyto %d rozwiniętych line items", len(expanded['data']))
+            return expanded['data']
+
+        cached = CheckoutLineItems.get(session['id'])
+        if cached is not None:
+            line_items = loads(cached)
+            logger.debug("Użyto %d line items zapisanych w bazie", len(line_items))
+            return line_items
+        return None
+
+    def iter_checkout_sessions(self, created_from, created_to, starting_after=None):
+        """Zakończone sesje checkout z zakresu dat (od najnowszej), z automatyczną paginacją."""
+        # Line items w tym samym żądaniu co sesje - bez osobnego wywołania dla każdej sesji
+        params = {'limit': 100, 'status': 'complete', 'created': {'gte': created_from, 'lte': created_to},
+                  'expand': ['data.line_items']}
+        if starting_after:
+            params['starting_after'] = starting_after
+        return self.client.checkout.sessions.list(params=params).auto_paging_iter()
+
+    def iter_products(self, active=True, expand_prices=False):
+        params = {'limit': 100}
+        if active is not None:
+            params['active'] = active
+        if expand_prices:
+            # Domyślna cena (kwota, waluta) w tym samym żądaniu co produkt
+            params['expand'] = ['data.default_price']
+        return self.client.products.list(params=params).auto_paging_iter()
+
+    def get_all_products(self, active=True, expand_prices=False):
+        return list(self.iter_products(active, expand_prices))
+
+    def update_product(self, product_id, params, idempotency_key=None):
+        options = {'idempotency_key': idempotency_key} if idempotency_key else {}
+        return self.client.products.update(product_id, params=params, options=options)
+
+    def create_price(self, params, idempotency_key=None):
+        options = {'idempotency_key': idempotency_key} if idempotency_key else {}
+        return self.client.prices.create(params=params, options=options)
+
+    def get_product_events(self, created_after):
+        """Zdarzenia product.* od podanego momentu, od najstarszego."""
+        events = self.client.events.list(params={
+            'limit': 100, 'type': 'product.*', 'created': {'gt': created_after}
+        }).auto_paging_iter()
+        return sorted(events, key=lambda event: event['created'])
+
+
+class AsyncHTTPXClient(stripe.HTTPClient):
+    """Asynchroniczny klient HTTP SDK Stripe na przekazanym httpx.AsyncClient.
+
+    Timeouty, hooki metryk i pulę połączeń ustawia tworzący klienta. Metody synchroniczne
+    nie są obsługiwane (zgłaszają NotImplementedError klasy bazowej).
+    """
+    name = 'httpx-async'
+
+    def __init__(self, client):
+        super().__init__()
+        self.client = client
+
+    async def request_async(self, method, url, headers, post_data=None):
+        response = await self._send(method, url, headers, post_data, stream=False)
+        return response.content, response.status_code, response.headers
+
+    async def request_stream_async(self, method, url, headers, post_data=None):
+        response = await self._send(method, url, headers, post_data, stream=True)
+        return response.aiter_bytes(), response.status_code, response.headers
+
+    async def _send(self, method, url, headers, post_data, stream):
+        request = self.client.build_request(method, url, headers=headers, content=post_data)
         try:
-            products = self.stripe.Product.list(limit=100, active=True)
-            return products.data
+            return await self.client.send(request, stream=stream)
         except Exception as e:
-            logger.error(f"Błąd podczas pobierania produktów ze Stripe: {str(e)}")
-            return []
\ No newline at end of file
+            # Błąd sieci - SDK ponawia żądanie (jak przy wbudowanym HTTPXClient)
+            raise stripe.APIConnectionError(f"Błąd komunikacji ze Stripe ({type(e).__name__}: {e})",
+                                            should_retry=True) from e
+
+    def sleep_async(self, secs):
+        return asyncio.sleep(secs)
+
+    async def close_async(self):
+        await self.client.aclose()
+
+
+class AsyncStripeHandler(StripeHandler):
+    """StripeHandler na asynchronicznym kliencie httpx (metody `*_async` SDK) dla workera asyncio.
+
+    Klient httpx jest związany z pętlą zdarzeń - każda pętla tworzy własną instancję.
+    Ponowienia (z kluczem idempotencji dla POST) wykonuje SDK, a limity per konto Stripe
+    (kubełek tokenów i adaptacyjny limit równoległości) są wspólne z sesjami requests.
+    """
+
+    def __init__(self, api_key, webhook_secret, http_config=None, api_base=None):
+        from .http_pool import DEFAULT_HTTP_CONFIG, create_async_client
+        http_config = dict(DEFAULT_HTTP_CONFIG, **(http_config or {}))
+        self._http_client = AsyncHTTPXClient(create_async_client(
+            http_config, 'stripe', verify=ssl.create_default_context(cafile=stripe.ca_bundle_path)))
+        base_addresses = {'api': api_base} if api_base else {}
+        self.client = stripe.StripeClient(api_key, http_client=self._http_client, base_addresses=base_addresses,
+                                          max_network_retries=http_config['retries'])
+        self.webhook_secret = webhook_secret
+
+    async def aclose(self):
+        await self._http_client.close_async()
+
+    async def process_checkout_session_async(self, session):
+        line_items = await run_db(self._known_line_items, session)
+        if line_items is not None:
+            return line_items
+
+        page = await self.client.checkout.sessions.line_items.list_async(session['id'], params={'limit': 100})
+        line_items = [item async for item in page.auto_paging_iter()]
+        logger.debug("Pobrano %d line items", len(line_items))
+        await run_db(CheckoutLineItems.remember, session['id'], json.dumps(line_items))
+        return line_items
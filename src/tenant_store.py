@@ -0,0 +1,78 @@
+import threading
+import time
+from collections import namedtuple
+from .extensions import db
+from .models import Tenant, CacheVersion
+
+TENANTS_VERSION_KEY = 'tenants'
+
+# Migawka tenanta odłączona od sesji SQLAlchemy - bezpieczna do współdzielenia między wątkami
+TenantSettings = namedtuple('TenantSettings', ['id', 'slug', 'name', 'stripe_account_id',
+                                               'max_concurrency', 'config'])
+
+
+class TenantStore:
+    """Aktywne sklepy (tenanci) trzymane w pamięci procesu.
+
+    Działa jak ConfigStore: wszystkie wiersze są ładowane jednym zapytaniem, a zmiana
+    (CLI `python -m src.tenants`) podbija licznik wersji, który sprawdzamy nie częściej
+    niż co `check_interval` sekund.
+    """
+
+    def __init__(self, check_interval=5):
+        self.check_interval = check_interval
+        self._lock = threading.Lock()
+        self._by_id = None
+        self._by_slug = None
+        self._by_account = None
+        self._version = None
+        self._checked_at = 0.0
+
+    def get(self, tenant_id):
+        return self._ensure_fresh()[0].get(tenant_id)
+
+    def by_slug(self, slug):
+        self._ensure_fresh()
+        return self._by_slug.get(slug)
+
+    def by_stripe_account(self, account_id):
+        if not account_id:
+            return None
+        self._ensure_fresh()
+        return self._by_account.get(account_id)
+
+    def all(self):
+        return list(self._ensure_fresh()[0].values())
+
+    def version(self):
+        return self._ensure_fresh()[1]
+
+    def invalidate(self):
+        CacheVersion.bump(TENANTS_VERSION_KEY)
+        db.session.commit()
+        with self._lock:
+            self._by_id = None
+
+    def _ensure_fresh(self):
+        by_id, version = self._by_id, self._version
+        if by_id is not None and time.monotonic() - self._checked_at < self.check_interval:
+            return by_id, version
+
+        with self._lock:
+            now = time.monotonic()
+            if self._by_id is not None and now - self._checked_at < self.check_interval:
+                return self._by_id, self._version
+            version = CacheVersion.get_version(TENANTS_VERSION_KEY)
+            if self._by_id is None or version != self._version:
+                tenants = [TenantSettings(t.id, t.slug, t.name, t.stripe_account_id, t.max_concurrency,
+                                          t.handler_config())
+                           for t in Tenant.query.filter_by(active=True)]
+                self._by_slug = {t.slug: t for t in tenants}
+                self._by_account = {t.stripe_account_id: t for t in tenants if t.stripe_account_id}
+                self._by_id = {t.id: t for t in tenants}
+                self._version = version
+            self._checked_at = now
+            return self._by_id, self._version
+
+
+tenant_store = TenantStore()
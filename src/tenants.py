@@ -0,0 +1,115 @@
+import argparse
+import getpass
+import sys
+from .extensions import db
+from .models import (Tenant, Product, ProductMapping, CatalogItem, CustomerIndex, SyncState,
+                     DEFAULT_TENANT_ID)
+from .tenant_store import tenant_store
+
+FIELDS = ['name', 'stripe_account_id', 'stripe_api_key', 'stripe_webhook_secret', 'woocommerce_url',
+          'woocommerce_consumer_key', 'woocommerce_consumer_secret', 'max_concurrency']
+# Pola wymagane - brakujące przy `add` są odczytywane interaktywnie (sekrety bez echa)
+REQUIRED_FIELDS = ['woocommerce_url', 'woocommerce_consumer_key', 'woocommerce_consumer_secret', 'stripe_api_key']
+SECRET_FIELDS = ['woocommerce_consumer_secret', 'stripe_api_key', 'stripe_webhook_secret']
+
+
+class UnknownTenantError(LookupError):
+    pass
+
+
+def resolve_tenant_id(slug):
+    """ID sklepu o podanym slugu; brak sluga oznacza sklep z ustawień panelu."""
+    if not slug:
+        return DEFAULT_TENANT_ID
+    tenant = Tenant.query.filter_by(slug=slug).first()
+    if tenant is None:
+        raise UnknownTenantError(f"Nie ma sklepu o slugu {slug!r}")
+    return tenant.id
+
+
+def delete_tenant_data(tenant_id):
+    """Usuwa mapowania, katalog, indeks klientów i kursory synchronizacji sklepu (bez commita)."""
+    product_ids = db.session.query(Product.id).filter_by(tenant_id=tenant_id)
+    ProductMapping.query.filter(ProductMapping.product_id.in_(product_ids)).delete(synchronize_session=False)
+    Product.query.filter_by(tenant_id=tenant_id).delete(synchronize_session=False)
+    CatalogItem.query.filter_by(tenant_id=tenant_id).delete(synchronize_session=False)
+    CustomerIndex.query.filter_by(tenant_id=tenant_id).delete(synchronize_session=False)
+    SyncState.query.filter(SyncState.name.like(f'%:{tenant_id}')).delete(synchronize_session=False)
+
+
+def _apply(tenant, args):
+    for field in FIELDS:
+        value = getattr(args, field)
+        if value is None:
+            continue
+        if field in ('stripe_account_id', 'max_concurrency') and not value:
+            # Pusta wartość / 0 wyłącza routing po koncie Stripe lub indywidualny limit
+            value = None
+        setattr(tenant, field, value)
+    for field in REQUIRED_FIELDS:
+        if not getattr(tenant, field):
+            prompt = getpass.getpass if field in SECRET_FIELDS else input
+            setattr(tenant, field, prompt(f"{field}: "))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Zarządzanie sklepami (tenantami)")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    subparsers.add_parser('list')
+    add_parser = subparsers.add_parser('add')
+    update_parser = subparsers.add_parser('update')
+    for subparser in (add_parser, update_parser):
+        subparser.add_argument('slug', help="Identyfikator w adresie webhooka /webhook/<slug>")
+        subparser.add_argument('--name')
+        subparser.add_argument('--stripe-account-id', help="Konto Stripe Connect kierowane z /webhook")
+        subparser.add_argument('--stripe-api-key')
+        subparser.add_argument('--stripe-webhook-secret')
+        subparser.add_argument('--woocommerce-url')
+        subparser.add_argument('--woocommerce-consumer-key')
+        subparser.add_argument('--woocommerce-consumer-secret')
+        subparser.add_argument('--max-concurrency', type=int,
+                               help="Maks. liczba równoległych webhooków sklepu na proces")
+    update_parser.add_argument('--active', choices=['yes', 'no'])
+    remove_parser = subparsers.add_parser('remove')
+    remove_parser.add_argument('slug')
+    args = parser.parse_args()
+
+    from . import create_app
+    app = create_app(start_workers=False)
+    with app.app_context():
+        if args.command == 'list':
+            for tenant in Tenant.query.order_by(Tenant.id):
+                status = 'aktywny' if tenant.active else 'wyłączony'
+                print(f"{tenant.id:>4}  {tenant.slug:<20} {tenant.name:<30} {tenant.woocommerce_url}  "
+                      f"konto={tenant.stripe_account_id or '-'}  limit={tenant.max_concurrency or '-'}  {status}")
+            return
+
+        tenant = Tenant.query.filter_by(slug=args.slug).first()
+        if args.command == 'add':
+            if tenant is not None:
+                print(f"Sklep {args.slug!r} już istnieje.")
+                sys.exit(1)
+            tenant = Tenant(slug=args.slug, name=args.name or args.slug)
+            db.session.add(tenant)
+        elif tenant is None:
+            print(f"Nie ma sklepu o slugu {args.slug!r}.")
+            sys.exit(1)
+
+        if args.command == 'remove':
+            delete_tenant_data(tenant.id)
+            db.session.delete(tenant)
+        else:
+            _apply(tenant, args)
+            if args.command == 'update' and args.active:
+                tenant.active = args.active == 'yes'
+        tenant_store.invalidate()
+
+        from .product_index import product_index
+        product_index.invalidate()
+        print(f"Zapisano sklep {args.slug!r}." if args.command != 'remove' else f"Usunięto sklep {args.slug!r}.")
+        if args.command == 'add':
+            print(f"Adres webhooka: /webhook/{tenant.slug}")
+
+
+if __name__ == '__main__':
+    main()
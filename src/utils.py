@@ -1,22 +1,30 @@
-from .models import Config
+from .config_store import config_store
+
+CONFIG_KEYS = ['woocommerce_url', 'woocommerce_consumer_key', 'woocommerce_consumer_secret',
+               'stripe_api_key', 'stripe_webhook_secret']
+
 
 def load_config():
+    values = config_store.all()
     config = {
         'woocommerce': {
-            'url': Config.get_value('woocommerce_url'),
-            'consumer_key': Config.get_value('woocommerce_consumer_key'),
-            'consumer_secret': Config.get_value('woocommerce_consumer_secret'),
+            'url': values.get('woocommerce_url'),
+            'consumer_key': values.get('woocommerce_consumer_key'),
+            'consumer_secret': values.get('woocommerce_consumer_secret'),
         },
         'stripe': {
-            'api_key': Config.get_value('stripe_api_key'),
-            'webhook_secret': Config.get_value('stripe_webhook_secret'),
+            'api_key': values.get('stripe_api_key'),
+            'webhook_secret': values.get('stripe_webhook_secret'),
         }
     }
     return config
 
 def save_config(new_config):
-    Config.set_value('woocommerce_url', new_config['woocommerce']['url'])
-    Config.set_value('woocommerce_consumer_key', new_config['woocommerce']['consumer_key'])
-    Config.set_value('woocommerce_consumer_secret', new_config['woocommerce']['consumer_secret'])
-    Config.set_value('stripe_api_key', new_config['stripe']['api_key'])
-    Config.set_value('stripe_webhook_secret', new_config['stripe']['webhook_secret'])
\ No newline at end of file
+    # Wszystkie klucze w jednej transakcji
+    config_store.set_many({
+        'woocommerce_url': new_config['woocommerce']['url'],
+        'woocommerce_consumer_key': new_config['woocommerce']['consumer_key'],
+        'woocommerce_consumer_secret': new_config['woocommerce']['consumer_secret'],
+        'stripe_api_key': new_config['stripe']['api_key'],
+        'stripe_webhook_secret': new_config['stripe']['webhook_secret'],
+    })
@@ -0,0 +1,26 @@
+import argparse
+from . import create_app
+from .handlers import registry
+from .tenants import resolve_tenant_id, UnknownTenantError
+
+
+def warm_customers(tenant=None):
+    app = create_app(start_workers=False)
+    with app.app_context():
+        try:
+            woocommerce_handler = registry.current(resolve_tenant_id(tenant)).woocommerce
+        except UnknownTenantError as e:
+            print(e)
+            return
+        if not woocommerce_handler:
+            print("WooCommerce nie jest skonfigurowany.")
+            return
+
+        count = woocommerce_handler.warm_customer_index()
+        print(f"Zaindeksowano {count} klientów WooCommerce.")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Wstępne wypełnienie indeksu klientów WooCommerce")
+    parser.add_argument('--tenant', help="Slug sklepu (domyślnie sklep z ustawień panelu)")
+    warm_customers(parser.parse_args().tenant)
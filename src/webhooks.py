@@ -0,0 +1,140 @@
+import hashlib
+import hmac
+import json
+import logging
+import re
+import time
+from .models import DEFAULT_TENANT_ID
+from .tenant_store import tenant_store
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover - orjson jest opcjonalny
+    orjson = None
+
+logger = logging.getLogger(__name__)
+
+# Typy eventów, które potrafimy przetworzyć
+SUPPORTED_EVENT_TYPES = frozenset(['checkout.session.completed'])
+
+DEFAULT_WEBHOOK_CONFIG = {
+    # Pozostałe typy są potwierdzane bez dekodowania całego eventu
+    'event_types': ['checkout.session.completed'],
+    # Większe żądania są odrzucane (413) przed odczytem treści
+    'max_payload_bytes': 256 * 1024,
+    # Maksymalny wiek podpisu w sekundach (ochrona przed powtórzeniem żądania)
+    'signature_tolerance': 300,
+}
+
+# Stripe wysyła eventy sformatowane z wcięciem 2 spacji - klucze najwyższego poziomu
+# są jedynymi poprzedzonymi znakiem nowej linii i dokładnie dwiema spacjami
+_TOP_LEVEL_TYPE = re.compile(rb'\n  "type": ?"([^"\\]+)"')
+_TOP_LEVEL_ACCOUNT = re.compile(rb'\n  "account": ?"([^"\\]+)"')
+
+
+class SignatureError(ValueError):
+    pass
+
+
+def loads(payload):
+    """Dekoduje JSON przez orjson, a bez niego przez standardowy moduł json."""
+    if orjson is not None:
+        return orjson.loads(payload)
+    return json.loads(payload)
+
+
+def verify_signature(payload, sig_header, secret, tolerance=300):
+    """Sprawdza nagłówek Stripe-Signature (HMAC-SHA256 z `t.payload`) na surowych bajtach."""
+    if not sig_header:
+        raise SignatureError("Brak nagłówka Stripe-Signature")
+    if not secret:
+        raise SignatureError("Brak sekretu webhooka")
+    timestamp = None
+    signatures = []
+    for item in sig_header.split(','):
+        key, _, value = item.strip().partition('=')
+        if key == 't':
+            timestamp = value
+        elif key == 'v1':
+            signatures.append(value)
+    if not timestamp or not timestamp.isdigit() or not signatures:
+        raise SignatureError("Nieprawidłowy format nagłówka Stripe-Signature")
+
+    expected = hmac.new(secret.encode('utf-8'), timestamp.encode('ascii') + b'.' + payload,
+                        hashlib.sha256).hexdigest()
+    if not any(hmac.compare_digest(expected, signature) for signature in signatures):
+        raise SignatureError("Podpis nie pasuje do treści żądania")
+    if tolerance and int(timestamp) < time.time() - tolerance:
+        raise SignatureError("Podpis jest starszy niż dopuszczalna tolerancja")
+
+
+def verify_signature_any(payload, sig_header, secrets, tolerance=300):
+    """Jak verify_signature, ale wystarczy zgodność z jednym z sekretów."""
+    for secret in secrets[:-1]:
+        try:
+            return verify_signature(payload, sig_header, secret, tolerance)
+        except SignatureError:
+            pass
+    verify_signature(payload, sig_header, secrets[-1] if secrets else None, tolerance)
+
+
+def event_type(payload):
+    """Typ eventu bez dekodowania całego JSON-a (z pełnym dekodowaniem jako zapasem)."""
+    match = _TOP_LEVEL_TYPE.search(payload)
+    if match:
+        return match.group(1).decode('ascii', 'replace')
+    try:
+        event = loads(payload)
+    except ValueError as e:
+        raise ValueError(f"Nieprawidłowy JSON eventu: {e}")
+    if not isinstance(event, dict):
+        raise ValueError("Event nie jest obiektem JSON")
+    return event.get('type')
+
+
+def event_account(payload):
+    """Konto połączone (Stripe Connect) eventu, odczytane przed weryfikacją podpisu."""
+    match = _TOP_LEVEL_ACCOUNT.search(payload)
+    if match:
+        return match.group(1).decode('ascii', 'replace')
+    if b'"account"' not in payload:
+        return None
+    try:
+        event = loads(payload)
+    except ValueError:
+        return None
+    return event.get('account') if isinstance(event, dict) else None
+
+
+def event_tenant(tenant_id, event):
+    """Sklep, do którego należy event odebrany przez adres sklepu `tenant_id`."""
+    if tenant_id == DEFAULT_TENANT_ID:
+        # Eventy kont połączonych (Stripe Connect) trafiają do sklepu przypisanego do konta
+        tenant = tenant_store.by_stripe_account(event.get('account'))
+        if tenant is not None:
+            return tenant.id
+    return tenant_id
+
+
+class WebhookFilter:
+    """Ustawienia wczesnego filtrowania webhooków (sekcja `webhook` w config.yaml)."""
+
+    def __init__(self):
+        self.configure(None)
+
+    def configure(self, webhook_config):
+        config = dict(DEFAULT_WEBHOOK_CONFIG, **(webhook_config or {}))
+        event_types = set(config['event_types'] or ())
+        unsupported = event_types - SUPPORTED_EVENT_TYPES
+        if unsupported:
+            logger.warning("Pominięto nieobsługiwane typy eventów w webhook.event_types: %s",
+                           ', '.join(sorted(unsupported)))
+        self.event_types = frozenset(event_types & SUPPORTED_EVENT_TYPES)
+        self.max_payload_bytes = config['max_payload_bytes']
+        self.signature_tolerance = config['signature_tolerance']
+
+    def accepts(self, event_type):
+        return event_type in self.event_types
+
+
+webhook_filter = WebhookFilter()
@@ -0,0 +1,110 @@
+import requests
+from json import dumps as jsonencode
+from woocommerce import API
+
+
+class _RequestBuilder(API):
+    """Budowanie żądania jak w bibliotece WooCommerce (adres, uwierzytelnienie, treść JSON)."""
+
+    def _build_request(self, method, endpoint, data, params=None, **kwargs):
+        if params is None:
+            params = {}
+        url = self._API__get_url(endpoint)
+        auth = None
+        headers = {
+            "user-agent": self.user_agent,
+            "accept": "application/json"
+        }
+
+        if self.is_ssl and not self.query_string_auth:
+            auth = (self.consumer_key, self.consumer_secret)
+        elif self.is_ssl and self.query_string_auth:
+            params.update({
+                "consumer_key": self.consumer_key,
+                "consumer_secret": self.consumer_secret
+            })
+        else:
+            url = self._API__get_oauth_url(f"{url}?{requests.compat.urlencode(params)}", method, **kwargs)
+            # Podpis OAuth jest już w adresie (httpx zastąpiłby jego query string nawet pustymi `params`)
+            params = None
+
+        if data is not None:
+            data = jsonencode(data, ensure_ascii=False).encode('utf-8')
+            headers["content-type"] = "application/json;charset=utf-8"
+        return url, auth, params, data, headers
+
+
+class PooledAPI(_RequestBuilder):
+    """Klient WooCommerce korzystający ze wspólnej sesji HTTP zamiast `requests.request`.
+
+    Biblioteka WooCommerce otwiera nowe połączenie (i nowy handshake TLS) przy każdym
+    wywołaniu. Tu powtarzamy jej logikę budowania żądania, ale wysyłamy je przez sesję.
+    """
+
+    def __init__(self, url, consumer_key, consumer_secret, session, **kwargs):
+        super().__init__(url, consumer_key, consumer_secret, **kwargs)
+        self.session = session
+
+    def _request(self, method, endpoint, data, params=None, **kwargs):
+        url, auth, params, data, headers = self._build_request(method, endpoint, data, params, **kwargs)
+        return self.session.request(
+            method=method,
+            url=url,
+            verify=self.verify_ssl,
+            auth=auth,
+            params=params,
+            data=data,
+            timeout=self.timeout,
+            headers=headers,
+        )
+
+    def get(self, endpoint, **kwargs):
+        return self._request("GET", endpoint, None, **kwargs)
+
+    def post(self, endpoint, data, **kwargs):
+        return self._request("POST", endpoint, data, **kwargs)
+
+    def put(self, endpoint, data, **kwargs):
+        return self._request("PUT", endpoint, data, **kwargs)
+
+    def delete(self, endpoint, **kwargs):
+        return self._request("DELETE", endpoint, None, **kwargs)
+
+    def options(self, endpoint, **kwargs):
+        return self._request("OPTIONS", endpoint, None, **kwargs)
+
+
+class AsyncPooledAPI(_RequestBuilder):
+    """Asynchroniczny odpowiednik PooledAPI na kliencie `httpx.AsyncClient`.
+
+    Klient jest związany z pętlą zdarzeń, w której go utworzono - każda pętla (wątek
+    workera asyncio) potrzebuje własnej instancji. Limity per host są wspólne z PooledAPI.
+    """
+
+    def __init__(self, url, consumer_key, consumer_secret, http_config=None, **kwargs):
+        from .http_pool import create_async_client
+        super().__init__(url, consumer_key, consumer_secret, **kwargs)
+        self.client = create_async_client(http_config, 'woocommerce', verify=self.verify_ssl)
+
+    async def _request(self, method, endpoint, data, params=None, **kwargs):
+        url, auth, params, data, headers = self._build_request(method, endpoint, data, params, **kwargs)
+        return await self.client.request(
+            method=method,
+            url=url,
+            auth=auth,
+            params=params,
+            content=data,
+            headers=headers,
+        )
+
+    async def get(self, endpoint, **kwargs):
+        return await self._request("GET", endpoint, None, **kwargs)
+
+    async def post(self, endpoint, data, **kwargs):
+        return await self._request("POST", endpoint, data, **kwargs)
+
+    async def put(self, endpoint, data, **kwargs):
+        return await self._request("PUT", endpoint, data, **kwargs)
+
+    async def delete(self, endpoint, **kwargs):
+        return await self._request("DELETE", endpoint, None, **kwargs)
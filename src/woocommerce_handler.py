@@ -1,128 +1,332 @@
 from woocommerce import API
+from .woo_api import PooledAPI
+from .order_batcher import OrderBatcher, OrderBatcherClosed
+from .metrics import WEBHOOK_STAGE_SECONDS
 import logging
-from .models import Product
+from .extensions import db, run_db
+from .models import SyncedSession, CustomerIndex, DEFAULT_TENANT_ID
+from .product_index import product_index
+from .job_queue import JobDeferred
+import asyncio
 import datetime
+import random
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
 
 
 logger = logging.getLogger(__name__)
 
+
+class OrderInProgressError(JobDeferred):
+    """Sesja Stripe (lub jej klient) jest w trakcie przetwarzania przez inny proces."""
+
+
 class WooCommerceHandler:
-    def __init__(self, woo_config):
-        self.wcapi = API(
-            url=woo_config['url'],
-            consumer_key=woo_config['consumer_key'],
-            consumer_secret=woo_config['consumer_secret'],
-            version="wc/v3",
-            timeout=30
-        )
-        logger.info(f"WooCommerceHandler zainicjalizowany z konfiguracją: {woo_config}")
+    # Po tym czasie wpis w indeksie klientów jest ponownie weryfikowany w WooCommerce
+    customer_ttl = datetime.timedelta(days=1)
+    tenant_id = DEFAULT_TENANT_ID
 
-    def get_all_products(self):
-            logger.info("Pobieranie wszystkich produktów z WooCommerce")
-            products = []
-            page = 1
-            per_page = 100
+    def __init__(self, woo_config, page_workers=4, session=None, batching_config=None, customer_ttl=None,
+                 tenant_id=DEFAULT_TENANT_ID):
+        self.tenant_id = tenant_id
+        self.page_workers = page_workers
+        if customer_ttl is not None:
+            self.customer_ttl = customer_ttl
+        if session is not None:
+            # Wspólna pula połączeń keep-alive zamiast nowego połączenia na każde żądanie
+            self.wcapi = PooledAPI(
+                url=woo_config['url'],
+                consumer_key=woo_config['consumer_key'],
+                consumer_secret=woo_config['consumer_secret'],
+                session=session,
+                version="wc/v3",
+                # Timeouty połączenia i odczytu ustawia adapter sesji (http.connect_timeout/read_timeout)
+                timeout=None
+            )
+        else:
+            self.wcapi = API(
+                url=woo_config['url'],
+                consumer_key=woo_config['consumer_key'],
+                consumer_secret=woo_config['consumer_secret'],
+                version="wc/v3",
+                timeout=30
+            )
+        self.batcher = None
+        if batching_config and batching_config.get('enabled'):
+            self.batcher = OrderBatcher(self.wcapi, batching_config)
+        logger.info("WooCommerceHandler zainicjalizowany dla sklepu %s", woo_config['url'])
 
-            while True:
-                try:
-                    response = self.wcapi.get("products", params={
-                        "page": page,
-                        "per_page": per_page,
-                        "status": "publish"  # Pobieramy tylko opublikowane produkty
-                    })
-                    
-                    if response.status_code != 200:
-                        logger.error(f"Błąd podczas pobierania produktów. Status: {response.status_code}, Treść: {response.text}")
-                        break
-
-                    new_products = response.json()
-                    if not new_products:
-                        break
-
-                    products.extend(new_products)
-                    logger.info(f"Pobrano {len(new_products)} produktów ze strony {page}")
-                    
-                    page += 1
-                except Exception as e:
-                    logger.error(f"Wystąpił błąd podczas pobierania produktów: {str(e)}")
-                    break
-
-            logger.info(f"Łącznie pobrano {len(products)} produktów")
-            return products
-
-    def create_order(self, stripe_session, line_items):
-        logger.info(f"Rozpoczęcie tworzenia zamówienia dla sesji: {stripe_session['id']}")
-
-        # Sprawdź istniejące zamówienia z ostatnich 7 dni
-        seven_days_ago = datetime.datetime.now() - datetime.timedelta(days=7)
-        page = 1
+    def close(self):
+        if self.batcher is not None:
+            self.batcher.close()
+
+    def get_all_products(self, status="publish", modified_after=None):
+        logger.info("Pobieranie wszystkich produktów z WooCommerce")
+        products = list(self.iter_products(status, modified_after))
+        logger.info("Łącznie pobrano %d produktów", len(products))
+        return products
+
+    def iter_products(self, status="publish", modified_after=None):
+        for page in self.iter_product_pages(status, modified_after):
+            yield from page
+
+    def iter_product_pages(self, status="publish", modified_after=None):
+        """Zwraca kolejne strony produktów, w kolejności.
+
+        Pierwsza strona mówi (X-WP-TotalPages), ile jest wszystkich stron - pozostałe pobieramy
+        równolegle, trzymając w pamięci najwyżej `page_workers` stron naprzód.
+        """
         per_page = 100
+        params = {"status": status}  # Domyślnie pobieramy tylko opublikowane produkty
+        if modified_after:
+            # Synchronizacja przyrostowa - tylko produkty zmienione od ostatniego razu
+            params.update({"modified_after": modified_after.isoformat(), "dates_are_gmt": "true"})
 
-        while True:
-            try:
-                orders = self.wcapi.get("orders", params={
-                    "after": seven_days_ago.isoformat(),
-                    "page": page,
-                    "per_page": per_page
-                }).json()
-
-                if not orders:
-                    break
-
-                for order in orders:
-                    if "meta_data" in order:
-                        for meta in order['meta_data']:
-                            if meta['key'] == "stripe_session_id" and meta['value'] == stripe_session['id']:
-                                logger.info(f"Zamówienie dla sesji {stripe_session['id']} już istnieje: {order['id']}")
-                                return order
+        response = self._get_products_page(params, 1, per_page)
+        first_page = response.json()
+        if not first_page:
+            return
+        yield first_page
 
+        total_pages = response.headers.get('X-WP-TotalPages')
+        if total_pages is None:
+            # Brak nagłówków - pobieramy sekwencyjnie aż do pustej strony
+            page = 2
+            while True:
+                new_products = self._fetch_products_page(params, page, per_page)
+                if not new_products:
+                    return
+                yield new_products
                 page += 1
-            except Exception as e:
-                logger.error(f"Błąd podczas pobierania zamówień: {str(e)}")
-                break
 
-        logger.info("Tworzenie nowego zamówienia")
+        logger.info("Produktów: %s, stron: %s", response.headers.get('X-WP-Total'), total_pages)
+        pages = iter(range(2, int(total_pages) + 1))
+        with ThreadPoolExecutor(max_workers=self.page_workers) as executor:
+            pending = deque(executor.submit(self._fetch_products_page, params, page, per_page)
+                            for page in islice(pages, self.page_workers))
+            while pending:
+                try:
+                    new_products = pending.popleft().result()
+                except Exception:
+                    # Błąd strony przerywa całe pobieranie - niepełny katalog nie może wyglądać na kompletny
+                    for future in pending:
+                        future.cancel()
+                    raise
+                for page in islice(pages, 1):
+                    pending.append(executor.submit(self._fetch_products_page, params, page, per_page))
+                yield new_products
+
+    def _fetch_products_page(self, params, page, per_page):
+        response = self._get_products_page(params, page, per_page)
+        new_products = response.json()
+        logger.debug("Pobrano %d produktów ze strony %d", len(new_products), page)
+        return new_products
+
+    def _get_products_page(self, params, page, per_page):
+        response = self.wcapi.get("products", params=dict(params, page=page, per_page=per_page))
+        if response.status_code != 200:
+            logger.error("Błąd podczas pobierania produktów. Status: %s, Treść: %s", response.status_code, response.text)
+            raise Exception(f"Błąd podczas pobierania produktów (strona {page}, status {response.status_code})")
+        return response
+
+    def create_order(self, stripe_session, line_items, event_id=None, checked_store=False):
+        """Tworzy zamówienie dla sesji Stripe (raz - rezerwacja w rejestrze SyncedSession).
+
+        `checked_store=True` - wywołujący (np. backfill) sprawdził już sklep, więc skanujemy go
+        tylko po przejęciu istniejącej rezerwacji.
+        """
+        logger.debug("Rozpoczęcie tworzenia zamówienia dla sesji: %s", stripe_session['id'])
+
+        with WEBHOOK_STAGE_SECONDS.time(stage='dedup'):
+            order_id, remote_scan = self._claim_session(stripe_session, event_id, checked_store)
+        if order_id is not None:
+            return {'id': order_id}
+
+        posted = False
         try:
-            customer = self.get_or_create_customer(stripe_session['customer_details'])
-            logger.info(f"Utworzono/znaleziono klienta: {customer['id']}")
+            if remote_scan:
+                with WEBHOOK_STAGE_SECONDS.time(stage='dedup_remote_scan'):
+                    existing_order = self.find_order_by_session(stripe_session['id'], stripe_session.get('created'))
+                if existing_order:
+                    SyncedSession.complete(stripe_session['id'], existing_order['id'])
+                    return existing_order
 
-            logger.info(f"Pobrano line items ze Stripe: {line_items}")
+            with WEBHOOK_STAGE_SECONDS.time(stage='customer'):
+                customer = self.get_or_create_customer(stripe_session['customer_details'])
+            logger.debug("Utworzono/znaleziono klienta: %s", customer['id'])
+            order_data = self.build_order_data(stripe_session, line_items, customer)
 
-            woo_line_items = self.prepare_line_items(line_items)
-            logger.info(f"Przygotowane line items dla WooCommerce: {woo_line_items}")
-
-            order_data = {
-                "payment_method": "stripe",
-                "payment_method_title": "Stripe",
-                "set_paid": True,
-                "status": "completed",
-                "customer_id": customer['id'],
-                "billing": {
-                    "email": stripe_session['customer_details']['email'],
-                    "first_name": stripe_session['customer_details']['name']
-                },
-                "line_items": woo_line_items,
-                "meta_data": [
-                    {"key": "stripe_session_id", "value": stripe_session['id']},
-                    {"key": "stripe_payment_intent", "value": stripe_session['payment_intent']}
-                ]
-            }
+            posted = True
+            new_order = self._post_order(order_data)
+        except Exception:
+            if posted:
+                # Zamówienie mogło powstać mimo błędu (np. timeout odczytu) - rezerwacja zostaje,
+                # a kolejna próba przejmie ją od razu i najpierw sprawdzi sklep
+                SyncedSession.mark_unknown(stripe_session['id'])
+            else:
+                SyncedSession.release(stripe_session['id'])
+            raise
 
-            logger.info(f"Dane zamówienia do wysłania: {order_data}")
-            response = self.wcapi.post("orders", order_data)
-            if response.status_code != 201:
-                logger.error(f"Błąd przy tworzeniu zamówienia. Status: {response.status_code}, Treść: {response.text}")
-                raise Exception(f"Błąd przy tworzeniu zamówienia: {response.text}")
+        SyncedSession.complete(stripe_session['id'], new_order['id'])
+        return new_order
 
-            new_order = response.json()
-            logger.info(f"Utworzono nowe zamówienie: {new_order['id']}")
+    @staticmethod
+    def _claim_session(stripe_session, event_id=None, checked_store=False):
+        """Rezerwuje sesję w rejestrze SyncedSession.
+
+        Zwraca (ID zamówienia, None) dla sesji już zsynchronizowanej, a po rezerwacji
+        (None, czy sprawdzić najpierw sklep).
+        """
+        session_id = stripe_session['id']
+        # Szybkie sprawdzenie w lokalnym rejestrze zsynchronizowanych sesji
+        synced = SyncedSession.lookup(session_id=session_id)
+        if synced and synced.status == SyncedSession.STATUS_COMPLETED:
+            logger.info("Zamówienie dla sesji %s już istnieje: %s", session_id, synced.woo_order_id)
+            return synced.woo_order_id, None
+
+        # Zdalne skanowanie tylko jako fallback: dla sesji sprzed wprowadzenia rejestru
+        # lub przejętej rezerwacji (porzuconej albo z nieznanym wynikiem - zamówienie mogło już powstać)
+        remote_scan = synced is not None or not (checked_store or SyncedSession.covers(stripe_session.get('created')))
+        if not SyncedSession.claim(session_id, event_id):
+            raise OrderInProgressError(f"Sesja {session_id} jest już przetwarzana przez inny proces",
+                                       retry_after=SyncedSession.retry_after(session_id))
+        return None, remote_scan
+
+    def find_order_by_session(self, session_id, created=None, after=None):
+        """Zamówienie sesji w sklepie - od `after` albo z okna wokół utworzenia sesji (najwyżej 7 dni)."""
+        for orders in self.iter_order_pages(after or self._orders_scan_after(created)):
+            order = self._order_for_session(orders, session_id)
+            if order is not None:
+                return order
+        return None
+
+    def iter_order_pages(self, after):
+        """Strony zamówień utworzonych po `after` (UTC), od najnowszych."""
+        page = 1
+        while True:
+            response = self.wcapi.get("orders", params=self._orders_query(after, page))
+            if response.status_code != 200:
+                # Przerwanie skanowania mogłoby skończyć się zduplikowanym zamówieniem
+                raise Exception(f"Błąd podczas pobierania zamówień (strona {page}, status {response.status_code})")
+            orders = response.json()
+            if not orders:
+                return
+            yield orders
+            page += 1
+
+    @staticmethod
+    def _orders_query(after, page, per_page=100):
+        # Daty w UTC (dates_are_gmt) jak w rejestrze SyncedSession, niezależnie od strefy czasowej sklepu
+        return {
+            "after": after.astimezone(datetime.timezone.utc).strftime('%Y-%m-%dT%H:%M:%S'),
+            "dates_are_gmt": "true",
+            "orderby": "date",
+            "order": "desc",
+            "page": page,
+            "per_page": per_page,
+        }
+
+    @staticmethod
+    def _orders_scan_after(created):
+        # Sprawdź istniejące zamówienia z ostatnich 7 dni (lub od dnia przed utworzeniem sesji)
+        seven_days_ago = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(days=7)
+        if created:
+            seven_days_ago = max(seven_days_ago, datetime.datetime.fromtimestamp(created, datetime.timezone.utc)
+                                 - datetime.timedelta(days=1))
+        return seven_days_ago
+
+    @staticmethod
+    def _order_for_session(orders, session_id):
+        for order in orders:
+            if "meta_data" in order:
+                for meta in order['meta_data']:
+                    if meta['key'] == "stripe_session_id" and meta['value'] == session_id:
+                        logger.info("Zamówienie dla sesji %s już istnieje: %s", session_id, order['id'])
+                        return order
+        return None
+
+    def _post_order(self, order_data):
+        try:
+            with WEBHOOK_STAGE_SECONDS.time(stage='order_post'):
+                if self.batcher is not None:
+                    try:
+                        # Tryb paczkowy - zamówienie trafia do wspólnego żądania orders/batch
+                        new_order = self.batcher.create_order(order_data)
+                    except OrderBatcherClosed:
+                        # Handler podmieniony po zmianie ustawień - zamówienie nie zostało wysłane
+                        new_order = self._post_single_order(order_data)
+                else:
+                    new_order = self._post_single_order(order_data)
+            logger.info("Utworzono nowe zamówienie: %s", new_order['id'])
             return new_order
         except Exception as e:
-            logger.error(f"Błąd podczas tworzenia zamówienia: {str(e)}")
+            logger.error("Błąd podczas tworzenia zamówienia: %s", e)
             raise
 
+    def _post_single_order(self, order_data):
+        response = self.wcapi.post("orders", order_data)
+        if response.status_code != 201:
+            logger.error("Błąd przy tworzeniu zamówienia. Status: %s, Treść: %s", response.status_code, response.text)
+            raise Exception(f"Błąd przy tworzeniu zamówienia: {response.text}")
+        return response.json()
+
+    def build_order_data(self, stripe_session, line_items, customer):
+        with WEBHOOK_STAGE_SECONDS.time(stage='prepare_line_items'):
+            woo_line_items = self.prepare_line_items(line_items)
+        logger.debug("Przygotowane line items dla WooCommerce: %s", woo_line_items)
+
+        order_data = {
+            "payment_method": "stripe",
+            "payment_method_title": "Stripe",
+            "set_paid": True,
+            "status": "completed",
+            "customer_id": customer['id'],
+            "billing": {
+                "email": stripe_session['customer_details']['email'],
+                "first_name": stripe_session['customer_details']['name']
+            },
+            "line_items": woo_line_items,
+            "meta_data": [
+                {"key": "stripe_session_id", "value": stripe_session['id']},
+                {"key": "stripe_payment_intent", "value": stripe_session['payment_intent']}
+            ]
+        }
+        logger.debug("Dane zamówienia do wysłania: %s", order_data)
+        return order_data
+
     def get_or_create_customer(self, customer_details):
-        customers = self.wcapi.get("customers", params={"email": customer_details['email']}).json()
+        email = customer_details['email'].strip().lower()
+
+        entry = CustomerIndex.lookup(email, tenant_id=self.tenant_id)
+        if entry and entry.woo_customer_id:
+            if entry.verified_at and datetime.datetime.utcnow() - entry.verified_at < self.customer_ttl:
+                return {'id': entry.woo_customer_id, 'email': email}
+            customer = self._revalidate_customer(email, entry.woo_customer_id)
+            if customer:
+                return customer
+
+        if not CustomerIndex.claim(email, tenant_id=self.tenant_id):
+            # Klienta tworzy właśnie inny proces - czekamy na jego wynik zamiast tworzyć duplikat
+            return self._wait_for_customer(email)
+
+        try:
+            customer = self._find_or_create_customer(customer_details)
+        except Exception:
+            CustomerIndex.release(email, tenant_id=self.tenant_id)
+            raise
+        CustomerIndex.remember(email, customer['id'], tenant_id=self.tenant_id)
+        return customer
+
+    def _find_customers(self, email):
+        response = self.wcapi.get("customers", params={"email": email})
+        if response.status_code != 200:
+            raise Exception(f"Błąd podczas wyszukiwania klienta (status {response.status_code})")
+        return response.json()
+
+    def _find_or_create_customer(self, customer_details):
+        customers = self._find_customers(customer_details['email'])
         if customers:
             return customers[0]
         else:
@@ -131,20 +335,285 @@ class WooCommerceHandler:
                 "first_name": customer_details['name']
             }
             response = self.wcapi.post("customers", customer_data)
-            return response.json()
+            customer = response.json()
+            if response.status_code != 201 and customer.get('code') == 'registration-error-email-exists':
+                return self._find_customers(customer_details['email'])[0]
+            if response.status_code != 201:
+                raise Exception(f"Błąd przy tworzeniu klienta (status {response.status_code}): {response.text}")
+            return customer
+
+    def _revalidate_customer(self, email, customer_id):
+        response = self.wcapi.get(f"customers/{customer_id}")
+        if response.status_code == 429 or response.status_code >= 500:
+            # Chwilowa niedostępność sklepu nie oznacza, że klient zniknął
+            raise Exception(f"Błąd podczas weryfikacji klienta {customer_id} (status {response.status_code})")
+        if response.status_code == 200:
+            customer = response.json()
+            if customer.get('email', '').lower() == email:
+                CustomerIndex.remember(email, customer['id'], tenant_id=self.tenant_id)
+                return customer
+        logger.info("Klient %s dla %s jest nieaktualny - usuwam z indeksu", customer_id, email)
+        CustomerIndex.forget(email, tenant_id=self.tenant_id)
+        return None
+
+    def _wait_for_customer(self, email, timeout=10, interval=0.2):
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            time.sleep(interval)
+            db.session.expire_all()
+            entry = CustomerIndex.lookup(email, tenant_id=self.tenant_id)
+            if entry is None:
+                break
+            if entry.woo_customer_id:
+                return {'id': entry.woo_customer_id, 'email': email}
+        raise OrderInProgressError(f"Klient {email} jest właśnie tworzony przez inny proces",
+                                   retry_after=CustomerIndex.retry_after(email, tenant_id=self.tenant_id))
+
+    def warm_customer_index(self):
+        """Wstępne wypełnienie indeksu klientów na podstawie endpointu customers."""
+        page = 1
+        per_page = 100
+        count = 0
+        while True:
+            response = self.wcapi.get("customers", params={"page": page, "per_page": per_page, "role": "all"})
+            if response.status_code != 200:
+                raise Exception(f"Błąd podczas pobierania klientów: {response.text}")
+            customers = response.json()
+            if not customers:
+                break
+            CustomerIndex.remember_many({
+                customer['email'].strip().lower(): customer['id']
+                for customer in customers if customer.get('email')
+            }, tenant_id=self.tenant_id)
+            count += len(customers)
+            logger.info("Zaindeksowano %d klientów", count)
+            page += 1
+        return count
 
     def prepare_line_items(self, stripe_line_items):
         woo_line_items = []
         for item in stripe_line_items:
-            product = Product.query.filter_by(stripe_id=item['price']['product']).first()
-            if product:
-                woo_product_ids = product.get_woo_product_ids()
-                for woo_product_id in woo_product_ids:
+            templates = product_index.get(item['price']['product'], self.tenant_id)
+            if templates is not None:
+                for template in templates:
                     woo_line_items.append({
-                        "product_id": woo_product_id,
-                        "quantity": item['quantity'],
-                        "total": str(item['amount_total'] / 100 / len(woo_product_ids))
+                        "product_id": template.product_id,
+                        "quantity": item['quantity'] * template.quantity,
+                        "total": str(item['amount_total'] / 100 * template.share)
                     })
             else:
-                logger.error(f"Nie znaleziono mapowania dla produktu Stripe: {item['price']['product']}")
-        return woo_line_items
\ No newline at end of file
+                logger.error("Nie znaleziono mapowania dla produktu Stripe: %s", item['price']['product'])
+        return woo_line_items
+
+
+async def gather_or_cancel(*awaitables):
+    """Jak asyncio.gather, ale błąd jednego wywołania anuluje pozostałe (i czeka na ich sprzątanie)."""
+    tasks = [asyncio.ensure_future(awaitable) for awaitable in awaitables]
+    try:
+        return await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
+
+
+async def timed(stage, awaitable):
+    with WEBHOOK_STAGE_SECONDS.time(stage=stage):
+        return await awaitable
+
+
+class AsyncWooCommerceHandler(WooCommerceHandler):
+    """WooCommerceHandler na asynchronicznym kliencie httpx dla workera asyncio.
+
+    `create_order_async` pobiera line items, szuka klienta i sprawdza duplikat w sklepie
+    równolegle - czas zamówienia to w przybliżeniu czas najwolniejszego z tych wywołań.
+    Klient httpx jest związany z pętlą zdarzeń - każda pętla tworzy własną instancję.
+    """
+
+    def __init__(self, woo_config, http_config=None, customer_ttl=None, tenant_id=DEFAULT_TENANT_ID):
+        import httpx
+        from .http_pool import DEFAULT_HTTP_CONFIG
+        from .woo_api import AsyncPooledAPI
+        super().__init__(woo_config, customer_ttl=customer_ttl, tenant_id=tenant_id)
+        self.http_config = dict(DEFAULT_HTTP_CONFIG, **(http_config or {}))
+        self._httpx = httpx
+        # Kubełek tokenów i adaptacyjny limit równoległości wspólne z sesjami requests (ThrottledAsyncTransport)
+        self.wcapi_async = AsyncPooledAPI(
+            url=woo_config['url'],
+            consumer_key=woo_config['consumer_key'],
+            consumer_secret=woo_config['consumer_secret'],
+            http_config=self.http_config,
+            version="wc/v3",
+        )
+
+    async def aclose(self):
+        await self.wcapi_async.client.aclose()
+
+    async def _get(self, endpoint, params=None):
+        """GET z ponowieniami po 429/5xx i błędach sieci (jak ThrottledAdapter w ścieżce synchronicznej)."""
+        from .http_pool import RETRY_STATUSES, parse_retry_after
+        from .metrics import OUTBOUND_RETRIES
+        config = self.http_config
+        attempt = 0
+        while True:
+            try:
+                response = await self.wcapi_async.get(endpoint, params=dict(params or {}))
+            except (self._httpx.TimeoutException, self._httpx.TransportError) as e:
+                if attempt >= config['retries']:
+                    raise
+                reason = 'timeout' if isinstance(e, self._httpx.TimeoutException) else 'connection'
+                delay = self._backoff(attempt)
+            else:
+                if response.status_code not in RETRY_STATUSES or attempt >= config['retries']:
+                    return response
+                retry_after = parse_retry_after(response.headers.get('Retry-After'))
+                if retry_after is not None and retry_after > config['max_retry_after']:
+                    return response
+                reason = str(response.status_code)
+                delay = max(retry_after or 0, self._backoff(attempt))
+            OUTBOUND_RETRIES.inc(service='woocommerce', reason=reason)
+            await asyncio.sleep(delay)
+            attempt += 1
+
+    def _backoff(self, attempt):
+        cap = min(self.http_config['max_backoff_seconds'], self.http_config['backoff_seconds'] * 2 ** attempt)
+        return random.uniform(0, cap)
+
+    async def create_order_async(self, stripe_session, line_items, event_id=None):
+        """Tworzy zamówienie; `line_items` to awaitable (np. pobieranie line items ze Stripe)."""
+        session_id = stripe_session['id']
+        logger.debug("Rozpoczęcie tworzenia zamówienia dla sesji: %s", session_id)
+
+        try:
+            with WEBHOOK_STAGE_SECONDS.time(stage='dedup'):
+                order_id, remote_scan = await run_db(self._claim_session, stripe_session, event_id)
+        except BaseException:
+            if asyncio.iscoroutine(line_items):
+                line_items.close()
+            raise
+        if order_id is not None:
+            if asyncio.iscoroutine(line_items):
+                line_items.close()
+            return {'id': order_id}
+
+        posted = False
+        try:
+            calls = [timed('list_line_items', line_items),
+                     timed('customer', self.get_or_create_customer_async(stripe_session['customer_details']))]
+            # Zdalne skanowanie tylko jako fallback (jak w create_order)
+            if remote_scan:
+                calls.append(timed('dedup_remote_scan',
+                                   self.find_order_by_session_async(session_id, stripe_session.get('created'))))
+            results = await gather_or_cancel(*calls)
+            existing_order = results[2] if len(results) > 2 else None
+            if existing_order:
+                await run_db(SyncedSession.complete, session_id, existing_order['id'])
+                return existing_order
+
+            # Mapowania produktów odświeżane są z bazy
+            order_data = await run_db(self.build_order_data, stripe_session, results[0], results[1])
+            posted = True
+            with WEBHOOK_STAGE_SECONDS.time(stage='order_post'):
+                response = await self.wcapi_async.post("orders", order_data)
+            if response.status_code != 201:
+                logger.error("Błąd przy tworzeniu zamówienia. Status: %s, Treść: %s", response.status_code, response.text)
+                raise Exception(f"Błąd przy tworzeniu zamówienia: {response.text}")
+            new_order = response.json()
+            logger.info("Utworzono nowe zamówienie: %s", new_order['id'])
+        except BaseException:
+            # Również przy anulowaniu zadania - rezerwacja nie może zostać do wygaśnięcia
+            await run_db(SyncedSession.mark_unknown if posted else SyncedSession.release, session_id)
+            raise
+
+        await run_db(SyncedSession.complete, session_id, new_order['id'])
+        return new_order
+
+    async def find_order_by_session_async(self, session_id, created=None):
+        scan_after = self._orders_scan_after(created)
+        page = 1
+        while True:
+            response = await self._get("orders", params=self._orders_query(scan_after, page))
+            if response.status_code != 200:
+                raise Exception(f"Błąd podczas pobierania zamówień (strona {page}, status {response.status_code})")
+            orders = response.json()
+            if not orders:
+                return None
+            order = self._order_for_session(orders, session_id)
+            if order is not None:
+                return order
+            page += 1
+
+    async def get_or_create_customer_async(self, customer_details):
+        email = customer_details['email'].strip().lower()
+
+        customer_id, verified_at = await run_db(self._index_entry, email) or (None, None)
+        if customer_id:
+            if verified_at and datetime.datetime.utcnow() - verified_at < self.customer_ttl:
+                return {'id': customer_id, 'email': email}
+            customer = await self._revalidate_customer_async(email, customer_id)
+            if customer:
+                return customer
+
+        if not await run_db(CustomerIndex.claim, email, tenant_id=self.tenant_id):
+            return await self._wait_for_customer_async(email)
+
+        try:
+            customer = await self._find_or_create_customer_async(customer_details)
+        except BaseException:
+            await run_db(CustomerIndex.release, email, tenant_id=self.tenant_id)
+            raise
+        await run_db(CustomerIndex.remember, email, customer['id'], tenant_id=self.tenant_id)
+        return customer
+
+    def _index_entry(self, email):
+        """Wpis indeksu klientów jako (woo_customer_id, verified_at) albo None."""
+        entry = CustomerIndex.lookup(email, tenant_id=self.tenant_id)
+        return (entry.woo_customer_id, entry.verified_at) if entry is not None else None
+
+    async def _find_customers_async(self, email):
+        response = await self._get("customers", params={"email": email})
+        if response.status_code != 200:
+            raise Exception(f"Błąd podczas wyszukiwania klienta (status {response.status_code})")
+        return response.json()
+
+    async def _find_or_create_customer_async(self, customer_details):
+        customers = await self._find_customers_async(customer_details['email'])
+        if customers:
+            return customers[0]
+        response = await self.wcapi_async.post("customers", {
+            "email": customer_details['email'],
+            "first_name": customer_details['name']
+        })
+        customer = response.json()
+        if response.status_code != 201 and customer.get('code') == 'registration-error-email-exists':
+            return (await self._find_customers_async(customer_details['email']))[0]
+        if response.status_code != 201:
+            raise Exception(f"Błąd przy tworzeniu klienta (status {response.status_code}): {response.text}")
+        return customer
+
+    async def _revalidate_customer_async(self, email, customer_id):
+        response = await self._get(f"customers/{customer_id}")
+        if response.status_code == 429 or response.status_code >= 500:
+            raise Exception(f"Błąd podczas weryfikacji klienta {customer_id} (status {response.status_code})")
+        if response.status_code == 200:
+            customer = response.json()
+            if customer.get('email', '').lower() == email:
+                await run_db(CustomerIndex.remember, email, customer['id'], tenant_id=self.tenant_id)
+                return customer
+        logger.info("Klient %s dla %s jest nieaktualny - usuwam z indeksu", customer_id, email)
+        await run_db(CustomerIndex.forget, email, tenant_id=self.tenant_id)
+        return None
+
+    async def _wait_for_customer_async(self, email, timeout=10, interval=0.2):
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            await asyncio.sleep(interval)
+            entry = await run_db(self._index_entry, email)
+            if entry is None:
+                break
+            if entry[0]:
+                return {'id': entry[0], 'email': email}
+        raise OrderInProgressError(f"Klient {email} jest właśnie tworzony przez inny proces",
+                                   retry_after=await run_db(CustomerIndex.retry_after, email,
+                                                            tenant_id=self.tenant_id))
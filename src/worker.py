@@ -0,0 +1,21 @@
+from . import create_app
+import os
+import time
+
+
+def run_worker(config_path='src/config/config.yaml'):
+    # Samodzielny proces workera - webhooki przyjmuje aplikacja, tu tylko przetwarzamy kolejkę.
+    # Schemat bazy przygotowuje `python -m src.migrate`.
+    app = create_app(start_workers=False, config_path=config_path, migrate=False)
+    pool = app.extensions['webhook_workers']
+    pool.start()
+    print(f"Workery kolejki webhooków uruchomione ({pool.config['workers']}). Ctrl+C aby zakończyć.")
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pool.stop(timeout=10)
+
+
+if __name__ == '__main__':
+    run_worker(os.environ.get('STRIPEWOO_CONFIG', 'src/config/config.yaml'))
@@ -0,0 +1,16 @@
+"""Produkcyjny punkt wejścia WSGI, np. `gunicorn -w 4 src.wsgi:app`.
+
+Start nie tworzy schematu bazy ani nie ładuje SDK Stripe i WooCommerce - przed
+pierwszym uruchomieniem i po każdej aktualizacji należy wykonać `python -m src.migrate`.
+Ścieżkę pliku konfiguracyjnego można podać w zmiennej STRIPEWOO_CONFIG.
+
+Workery kolejki startują przy pierwszym żądaniu w każdym procesie, a nie przy imporcie -
+przy `gunicorn --preload` import odbywa się w procesie nadrzędnym, a wątki nie przeżywają fork.
+"""
+import os
+from . import create_app
+
+CONFIG_PATH = os.environ.get('STRIPEWOO_CONFIG', 'src/config/config.yaml')
+
+app = create_app(start_workers=False, config_path=CONFIG_PATH, migrate=False)
+app.before_request(app.extensions['webhook_workers'].ensure_started)
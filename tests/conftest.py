@@ -0,0 +1,40 @@
+import pytest
+import yaml
+from src import create_app
+from src.config_store import config_store
+from src.extensions import db
+from src.models import SyncedSession
+
+WEBHOOK_SECRET = 'whsec_test'
+
+
+@pytest.fixture
+def app(tmp_path):
+    """Aplikacja na osobnej bazie SQLite, bez workerów kolejki i dziennika eventów."""
+    config_path = tmp_path / 'config.yaml'
+    config_path.write_text(yaml.safe_dump({
+        'sqlalchemy': {'secret_key': 'test', 'database_url': f"sqlite:///{tmp_path / 'test.db'}"},
+        'event_log': {'enabled': False},
+    }))
+    app = create_app(start_workers=False, config_path=str(config_path))
+    with app.app_context():
+        config_store.set_many({
+            'woocommerce_url': 'https://woo.test',
+            'woocommerce_consumer_key': 'ck_test',
+            'woocommerce_consumer_secret': 'cs_test',
+            'stripe_api_key': 'sk_test_key',
+            'stripe_webhook_secret': WEBHOOK_SECRET,
+        })
+    # Pamięć podręczna z poprzedniej bazy
+    SyncedSession._coverage_start = None
+    yield app
+    with app.app_context():
+        db.session.remove()
+        db.engine.dispose()
+
+
+@pytest.fixture
+def app_context(app):
+    with app.app_context():
+        yield
+        db.session.remove()
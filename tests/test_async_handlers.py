@@ -0,0 +1,101 @@
+import asyncio
+import httpx
+from src.config_store import config_store
+from src.handlers import AsyncHandlerCache, registry
+from src.metrics import API_CALLS_PER_WEBHOOK, count_api_calls, httpx_hooks
+
+
+def is_closed(handlers):
+    return handlers.woocommerce.wcapi_async.client.is_closed, handlers.stripe._http_client.client.is_closed
+
+
+def test_replaced_handlers_close_after_last_use(app_context):
+    cache = AsyncHandlerCache(registry)
+
+    async def scenario():
+        async with cache.use() as old:
+            config_store.set_many({'woocommerce_url': 'https://other.test'})
+            async with cache.use() as new:
+                assert new is not old
+                # Stare handlery obsługują jeszcze zadanie w toku
+                assert is_closed(old) == (False, False)
+            assert is_closed(new) == (False, False)
+        assert is_closed(old) == (True, True)
+        await cache.aclose()
+        assert is_closed(new) == (True, True)
+
+    asyncio.run(scenario())
+
+
+def test_unused_replaced_handlers_close_at_once(app_context):
+    cache = AsyncHandlerCache(registry)
+
+    async def scenario():
+        async with cache.use() as old:
+            pass
+        config_store.set_many({'woocommerce_url': 'https://other.test'})
+        async with cache.use():
+            assert is_closed(old) == (True, True)
+        await cache.aclose()
+
+    asyncio.run(scenario())
+
+
+def test_api_calls_are_counted_per_webhook_task(monkeypatch):
+    observed = []
+    monkeypatch.setattr(API_CALLS_PER_WEBHOOK, 'observe', lambda value, **labels: observed.append(value))
+
+    async def webhook(client, calls):
+        with count_api_calls():
+            # Żądania z zadań potomnych (jak gather_or_cancel) liczą się do webhooka
+            await asyncio.gather(*(client.get('https://woo.test/wp-json/wc/v3/orders') for _ in range(calls)))
+
+    async def scenario():
+        async with httpx.AsyncClient(transport=httpx.MockTransport(lambda request: httpx.Response(200)),
+                                     event_hooks=httpx_hooks('woocommerce')) as client:
+            await asyncio.gather(webhook(client, 1), webhook(client, 3))
+
+    asyncio.run(scenario())
+    assert sorted(observed) == [1, 3]
+
+
+def test_async_transport_shares_host_limits():
+    from src.http_pool import DEFAULT_HTTP_CONFIG, ThrottledAsyncTransport, host_limits, service_limits
+    http_config = dict(DEFAULT_HTTP_CONFIG, limits={'woocommerce': {'max_concurrency': 4}})
+    transport = ThrottledAsyncTransport('woocommerce', http_config, httpx.MockTransport(
+        lambda request: httpx.Response(429, headers={'Retry-After': '0'})))
+
+    async def scenario():
+        async with httpx.AsyncClient(transport=transport) as client:
+            response = await client.post('https://limits-async.test/wp-json/wc/v3/orders', content=b'{}')
+        assert response.status_code == 429
+
+    asyncio.run(scenario())
+    # Ten sam stan co w sesjach requests tego hosta (ThrottledAdapter)
+    limits = host_limits('limits-async.test', service_limits('woocommerce', http_config))
+    assert limits.limiter.limit == 2 and limits.limiter._in_flight == 0
+
+
+def test_async_limiter_waits_for_release_from_thread():
+    import threading
+    from src.http_pool import AdaptiveLimiter
+    limiter = AdaptiveLimiter(1)
+    limiter.acquire()
+
+    async def scenario():
+        waiting = asyncio.ensure_future(limiter.acquire_async())
+        await asyncio.sleep(0.05)
+        assert not waiting.done()
+        threading.Thread(target=limiter.release).start()
+        await asyncio.wait_for(waiting, 1)
+
+    asyncio.run(scenario())
+    assert limiter._in_flight == 1
+
+
+def test_async_woocommerce_client_honours_verify_ssl():
+    import ssl
+    from src.woo_api import AsyncPooledAPI
+    api = AsyncPooledAPI('https://woo.test', 'ck_test', 'cs_test', verify_ssl=False)
+    assert api.client._transport.transport._pool._ssl_context.verify_mode == ssl.CERT_NONE
+    asyncio.run(api.client.aclose())
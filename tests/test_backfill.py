@@ -0,0 +1,58 @@
+import datetime
+from src.backfill import StoreOrders, find_missing
+from src.models import SyncedSession
+from src.woocommerce_handler import WooCommerceHandler
+
+UTC = datetime.timezone.utc
+NOW = datetime.datetime(2024, 10, 10, 12, 0, tzinfo=UTC)
+
+
+def session(session_id, days_ago):
+    return {'id': session_id, 'created': int((NOW - datetime.timedelta(days=days_ago)).timestamp())}
+
+
+def order(order_id, session_id, days_ago):
+    created = NOW - datetime.timedelta(days=days_ago)
+    return {'id': order_id, 'date_created_gmt': created.strftime('%Y-%m-%dT%H:%M:%S'),
+            'meta_data': [{'key': 'stripe_session_id', 'value': session_id}]}
+
+
+class FakeHandler:
+    def __init__(self, pages):
+        self.pages = pages
+        self.read = 0
+
+    def iter_order_pages(self, after):
+        for page in self.pages:
+            self.read += 1
+            yield page
+
+
+def test_store_orders_are_read_only_as_far_as_the_sessions_need():
+    handler = FakeHandler([
+        [order(3, 'cs_new', 0), order(2, 'cs_mid', 3)],
+        [order(1, 'cs_old', 8)],
+    ])
+    store_orders = StoreOrders(handler, session('cs_first', 9)['created'])
+    assert store_orders.after == NOW - datetime.timedelta(days=10)
+
+    assert store_orders.find([session('cs_new', 0), session('cs_none', 1)]) == {'cs_new': 3}
+    assert handler.read == 1
+    # Starsza paczka sesji doczytuje kolejne strony
+    assert store_orders.find([session('cs_old', 8), session('cs_mid', 3)]) == {'cs_old': 1, 'cs_mid': 2}
+    assert handler.read == 2
+
+
+def test_orders_query_uses_utc():
+    warsaw = datetime.timezone(datetime.timedelta(hours=2))
+    query = WooCommerceHandler._orders_query(datetime.datetime(2024, 10, 1, 2, 30, tzinfo=warsaw), 3)
+    assert query['after'] == '2024-10-01T00:30:00'
+    assert (query['dates_are_gmt'], query['order'], query['page']) == ('true', 'desc', 3)
+
+
+def test_find_missing_skips_completed_sessions(app_context):
+    SyncedSession.claim('cs_done')
+    SyncedSession.complete('cs_done', 10)
+    SyncedSession.claim('cs_pending')
+    sessions = [{'id': 'cs_done'}, {'id': 'cs_pending'}, {'id': 'cs_new'}]
+    assert [s['id'] for s in find_missing(sessions)] == ['cs_pending', 'cs_new']
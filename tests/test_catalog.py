@@ -0,0 +1,69 @@
+import datetime
+import threading
+import time
+from src.catalog import CatalogSync, STRIPE_CURSOR, WOO_CURSOR
+from src.extensions import db
+from src.models import CatalogItem, SyncState
+
+
+class FakeStripe:
+    def __init__(self, *products):
+        self.products = list(products)
+
+    def iter_products(self, active=None):
+        return [{'id': product_id, 'name': product_id, 'active': True, 'updated': int(time.time())}
+                for product_id in self.products]
+
+
+class FakeWoo:
+    def __init__(self, *products):
+        self.products = list(products)
+
+    def iter_product_pages(self, status="publish", modified_after=None):
+        if status == "trash":
+            return iter([])
+        return iter([[{'id': product_id, 'name': f"Produkt {product_id}", 'status': 'publish'}
+                      for product_id in self.products]])
+
+
+def catalog(source):
+    return sorted(item.external_id for item in CatalogItem.query.filter_by(source=source))
+
+
+def test_full_sync_purges_deleted_products(app_context):
+    sync = CatalogSync()
+    sync.refresh(FakeWoo(1, 2), FakeStripe('prod_A', 'prod_B'))
+    assert catalog(CatalogItem.SOURCE_STRIPE) == ['prod_A', 'prod_B']
+
+    # Kursory usunięte - kolejna synchronizacja jest pełna
+    SyncState.query.delete()
+    db.session.commit()
+    sync.refresh(FakeWoo(2), FakeStripe('prod_B'))
+    assert catalog(CatalogItem.SOURCE_STRIPE) == ['prod_B']
+    assert catalog(CatalogItem.SOURCE_WOO) == ['2']
+
+
+def test_stale_catalog_starts_one_background_refresh(app, app_context, monkeypatch):
+    sync = CatalogSync(ttl=60)
+    for name in (WOO_CURSOR, STRIPE_CURSOR):
+        SyncState.set(name, datetime.datetime.utcnow().isoformat())
+    SyncState.query.update({'updated_at': datetime.datetime.utcnow() - datetime.timedelta(minutes=5)})
+    db.session.commit()
+
+    release = threading.Event()
+    calls = []
+
+    def refresh(woo_handler, stripe_handler, blocking=True, tenant_id=0):
+        calls.append(tenant_id)
+        release.wait(5)
+
+    monkeypatch.setattr(sync, 'refresh', refresh)
+    for _ in range(3):
+        sync.ensure_fresh(app, None, None)
+    release.set()
+    for _ in range(50):
+        if not sync._refreshing:
+            break
+        time.sleep(0.01)
+    assert calls == [0]
+    assert not sync._refreshing
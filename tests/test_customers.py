@@ -0,0 +1,102 @@
+import datetime
+import pytest
+from src.extensions import db
+from src.models import CustomerIndex
+from src.woocommerce_handler import WooCommerceHandler
+
+DETAILS = {'email': ' Jan@Example.com ', 'name': 'Jan'}
+
+
+class Response:
+    def __init__(self, status_code, body):
+        self.status_code = status_code
+        self.body = body
+        self.text = str(body)
+
+    def json(self):
+        return self.body
+
+
+class FakeWcapi:
+    def __init__(self, customers=None):
+        self.customers = dict(customers or {})
+        self.calls = []
+
+    def get(self, endpoint, params=None):
+        self.calls.append(('GET', endpoint))
+        if endpoint == 'customers':
+            return Response(200, [c for c in self.customers.values() if c['email'] == params['email'].strip().lower()])
+        customer = self.customers.get(int(endpoint.split('/')[1]))
+        return Response(200, customer) if customer else Response(404, {'code': 'woocommerce_rest_invalid_id'})
+
+    def post(self, endpoint, data):
+        self.calls.append(('POST', endpoint))
+        customer = {'id': max(self.customers, default=0) + 1, 'email': data['email']}
+        self.customers[customer['id']] = customer
+        return Response(201, customer)
+
+
+def make_handler(wcapi, tenant_id=0):
+    handler = WooCommerceHandler({'url': 'https://woo.test', 'consumer_key': 'ck', 'consumer_secret': 'cs'},
+                                 tenant_id=tenant_id)
+    handler.wcapi = wcapi
+    return handler
+
+
+def age_index(days):
+    CustomerIndex.query.update({'verified_at': datetime.datetime.utcnow() - datetime.timedelta(days=days)})
+    db.session.commit()
+
+
+def test_known_customer_is_served_from_the_index(app_context):
+    wcapi = FakeWcapi()
+    handler = make_handler(wcapi)
+    assert handler.get_or_create_customer(DETAILS)['id'] == 1
+    wcapi.calls.clear()
+    assert handler.get_or_create_customer(DETAILS) == {'id': 1, 'email': 'jan@example.com'}
+    assert wcapi.calls == []
+
+
+def test_stale_entry_is_revalidated(app_context):
+    wcapi = FakeWcapi({7: {'id': 7, 'email': 'jan@example.com'}})
+    CustomerIndex.remember('jan@example.com', 7)
+    age_index(2)
+    assert make_handler(wcapi).get_or_create_customer(DETAILS)['id'] == 7
+    assert wcapi.calls == [('GET', 'customers/7')]
+    assert datetime.datetime.utcnow() - CustomerIndex.lookup('jan@example.com').verified_at < datetime.timedelta(1)
+
+
+def test_deleted_customer_is_created_again(app_context):
+    wcapi = FakeWcapi()
+    CustomerIndex.remember('jan@example.com', 7)
+    age_index(2)
+    assert make_handler(wcapi).get_or_create_customer(DETAILS)['id'] == 1
+    assert CustomerIndex.lookup('jan@example.com').woo_customer_id == 1
+
+
+def test_store_outage_keeps_the_entry(app_context):
+    wcapi = FakeWcapi()
+    wcapi.get = lambda endpoint, params=None: Response(503, {})
+    CustomerIndex.remember('jan@example.com', 7)
+    age_index(2)
+    with pytest.raises(Exception, match='503'):
+        make_handler(wcapi).get_or_create_customer(DETAILS)
+    assert CustomerIndex.lookup('jan@example.com').woo_customer_id == 7
+
+
+def test_claim_is_exclusive_until_stale(app_context):
+    assert CustomerIndex.claim('jan@example.com')
+    assert not CustomerIndex.claim('jan@example.com')
+    assert CustomerIndex.retry_after('jan@example.com') > 0
+    # Proces, który zarezerwował adres, padł - rezerwację można przejąć
+    CustomerIndex.query.update({'claimed_at': datetime.datetime.utcnow() - CustomerIndex.STALE_AFTER})
+    db.session.commit()
+    assert CustomerIndex.retry_after('jan@example.com') == 0
+    assert CustomerIndex.claim('jan@example.com')
+
+
+def test_index_is_kept_per_store(app_context):
+    make_handler(FakeWcapi({5: {'id': 5, 'email': 'jan@example.com'}})).get_or_create_customer(DETAILS)
+    make_handler(FakeWcapi(), tenant_id=2).get_or_create_customer(DETAILS)
+    assert CustomerIndex.lookup('jan@example.com').woo_customer_id == 5
+    assert CustomerIndex.lookup('jan@example.com', tenant_id=2).woo_customer_id == 1
@@ -0,0 +1,36 @@
+import os
+from src.event_log import EventLog, read_events
+
+HEADERS = {'Content-Type': 'application/json', 'Stripe-Signature': 't=1,v1=abc'}
+
+
+def make_log(directory):
+    log = EventLog()
+    log.configure({'enabled': True, 'directory': str(directory)})
+    return log
+
+
+def test_records_are_written_and_compressed(tmp_path):
+    # Segment procesu, który już nie działa, kompresuje wątek zapisujący
+    orphan = tmp_path / 'segment-1000-999999999.jsonl'
+    orphan.write_text('{"received_at": 1.0, "type": null, "path": "/webhook", "body": "{}"}\n')
+    log = make_log(tmp_path)
+    log.append(HEADERS, b'{"id": "evt_1"}', '/webhook', 0, 'checkout.session.completed', 'evt_1')
+    log.close()
+
+    assert not orphan.exists()
+    assert all(name.endswith('.jsonl.gz') for name in os.listdir(tmp_path))
+    records = list(read_events(str(tmp_path)))
+    assert [record['type'] for record in records] == [None, 'checkout.session.completed']
+    assert records[1]['headers'] == {'Content-Type': 'application/json'}
+
+
+def test_append_never_fails_the_request(tmp_path):
+    # Katalog dziennika nie może powstać - w miejscu katalogu jest plik
+    blocked = tmp_path / 'blocked'
+    blocked.write_text('')
+    log = make_log(blocked / 'event_log')
+    log.append(HEADERS, b'{"id": "evt_1"}', '/webhook', 0, 'checkout.session.completed', 'evt_1')
+    log.append(HEADERS, b'\xff', '/webhook', 0, 'checkout.session.completed', 'evt_2')
+    log.close()
+    assert log.dropped == 1
@@ -0,0 +1,93 @@
+import time
+import pytest
+import requests
+from requests.adapters import HTTPAdapter
+from requests.structures import CaseInsensitiveDict
+from src.http_pool import AdaptiveLimiter, TokenBucket, create_session
+
+HTTP_CONFIG = {'backoff_seconds': 0, 'max_retry_after': 5}
+
+
+class FakeBackend:
+    """Zastępuje HTTPAdapter.send - kolejne odpowiedzi to (status, nagłówki) albo wyjątek."""
+
+    def __init__(self, *responses):
+        self.responses = list(responses)
+        self.requests = []
+
+    def __call__(self, request, **kwargs):
+        self.requests.append(request)
+        result = self.responses.pop(0)
+        if isinstance(result, Exception):
+            raise result
+        status_code, headers = result if isinstance(result, tuple) else (result, {})
+        response = requests.Response()
+        response.status_code = status_code
+        response.headers = CaseInsensitiveDict(headers)
+        response.request = request
+        response._content = b'{}'
+        response._content_consumed = True
+        return response
+
+
+@pytest.fixture
+def backend(monkeypatch):
+    def install(*responses):
+        fake = FakeBackend(*responses)
+        monkeypatch.setattr(HTTPAdapter, 'send', lambda adapter, request, **kwargs: fake(request, **kwargs))
+        return fake
+    return install
+
+
+def test_token_bucket_allows_burst_then_waits():
+    bucket = TokenBucket(rate=20, burst=2)
+    started = time.monotonic()
+    bucket.acquire()
+    bucket.acquire()
+    assert time.monotonic() - started < 0.04
+    bucket.acquire()
+    assert time.monotonic() - started >= 0.04
+
+
+def test_limiter_halves_once_per_interval_and_grows_back():
+    limiter = AdaptiveLimiter(8, decrease_interval=60)
+    for _ in range(2):
+        limiter.acquire()
+        limiter.release(throttled=True)
+    # Seria równoległych 429 obniża limit tylko raz
+    assert limiter.limit == 4
+    # Po udanej odpowiedzi limit rośnie o 1/limit - o jedno żądanie na pełną rundę
+    for _ in range(5):
+        limiter.acquire()
+        limiter.release()
+    assert int(limiter.limit) == 5
+
+
+def test_idempotent_request_is_retried(backend):
+    fake = backend(503, requests.exceptions.ConnectTimeout(), 200)
+    response = create_session(HTTP_CONFIG, 'woocommerce').get('https://retry.test/wp-json/wc/v3/orders')
+    assert response.status_code == 200 and len(fake.requests) == 3
+
+
+def test_woocommerce_post_is_retried_only_after_429(backend):
+    session = create_session(HTTP_CONFIG, 'woocommerce')
+    fake = backend(500)
+    assert session.post('https://post.test/wp-json/wc/v3/orders', json={}).status_code == 500
+    assert len(fake.requests) == 1
+    fake = backend((429, {'Retry-After': '0'}), 201)
+    assert session.post('https://post.test/wp-json/wc/v3/orders', json={}).status_code == 201
+    assert len(fake.requests) == 2
+
+
+def test_stripe_post_keeps_its_idempotency_key(backend):
+    fake = backend(500, 200)
+    create_session(HTTP_CONFIG, 'stripe').post('https://stripe.test/v1/customers', data={'email': 'a@b.c'})
+    keys = [request.headers['Idempotency-Key'] for request in fake.requests]
+    assert len(keys) == 2 and keys[0] == keys[1]
+
+
+def test_long_retry_after_is_returned_to_the_caller(backend):
+    fake = backend((429, {'Retry-After': '120'}))
+    session = create_session(dict(HTTP_CONFIG, max_retry_after=0.01), 'stripe')
+    assert session.get('https://pause.test/v1/products').status_code == 429
+    assert len(fake.requests) == 1
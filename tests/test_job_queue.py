@@ -0,0 +1,174 @@
+import asyncio
+import datetime
+import json
+import pytest
+from src.extensions import db
+from src.job_queue import (AsyncWorkerPool, JobDeferred, WorkerPool, claim_next_job, enqueue_event,
+                           purge_done_jobs)
+from src.models import WebhookJob
+
+CONFIG = {'max_attempts': 3, 'backoff_seconds': 5, 'max_backoff_seconds': 900, 'visibility_timeout': 300}
+
+
+def payload(session_id='cs_1'):
+    return json.dumps({'id': 'evt', 'type': 'checkout.session.completed', 'data': {'object': {'id': session_id}}})
+
+
+def job(event_id='evt_1'):
+    return WebhookJob.query.filter_by(event_id=event_id).one()
+
+
+def make_due(event_id='evt_1'):
+    WebhookJob.query.filter_by(event_id=event_id).update({'next_attempt_at': datetime.datetime.utcnow()})
+    db.session.commit()
+
+
+def abandon(event_id='evt_1'):
+    # Worker padł w trakcie przetwarzania - blokada wygasła
+    WebhookJob.query.filter_by(event_id=event_id).update({
+        'locked_at': datetime.datetime.utcnow() - datetime.timedelta(seconds=CONFIG['visibility_timeout'] + 1)})
+    db.session.commit()
+
+
+class Processor:
+    def __init__(self, *errors):
+        self.errors = list(errors)
+        self.events = []
+
+    def __call__(self, event, tenant_id):
+        self.events.append((event['data']['object']['id'], tenant_id))
+        if self.errors:
+            raise self.errors.pop(0)
+
+
+def test_enqueue_ignores_duplicate_events(app_context):
+    assert enqueue_event('evt_1', 'checkout.session.completed', payload())
+    assert not enqueue_event('evt_1', 'checkout.session.completed', payload())
+    assert WebhookJob.query.count() == 1
+
+
+def test_successful_job_is_done(app, app_context):
+    processor = Processor()
+    enqueue_event('evt_1', 'checkout.session.completed', payload(), tenant_id=4)
+    assert WorkerPool(app, processor, CONFIG).run_once()
+    assert processor.events == [('cs_1', 4)]
+    assert job().status == WebhookJob.STATUS_DONE
+    assert not WorkerPool(app, processor, CONFIG).run_once()
+
+
+def test_failed_job_backs_off_and_is_dead_lettered(app, app_context):
+    pool = WorkerPool(app, Processor(*[Exception('sklep niedostępny')] * 3), CONFIG)
+    enqueue_event('evt_1', 'checkout.session.completed', payload())
+
+    assert pool.run_once()
+    failed = job()
+    assert (failed.status, failed.attempts, failed.last_error) == (WebhookJob.STATUS_QUEUED, 1, 'sklep niedostępny')
+    delay = (failed.next_attempt_at - datetime.datetime.utcnow()).total_seconds()
+    assert CONFIG['backoff_seconds'] - 2 < delay <= CONFIG['backoff_seconds']
+    # Przed upływem opóźnienia zadanie nie jest pobierane
+    assert not pool.run_once()
+
+    make_due()
+    pool.run_once()
+    delay = (job().next_attempt_at - datetime.datetime.utcnow()).total_seconds()
+    assert CONFIG['backoff_seconds'] * 2 - 2 < delay <= CONFIG['backoff_seconds'] * 2
+
+    make_due()
+    pool.run_once()
+    assert (job().status, job().attempts) == (WebhookJob.STATUS_DEAD, 3)
+
+
+def test_deferred_job_does_not_use_an_attempt(app, app_context):
+    pool = WorkerPool(app, Processor(JobDeferred('zajęte', retry_after=120)), CONFIG)
+    enqueue_event('evt_1', 'checkout.session.completed', payload())
+    pool.run_once()
+    deferred = job()
+    assert (deferred.status, deferred.attempts) == (WebhookJob.STATUS_QUEUED, 0)
+    assert (deferred.next_attempt_at - datetime.datetime.utcnow()).total_seconds() > 115
+
+
+@pytest.mark.parametrize('body', ['{"id": "evt"', '{"id": "evt", "data": {}}'])
+def test_malformed_payload_is_retried_and_dead_lettered(app, app_context, body):
+    processor = Processor()
+    pool = WorkerPool(app, processor, CONFIG)
+    enqueue_event('evt_1', 'checkout.session.completed', body)
+    for _ in range(CONFIG['max_attempts']):
+        make_due()
+        assert pool.run_once()
+    assert job().status == WebhookJob.STATUS_DEAD
+    assert processor.events == []
+
+
+def test_abandoned_job_is_reclaimed_then_dead_lettered(app_context):
+    enqueue_event('evt_1', 'checkout.session.completed', payload())
+    claimed = claim_next_job(CONFIG['visibility_timeout'], max_attempts=2)
+    assert claimed.attempts == 1
+    # Blokada jeszcze ważna - nikt inny nie dostaje zadania
+    assert claim_next_job(CONFIG['visibility_timeout'], max_attempts=2) is None
+
+    abandon()
+    assert claim_next_job(CONFIG['visibility_timeout'], max_attempts=2).attempts == 2
+
+    abandon()
+    assert claim_next_job(CONFIG['visibility_timeout'], max_attempts=2) is None
+    db.session.expire_all()
+    assert job().status == WebhookJob.STATUS_DEAD
+    assert job().locked_at is None
+
+
+def test_tenant_limit_leaves_room_for_other_stores(app, app_context):
+    pool = WorkerPool(app, Processor(), dict(CONFIG, tenant_concurrency=1))
+    enqueue_event('evt_1', 'checkout.session.completed', payload('cs_1'), tenant_id=1)
+    enqueue_event('evt_2', 'checkout.session.completed', payload('cs_2'), tenant_id=1)
+    enqueue_event('evt_3', 'checkout.session.completed', payload('cs_3'), tenant_id=2)
+
+    first = pool._claim()
+    second = pool._claim()
+    assert (first.tenant_id, second.tenant_id) == (1, 2)
+    # Oba sklepy wyczerpały limit
+    assert pool._claim() is None
+
+    pool._release(1)
+    assert pool._claim().event_id == 'evt_2'
+
+
+def test_purge_removes_only_old_done_jobs(app_context):
+    for event_id in ('evt_1', 'evt_2', 'evt_3'):
+        enqueue_event(event_id, 'checkout.session.completed', payload())
+    old = datetime.datetime.utcnow() - datetime.timedelta(days=8)
+    WebhookJob.query.filter(WebhookJob.event_id.in_(['evt_1', 'evt_2'])).update(
+        {'status': WebhookJob.STATUS_DONE, 'created_at': old}, synchronize_session=False)
+    WebhookJob.query.filter_by(event_id='evt_3').update({'status': WebhookJob.STATUS_DONE})
+    db.session.commit()
+    assert purge_done_jobs(7, batch_size=1) == 2
+    assert [j.event_id for j in WebhookJob.query] == ['evt_3']
+
+
+def test_async_pool_fails_malformed_payload(app, app_context):
+    pool = AsyncWorkerPool(app, None, CONFIG)
+    enqueue_event('evt_1', 'checkout.session.completed', '{"id": "evt"')
+    job_id, tenant_id, body = pool._claim_detached()
+
+    async def processor(event, tenant_id):
+        raise AssertionError("procesor nie powinien dostać uszkodzonego eventu")
+
+    asyncio.run(pool._process(processor, job_id, tenant_id, body))
+    db.session.expire_all()
+    failed = job()
+    assert (failed.status, failed.attempts) == (WebhookJob.STATUS_QUEUED, 1)
+    assert failed.last_error
+    assert pool._in_flight[tenant_id] == 0
+
+
+def test_workers_start_once_per_process(app, monkeypatch):
+    pool = WorkerPool(app, Processor(), dict(CONFIG, workers=2, poll_interval=0.05))
+    try:
+        pool.ensure_started()
+        pool.ensure_started()
+        assert len(pool._threads) == 2
+        # Proces potomny po fork (gunicorn --preload) uruchamia własne wątki
+        monkeypatch.setattr('src.job_queue.os.getpid', lambda: -1)
+        pool.ensure_started()
+        assert len(pool._threads) == 2 and pool._started_pid == -1
+    finally:
+        pool.stop(timeout=1)
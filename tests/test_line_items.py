@@ -0,0 +1,58 @@
+import json
+from urllib.parse import parse_qs, urlparse
+import requests
+from requests.adapters import HTTPAdapter
+from src.models import CheckoutLineItems
+from src.stripe_handler import StripeHandler
+
+ITEMS = [{'id': f'li_{i}', 'object': 'item', 'quantity': 1} for i in range(5)]
+
+
+class LineItemsAdapter(HTTPAdapter):
+    """Stripe z line items sesji podzielonymi na strony po `page_size`."""
+
+    def __init__(self, page_size):
+        super().__init__()
+        self.page_size = page_size
+        self.requests = []
+
+    def send(self, request, **kwargs):
+        self.requests.append(request.url)
+        query = parse_qs(urlparse(request.url).query)
+        ids = [item['id'] for item in ITEMS]
+        start = ids.index(query['starting_after'][0]) + 1 if 'starting_after' in query else 0
+        page = ITEMS[start:start + self.page_size]
+        response = requests.Response()
+        response.status_code = 200
+        response.request = request
+        response._content = json.dumps({'object': 'list', 'data': page, 'url': urlparse(request.url).path,
+                                        'has_more': start + self.page_size < len(ITEMS)}).encode('utf-8')
+        return response
+
+
+def make_handler(page_size=2):
+    adapter = LineItemsAdapter(page_size)
+    session = requests.Session()
+    session.mount('https://', adapter)
+    return StripeHandler('sk_test_key', 'whsec_test', session=session), adapter
+
+
+def test_expanded_line_items_need_no_request(app_context):
+    handler, adapter = make_handler()
+    session = {'id': 'cs_1', 'line_items': {'data': ITEMS[:2], 'has_more': False}}
+    assert handler.process_checkout_session(session) == ITEMS[:2]
+    assert adapter.requests == []
+
+
+def test_line_items_are_paged_and_kept_for_retries(app_context):
+    handler, adapter = make_handler()
+    # Rozwinięta lista jest niepełna - pobieramy wszystkie strony
+    session = {'id': 'cs_1', 'line_items': {'data': ITEMS[:2], 'has_more': True}}
+    assert [item['id'] for item in handler.process_checkout_session(session)] == [item['id'] for item in ITEMS]
+    assert len(adapter.requests) == 3 and 'limit=100' in adapter.requests[0]
+
+    adapter.requests.clear()
+    assert len(handler.process_checkout_session({'id': 'cs_1'})) == len(ITEMS)
+    assert adapter.requests == []
+    CheckoutLineItems.forget('cs_1')
+    assert CheckoutLineItems.get('cs_1') is None
@@ -0,0 +1,30 @@
+import logging
+import sys
+from src.logging_setup import NonBlockingQueueHandler, StructuredFormatter
+
+
+def make_record(msg, args, exc_info=None):
+    return logging.LogRecord('test', logging.ERROR, __file__, 1, msg, args, exc_info)
+
+
+def test_prepare_snapshots_message_and_traceback():
+    order = {'id': 1, 'status': 'pending'}
+    try:
+        raise ValueError('brak klienta')
+    except ValueError:
+        record = make_record("Zamówienie %s", (order,), sys.exc_info())
+
+    prepared = NonBlockingQueueHandler(None).prepare(record)
+    # Zmiana argumentu po zalogowaniu nie wpływa na wpis
+    order['status'] = 'completed'
+
+    assert prepared.getMessage() == "Zamówienie {'id': 1, 'status': 'pending'}"
+    assert prepared.args is None and prepared.exc_info is None
+    assert 'ValueError: brak klienta' in StructuredFormatter(as_json=False).format(prepared)
+    # Oryginalny rekord trafia jeszcze do innych handlerów bez zmian
+    assert record.args is order and record.exc_info is not None
+
+
+def test_prepare_keeps_messages_with_percent_signs():
+    prepared = NonBlockingQueueHandler(None).prepare(make_record("Rabat 10% dla %s", None))
+    assert StructuredFormatter(as_json=False).format(prepared) == "ERROR:test:Rabat 10% dla %s"
@@ -0,0 +1,51 @@
+import json
+import pytest
+from src.mapping_io import MappingImportError, export_mappings, import_mappings
+from src.models import Product, ProductMapping
+from src.product_index import LineItemTemplate, product_index
+
+CSV = """stripe_product_id,name,woo_product_id,quantity,price_share
+prod_set,Zestaw,11,2,0.25
+prod_set,Zestaw,12,,
+prod_mug,Kubek,13,1,
+"""
+
+
+def test_import_export_round_trip(app_context):
+    result = import_mappings(CSV)
+    assert result == {'products': 2, 'created_products': 2, 'mappings': 3, 'replaced_mappings': 0}
+    exported = json.loads(export_mappings('json'))
+    assert [(row['stripe_product_id'], row['woo_product_id'], row['quantity']) for row in exported] == [
+        ('prod_mug', 13, 1), ('prod_set', 11, 2), ('prod_set', 12, 1)]
+    assert import_mappings(export_mappings('csv'))['replaced_mappings'] == 3
+
+
+def test_import_replaces_only_products_in_the_file(app_context):
+    import_mappings(CSV)
+    import_mappings("stripe_product_id,woo_product_id\nprod_set,21\n")
+    assert product_index.get('prod_set') == (LineItemTemplate(21, 1, 1.0),)
+    assert product_index.get('prod_mug') == (LineItemTemplate(13, 1, 1.0),)
+
+    import_mappings('[{"stripe_product_id": "prod_set", "woo_product_id": 21}]', fmt='json', replace_all=True)
+    assert [product.stripe_id for product in Product.query.all()] == ['prod_set']
+    assert product_index.get('prod_mug') is None
+
+
+@pytest.mark.parametrize('data, message', [
+    ("stripe_product_id,woo_product_id\n,5\n", 'brak stripe_product_id'),
+    ("stripe_product_id,woo_product_id\nprod_a,abc\n", 'niepoprawna wartość woo_product_id'),
+    ("stripe_product_id,woo_product_id,price_share\nprod_a,1,0.7\nprod_a,2,0.6\n", 'suma price_share'),
+])
+def test_invalid_file_changes_nothing(app_context, data, message):
+    import_mappings(CSV)
+    with pytest.raises(MappingImportError, match=message):
+        import_mappings(data)
+    assert ProductMapping.query.count() == 3
+
+
+def test_mappings_are_kept_per_store(app_context):
+    import_mappings(CSV)
+    import_mappings("stripe_product_id,woo_product_id\nprod_set,31\n", tenant_id=2)
+    assert product_index.get('prod_set', tenant_id=2) == (LineItemTemplate(31, 1, 1.0),)
+    assert product_index.get('prod_set') == (LineItemTemplate(11, 2, 0.25), LineItemTemplate(12, 1, 0.75))
+    assert 'prod_mug' not in export_mappings(tenant_id=2)
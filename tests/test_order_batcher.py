@@ -0,0 +1,101 @@
+import threading
+import time
+import pytest
+from src.models import SyncedSession
+from src.order_batcher import OrderBatcher, OrderBatchError
+from src.woocommerce_handler import WooCommerceHandler
+
+
+class Response:
+    def __init__(self, status_code, body):
+        self.status_code = status_code
+        self.body = body
+        self.text = str(body)
+
+    def json(self):
+        return self.body
+
+
+def order(session_id):
+    return {'line_items': [], 'meta_data': [{'key': 'stripe_session_id', 'value': session_id}]}
+
+
+class FakeStore:
+    """Sklep zwracający wyniki paczki w odwrotnej kolejności; `rejected` - sesje odrzucone przez sklep."""
+
+    def __init__(self, rejected=()):
+        self.rejected = set(rejected)
+        self.requests = []
+
+    def post(self, endpoint, data):
+        self.requests.append(endpoint)
+        if endpoint == 'orders':
+            return Response(201, dict(data, id=500))
+        results = []
+        for index, item in enumerate(data['create']):
+            session_id = item['meta_data'][0]['value']
+            if session_id in self.rejected:
+                results.append({'id': 0, 'error': {'code': 'invalid', 'message': f"odrzucono {session_id}"}})
+            else:
+                results.append(dict(item, id=100 + index))
+        return Response(200, {'create': results[::-1]})
+
+    def get(self, endpoint, params=None):
+        if endpoint == 'customers':
+            return Response(200, [{'id': 7}])
+        return Response(200, [])
+
+
+def create_concurrently(batcher, session_ids):
+    results = {}
+
+    def create(session_id):
+        try:
+            results[session_id] = batcher.create_order(order(session_id))
+        except Exception as e:
+            results[session_id] = e
+
+    threads = [threading.Thread(target=create, args=(session_id,)) for session_id in session_ids]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+def test_batch_results_are_matched_by_session():
+    store = FakeStore(rejected={'cs_2'})
+    batcher = OrderBatcher(store, {'window_ms': 100})
+    results = create_concurrently(batcher, ['cs_1', 'cs_2', 'cs_3'])
+    batcher.close()
+
+    assert store.requests == ['orders/batch']
+    for session_id in ('cs_1', 'cs_3'):
+        assert results[session_id]['meta_data'][0]['value'] == session_id
+    # Odrzucona pozycja nie dostaje zamówienia innej sesji
+    assert isinstance(results['cs_2'], OrderBatchError)
+    assert 'odrzucono cs_2' in str(results['cs_2'])
+
+
+def test_unsent_order_is_withdrawn_after_timeout():
+    store = FakeStore()
+    batcher = OrderBatcher(store, {'window_ms': 2000, 'timeout': 0.1})
+    started = time.monotonic()
+    with pytest.raises(OrderBatchError, match='nie zostało wysłane'):
+        batcher.create_order(order('cs_1'))
+    assert time.monotonic() - started < 1
+    batcher.close()
+    assert store.requests == []
+
+
+def test_closed_batcher_falls_back_to_a_single_order(app_context):
+    handler = WooCommerceHandler({'url': 'https://woo.test', 'consumer_key': 'ck', 'consumer_secret': 'cs'},
+                                 batching_config={'enabled': True})
+    handler.wcapi = handler.batcher.wcapi = FakeStore()
+    # Handler podmieniony po zmianie ustawień, a zadanie jeszcze z niego korzysta
+    handler.close()
+    session = {'id': 'cs_1', 'created': int(time.time()), 'payment_intent': 'pi_1',
+               'customer_details': {'email': 'anna@example.com', 'name': 'Anna'}}
+    assert handler.create_order(session, [])['id'] == 500
+    assert handler.wcapi.requests == ['orders']
+    assert SyncedSession.lookup(session_id='cs_1').status == SyncedSession.STATUS_COMPLETED
@@ -0,0 +1,91 @@
+from src.extensions import db
+from src.mapping_io import import_mappings
+from src.migrate import add_missing_columns
+from src.models import Product
+from src.product_sync import plan_changes, sync_products
+
+
+class FakeWoo:
+    def __init__(self, products):
+        self.products = products
+
+    def get_all_products(self, status="any"):
+        return list(self.products.values())
+
+
+class FakeStripe:
+    def __init__(self, products, fail=()):
+        self.products = products
+        self.fail = set(fail)
+        self.writes = []
+
+    def get_all_products(self, active=None, expand_prices=False):
+        return list(self.products.values())
+
+    def create_price(self, params, idempotency_key=None):
+        self.writes.append(('price', params['product'], idempotency_key))
+        return {'id': f"price_{len(self.writes)}"}
+
+    def update_product(self, product_id, params, idempotency_key=None):
+        if product_id in self.fail:
+            raise Exception("Stripe niedostępny")
+        self.writes.append(('product', product_id, idempotency_key))
+        self.products[product_id].update(params)
+
+
+def stripe_product(product_id, name, unit_amount, currency='pln'):
+    return {'id': product_id, 'name': name, 'active': True, 'updated': 1,
+            'default_price': {'id': f'price_{product_id}', 'currency': currency, 'unit_amount': unit_amount}}
+
+
+def woo_products():
+    return {1: {'id': 1, 'name': 'Kubek &amp; spodek', 'price': '19.99', 'status': 'publish'},
+            2: {'id': 2, 'name': 'Łyżeczka', 'price': '5', 'status': 'publish'},
+            3: {'id': 3, 'name': 'Talerz', 'price': '30', 'status': 'publish'}}
+
+
+def test_only_changed_products_are_written(app_context):
+    import_mappings("stripe_product_id,woo_product_id,quantity\nprod_mug,1,1\nprod_set,2,2\nprod_set,3,1\n"
+                    "prod_plate,3,1\n")
+    stripe = FakeStripe({'prod_mug': stripe_product('prod_mug', 'Kubek', 1999),
+                         'prod_set': stripe_product('prod_set', 'Zestaw', 3000),
+                         'prod_plate': stripe_product('prod_plate', 'Talerz', 3000)})
+    stats = sync_products(FakeWoo(woo_products()), stripe)
+    # Kubek: nowa nazwa, zestaw: nowa cena (2 x 5 + 30), talerz bez zmian
+    assert sorted((kind, product_id) for kind, product_id, _ in stripe.writes) == [
+        ('price', 'prod_set'), ('product', 'prod_mug'), ('product', 'prod_set')]
+    assert stripe.products['prod_mug']['name'] == 'Kubek & spodek'
+    assert (stats['updated'], stats['unchanged'], stats['writes']) == (2, 1, 3)
+
+    # Stan z WooCommerce się nie zmienił - produkty są pomijane bez porównania ze Stripe
+    stripe.writes.clear()
+    assert sync_products(FakeWoo(woo_products()), stripe)['unchanged'] == 3
+    assert stripe.writes == []
+
+
+def test_failed_product_is_retried_with_the_same_key(app_context):
+    import_mappings("stripe_product_id,woo_product_id\nprod_mug,1\n")
+    stripe = FakeStripe({'prod_mug': stripe_product('prod_mug', 'Kubek', 1000)}, fail=['prod_mug'])
+    assert sync_products(FakeWoo(woo_products()), stripe)['failed'] == 1
+    assert Product.query.one().sync_hash is None
+
+    stripe.fail.clear()
+    sync_products(FakeWoo(woo_products()), stripe)
+    price_keys = [key for kind, _, key in stripe.writes if kind == 'price']
+    # Ponowiona cena ma ten sam klucz idempotencji - Stripe nie utworzy drugiej
+    assert len(price_keys) == 2 and price_keys[0] == price_keys[1]
+    assert Product.query.one().sync_hash is not None
+
+
+def test_zero_decimal_currency_and_unpublished_product():
+    state = {'name': None, 'price': '1500', 'active': False}
+    update, new_price = plan_changes(state, stripe_product('prod_a', 'A', 1000, currency='jpy'))
+    assert update == {'active': False}
+    assert new_price == {'product': 'prod_a', 'currency': 'jpy', 'unit_amount': 1500}
+
+
+def test_migration_adds_the_sync_hash_column(app_context):
+    db.session.execute(db.text('ALTER TABLE product DROP COLUMN sync_hash'))
+    db.session.commit()
+    assert 'product.sync_hash' in add_missing_columns()
+    assert add_missing_columns() == []
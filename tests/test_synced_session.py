@@ -0,0 +1,151 @@
+import datetime
+import time
+import pytest
+import requests
+from src.extensions import db
+from src.models import SyncedSession
+from src.woocommerce_handler import WooCommerceHandler, OrderInProgressError
+
+
+def age_claim(session_id, seconds):
+    SyncedSession.query.filter_by(stripe_session_id=session_id).update(
+        {'claimed_at': datetime.datetime.utcnow() - datetime.timedelta(seconds=seconds)})
+    db.session.commit()
+
+
+def test_claim_is_exclusive(app_context):
+    assert SyncedSession.claim('cs_1', 'evt_1')
+    assert not SyncedSession.claim('cs_1', 'evt_2')
+    assert SyncedSession.lookup(session_id='cs_1').stripe_event_id == 'evt_1'
+
+
+def test_stale_claim_is_taken_over(app_context):
+    SyncedSession.claim('cs_1', 'evt_1')
+    age_claim('cs_1', SyncedSession.STALE_AFTER.total_seconds() + 1)
+    assert SyncedSession.claim('cs_1', 'evt_2')
+    # Przejęta rezerwacja jest znowu świeża
+    assert not SyncedSession.claim('cs_1', 'evt_3')
+    db.session.expire_all()
+    assert SyncedSession.lookup(session_id='cs_1').stripe_event_id == 'evt_2'
+
+
+def test_retry_after_counts_down_to_stale(app_context):
+    SyncedSession.claim('cs_1')
+    age_claim('cs_1', 60)
+    expected = SyncedSession.STALE_AFTER.total_seconds() - 60
+    assert expected - 5 < SyncedSession.retry_after('cs_1') <= expected
+    assert SyncedSession.retry_after('cs_unknown') == 0
+
+
+def test_completed_session_cannot_be_claimed(app_context):
+    SyncedSession.claim('cs_1')
+    SyncedSession.complete('cs_1', 10)
+    age_claim('cs_1', SyncedSession.STALE_AFTER.total_seconds() + 1)
+    assert not SyncedSession.claim('cs_1')
+
+
+def test_release_frees_the_session(app_context):
+    SyncedSession.claim('cs_1')
+    SyncedSession.release('cs_1')
+    assert SyncedSession.lookup(session_id='cs_1') is None
+    assert SyncedSession.claim('cs_1')
+
+
+def test_unknown_claim_is_kept_and_taken_over_at_once(app_context):
+    SyncedSession.claim('cs_1')
+    SyncedSession.mark_unknown('cs_1')
+    # Zamówienie mogło powstać - release nie może usunąć takiej rezerwacji
+    SyncedSession.release('cs_1')
+    assert SyncedSession.lookup(session_id='cs_1').status == SyncedSession.STATUS_UNKNOWN
+    assert SyncedSession.claim('cs_1')
+    db.session.expire_all()
+    assert SyncedSession.lookup(session_id='cs_1').status == SyncedSession.STATUS_PENDING
+
+
+class Response:
+    def __init__(self, status_code, body):
+        self.status_code = status_code
+        self.body = body
+        self.text = str(body)
+        self.headers = {}
+
+    def json(self):
+        return self.body
+
+
+class FakeStore:
+    """Atrapa API WooCommerce: zamówienia w pamięci, opcjonalny błąd przy tworzeniu zamówienia."""
+
+    def __init__(self, post_error=None, fail_after_saving=True, customer_error=None):
+        self.orders = []
+        self.post_error = post_error
+        self.fail_after_saving = fail_after_saving
+        self.customer_error = customer_error
+
+    def get(self, endpoint, params=None):
+        if endpoint == 'orders':
+            return Response(200, self.orders if params['page'] == 1 else [])
+        if endpoint == 'customers':
+            if self.customer_error:
+                raise self.customer_error
+            return Response(200, [{'id': 7, 'email': 'anna@example.com'}])
+        return Response(404, {})
+
+    def post(self, endpoint, data):
+        error, self.post_error = self.post_error, None
+        if error and not self.fail_after_saving:
+            raise error
+        order = dict(data, id=len(self.orders) + 1)
+        self.orders.append(order)
+        if error:
+            raise error
+        return Response(201, order)
+
+
+@pytest.fixture
+def handler(app_context):
+    handler = WooCommerceHandler({'url': 'https://woo.test', 'consumer_key': 'ck', 'consumer_secret': 'cs'})
+    # Rejestr działa od wcześniejszej sesji - nowe sesje nie wymagają skanowania sklepu
+    SyncedSession.claim('cs_before')
+    SyncedSession.complete('cs_before', 1000)
+    age_claim('cs_before', 3600)
+    SyncedSession._coverage_start = None
+    return handler
+
+
+def stripe_session(session_id='cs_new'):
+    return {'id': session_id, 'created': int(time.time()), 'payment_intent': 'pi_1',
+            'customer_details': {'email': 'anna@example.com', 'name': 'Anna'}}
+
+
+def test_timeout_after_post_does_not_duplicate_order(handler):
+    handler.wcapi = FakeStore(post_error=requests.exceptions.ReadTimeout('read timeout'))
+    with pytest.raises(requests.exceptions.ReadTimeout):
+        handler.create_order(stripe_session(), [])
+    assert SyncedSession.lookup(session_id='cs_new').status == SyncedSession.STATUS_UNKNOWN
+
+    order = handler.create_order(stripe_session(), [])
+    assert order['id'] == 1
+    assert len(handler.wcapi.orders) == 1
+    db.session.expire_all()
+    assert SyncedSession.lookup(session_id='cs_new').woo_order_id == 1
+
+
+def test_failure_before_post_releases_claim(handler):
+    handler.wcapi = FakeStore(customer_error=requests.exceptions.ConnectionError('refused'))
+    with pytest.raises(requests.exceptions.ConnectionError):
+        handler.create_order(stripe_session(), [])
+    assert SyncedSession.lookup(session_id='cs_new') is None
+
+    handler.wcapi.customer_error = None
+    assert handler.create_order(stripe_session(), [])['id'] == 1
+    assert len(handler.wcapi.orders) == 1
+
+
+def test_session_in_progress_is_deferred(handler):
+    handler.wcapi = FakeStore()
+    SyncedSession.claim('cs_new')
+    with pytest.raises(OrderInProgressError) as error:
+        handler.create_order(stripe_session(), [])
+    assert error.value.retry_after > SyncedSession.STALE_AFTER.total_seconds() - 5
+    assert handler.wcapi.orders == []
@@ -0,0 +1,79 @@
+import pytest
+from src.config_store import config_store
+from src.extensions import db
+from src.models import CatalogItem, DEFAULT_TENANT_ID, Tenant, WebhookJob
+from src.replay import sign
+from src.tenant_store import tenant_store
+from src.tenants import delete_tenant_data
+from .conftest import WEBHOOK_SECRET
+from .test_webhooks import make_event, pretty
+
+SHOP_SECRET = 'whsec_shop'
+
+
+@pytest.fixture
+def shop(app):
+    with app.app_context():
+        tenant = Tenant(slug='shop', name='Shop', stripe_account_id='acct_shop', stripe_api_key='sk_test_shop',
+                        stripe_webhook_secret=SHOP_SECRET, woocommerce_url='https://shop.test',
+                        woocommerce_consumer_key='ck_shop', woocommerce_consumer_secret='cs_shop')
+        db.session.add(tenant)
+        db.session.commit()
+        tenant_store.invalidate()
+        return tenant.id
+
+
+def post(client, path, payload, secret):
+    return client.post(path, data=payload, content_type='application/json',
+                       headers={'Stripe-Signature': sign(payload, secret)})
+
+
+def connect_event(event_id='evt_connect', account='acct_shop'):
+    event = make_event(event_id=event_id)
+    event['account'] = account
+    return pretty(event)
+
+
+def queued_tenants(app):
+    with app.app_context():
+        return {job.event_id: job.tenant_id for job in WebhookJob.query.all()}
+
+
+def test_store_webhook_uses_store_secret(app, shop):
+    client = app.test_client()
+    assert post(client, '/webhook/shop', pretty(make_event()), WEBHOOK_SECRET).status_code == 400
+    assert post(client, '/webhook/shop', pretty(make_event()), SHOP_SECRET).status_code == 200
+    assert post(client, '/webhook/other', pretty(make_event()), SHOP_SECRET).status_code == 404
+    assert queued_tenants(app) == {'evt_1': shop}
+
+
+def test_connect_event_is_routed_to_account_store(app, shop):
+    client = app.test_client()
+    assert post(client, '/webhook', connect_event(), WEBHOOK_SECRET).status_code == 200
+    assert post(client, '/webhook', connect_event('evt_other', 'acct_unknown'), WEBHOOK_SECRET).status_code == 200
+    assert queued_tenants(app) == {'evt_connect': shop, 'evt_other': DEFAULT_TENANT_ID}
+
+
+def test_connect_event_without_default_store(app, shop):
+    with app.app_context():
+        config_store.set_many({'stripe_api_key': '', 'stripe_webhook_secret': ''})
+    client = app.test_client()
+    assert post(client, '/webhook', connect_event(), SHOP_SECRET).status_code == 200
+    # Sekret sklepu nie pozwala podszyć się pod inne konto ani pod sklep domyślny
+    assert post(client, '/webhook', connect_event('evt_other', 'acct_unknown'), SHOP_SECRET).status_code == 500
+    assert queued_tenants(app) == {'evt_connect': shop}
+
+
+def test_forged_account_needs_that_store_secret(app, shop):
+    response = post(app.test_client(), '/webhook', connect_event(), 'whsec_attacker')
+    assert response.status_code == 400
+    assert queued_tenants(app) == {}
+
+
+def test_delete_tenant_data_keeps_other_stores(app_context, shop):
+    for tenant_id in (DEFAULT_TENANT_ID, shop):
+        db.session.add(CatalogItem(tenant_id=tenant_id, source='stripe', external_id='prod_1', name='Kubek'))
+    db.session.commit()
+    delete_tenant_data(shop)
+    db.session.commit()
+    assert [item.tenant_id for item in CatalogItem.query.all()] == [DEFAULT_TENANT_ID]
@@ -0,0 +1,120 @@
+import json
+import time
+import pytest
+from src.models import WebhookJob
+from src.replay import sign
+from src.webhooks import SignatureError, event_type, verify_signature, webhook_filter
+from .conftest import WEBHOOK_SECRET
+
+SECRET = 'whsec_unit'
+
+
+def make_event(event_type='checkout.session.completed', event_id='evt_1'):
+    # Kolejność kluczy jak w eventach Stripe - `type` na końcu, obiekty zagnieżdżone też mają `type`
+    return {
+        'id': event_id,
+        'object': 'event',
+        'data': {'object': {'id': 'cs_test_1', 'object': 'checkout.session',
+                            'payment_method_options': {'card': {'type': 'card'}}}},
+        'livemode': False,
+        'type': event_type,
+    }
+
+
+def pretty(event):
+    return json.dumps(event, indent=2).encode('utf-8')
+
+
+def test_valid_signature():
+    payload = pretty(make_event())
+    verify_signature(payload, sign(payload, SECRET), SECRET)
+
+
+def test_tampered_body_is_rejected():
+    payload = pretty(make_event())
+    header = sign(payload, SECRET)
+    with pytest.raises(SignatureError):
+        verify_signature(payload.replace(b'cs_test_1', b'cs_test_2'), header, SECRET)
+
+
+def test_wrong_secret_is_rejected():
+    payload = pretty(make_event())
+    with pytest.raises(SignatureError):
+        verify_signature(payload, sign(payload, 'whsec_other'), SECRET)
+
+
+def test_any_of_multiple_v1_signatures_is_accepted():
+    # Przy rotacji sekretu Stripe wysyła podpisy starym i nowym sekretem
+    payload = pretty(make_event())
+    timestamp = int(time.time())
+    valid = sign(payload, SECRET, timestamp).split('v1=')[1]
+    verify_signature(payload, f"t={timestamp},v1={'0' * 64},v1={valid}", SECRET)
+    with pytest.raises(SignatureError):
+        verify_signature(payload, f"t={timestamp},v1={'0' * 64},v1={'1' * 64}", SECRET)
+
+
+def test_expired_timestamp_is_rejected():
+    payload = pretty(make_event())
+    header = sign(payload, SECRET, int(time.time()) - 301)
+    with pytest.raises(SignatureError):
+        verify_signature(payload, header, SECRET, tolerance=300)
+    # Bez tolerancji wiek podpisu nie jest sprawdzany
+    verify_signature(payload, header, SECRET, tolerance=0)
+
+
+@pytest.mark.parametrize('header', [None, '', 'v1=abc', 't=123', 't=abc,v1=abc'])
+def test_malformed_header_is_rejected(header):
+    with pytest.raises(SignatureError):
+        verify_signature(pretty(make_event()), header, SECRET)
+
+
+def test_event_type_of_pretty_payload_ignores_nested_type():
+    assert event_type(pretty(make_event('product.updated'))) == 'product.updated'
+
+
+def test_event_type_of_compact_payload():
+    payload = json.dumps(make_event(), separators=(',', ':')).encode('utf-8')
+    assert event_type(payload) == 'checkout.session.completed'
+
+
+def test_event_type_of_invalid_payload():
+    with pytest.raises(ValueError):
+        event_type(b'{"id": ')
+    with pytest.raises(ValueError):
+        event_type(b'[]')
+
+
+def post_webhook(client, payload, header=None):
+    return client.post('/webhook', data=payload, content_type='application/json',
+                       headers={'Stripe-Signature': header or sign(payload, WEBHOOK_SECRET)})
+
+
+def test_webhook_queues_signed_event(app):
+    response = post_webhook(app.test_client(), pretty(make_event()))
+    assert response.status_code == 200
+    with app.app_context():
+        assert [job.event_id for job in WebhookJob.query.all()] == ['evt_1']
+
+
+def test_webhook_rejects_tampered_body(app):
+    payload = pretty(make_event())
+    response = post_webhook(app.test_client(), payload.replace(b'evt_1', b'evt_2'), sign(payload, WEBHOOK_SECRET))
+    assert response.status_code == 400
+    with app.app_context():
+        assert WebhookJob.query.count() == 0
+
+
+def test_webhook_acknowledges_ignored_type_without_queueing(app):
+    response = post_webhook(app.test_client(), pretty(make_event('product.updated')))
+    assert response.status_code == 200
+    with app.app_context():
+        assert WebhookJob.query.count() == 0
+
+
+def test_webhook_rejects_oversized_body(app):
+    event = make_event()
+    event['data']['object']['padding'] = 'x' * webhook_filter.max_payload_bytes
+    response = post_webhook(app.test_client(), pretty(event))
+    assert response.status_code == 413
+    with app.app_context():
+        assert WebhookJob.query.count() == 0